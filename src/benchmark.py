@@ -0,0 +1,258 @@
+import os
+import json
+import time
+import argparse
+import tempfile
+import numpy as np
+import pandas as pd
+
+from contextlib import contextmanager
+from shapely.geometry import Polygon
+
+from src.intersect import intersect_building, RESULT_COLUMNS, STAGES
+from src.utils.meshes import sample_surfaces, FloorplanExtrusion
+from src.utils.mesh_store import compile_mesh_store, MeshStore
+from src.utils.pointcloud_store import PointCloudStore, open_store
+from src.utils.instrumentation import StageRecorder, get_peak_rss
+
+
+# Footprint vertices, footprint radius (m) and building height range (m) per size class
+SIZES = {
+    'small': (6, 6.0, (6.0, 10.0)),
+    'medium': (24, 15.0, (10.0, 20.0)),
+    'large': (96, 40.0, (15.0, 30.0)),
+    'very_large': (384, 100.0, (20.0, 50.0)),
+}
+
+
+def make_footprint(num_vertices, radius, rng):
+    """Random star-shaped, so simple, footprint polygon with counter-clockwise vertices"""
+    angles = np.sort(rng.uniform(0, 2 * np.pi, num_vertices))
+    radii = radius * rng.uniform(0.6, 1.0, num_vertices)
+    return np.stack([radii * np.cos(angles), radii * np.sin(angles)], axis=1)
+
+
+def make_building(num_vertices, radius, height_range, rng, arcade_depth=(0.5, 1.5), point_density=20.0, noise=0.03):
+    """Synthetic LoD2.2 building with a mismatched floorplan and a simulated facade point cloud.
+
+    The BAG outline is the footprint of the model. The BGT floorplan lies `arcade_depth`
+    inside of it, like an arcade or a recessed ground floor. The facade points follow the
+    floorplan up to the true intersection height and the outline above it.
+
+    Returns:
+        dict: outline, floorplan (list[list[list]]]), height, truth (float), points (np.array(N,3))
+    """
+    outline = Polygon(make_footprint(num_vertices, radius, rng)).buffer(0)
+    floorplan = outline.buffer(-rng.uniform(*arcade_depth), join_style=2)
+    if floorplan.geom_type != 'Polygon':
+        floorplan = max(floorplan.geoms, key=lambda part: part.area)
+
+    height = rng.uniform(*height_range)
+    truth = rng.uniform(2.5, min(6.0, height - 2.0))
+
+    outline = [[list(point) for point in outline.exterior.coords]]
+    floorplan = [[list(point) for point in floorplan.exterior.coords]]
+
+    lower = FloorplanExtrusion(floorplan).to_trimesh(bottom=0.0, top=truth)
+    upper = FloorplanExtrusion(outline).to_trimesh(bottom=truth, top=height)
+    count = int(point_density * (lower.area + upper.area))
+    points = np.vstack(sample_surfaces([lower, upper], count, seed=rng)) + rng.normal(0, noise, (count, 3))
+
+    return {'outline': outline, 'floorplan': floorplan, 'height': height, 'truth': truth, 'points': points}
+
+
+def to_city_object(outline, height, vertices):
+    """LoD2.2 solid of an extruded outline with 3DBAG-like semantic surfaces, vertices are appended in millimetres"""
+    ring = outline[0][:-1]
+    bottom, top = [], []
+    for x, y in ring:
+        bottom.append(len(vertices))
+        vertices.append([int(round(x * 1000)), int(round(y * 1000)), 0])
+    for x, y in ring:
+        top.append(len(vertices))
+        vertices.append([int(round(x * 1000)), int(round(y * 1000)), int(round(height * 1000))])
+
+    surfaces, values = [[bottom[::-1]], [top]], [0, 1]
+    for i in range(len(ring)):
+        j = (i + 1) % len(ring)
+        surfaces.append([[bottom[i], bottom[j], top[j], top[i]]])
+        values.append(2)
+
+    semantics = {'surfaces': [{'type': 'GroundSurface'}, {'type': 'RoofSurface'}, {'type': 'WallSurface', 'on_footprint_edge': True}, {'type': 'WallSurface', 'on_footprint_edge': False}], 'values': [values]}
+    return {'type': 'BuildingPart', 'attributes': {}, 'geometry': [{'type': 'Solid', 'lod': 2.2, 'boundaries': [surfaces], 'semantics': semantics}]}
+
+
+def make_dataset(root, sizes=('small', 'medium', 'large'), buildings_per_size=5, seed=0, point_density=20.0):
+    """Writes a synthetic dataset: a compiled mesh store, a point cloud store and the floorplans, outlines and true heights
+
+    The meshes and point clouds of an existing dataset in root are replaced.
+
+    Args:
+        root (str): Output folder
+        sizes (list of str, optional): Size classes, see SIZES. Defaults to ('small', 'medium', 'large').
+        buildings_per_size (int, optional): Number of buildings per size class. Defaults to 5.
+        seed (int, optional): Seed. Defaults to 0.
+        point_density (float, optional): Facade points per m2. Defaults to 20.0.
+
+    Returns:
+        dict: idx, sizes, truths, city_map, city_outline, city_model (MeshStore) and dataset_root
+    """
+    rng = np.random.default_rng(seed)
+    os.makedirs(root, exist_ok=True)
+
+    city_objects, vertices = {}, []
+    dataset = {'idx': [], 'sizes': {}, 'truths': {}, 'city_map': {}, 'city_outline': {}}
+
+    with PointCloudStore(os.path.join(root, 'pointclouds'), mode='w') as store:
+        for size in sizes:
+            num_vertices, radius, height_range = SIZES[size]
+            for _ in range(buildings_per_size):
+                id = f'{len(dataset["idx"]):016d}'
+                building = make_building(num_vertices, radius, height_range, rng, point_density=point_density)
+
+                city_objects[f'NL.IMBAG.Pand.{id}-0'] = to_city_object(building['outline'], building['height'], vertices)
+                store.append(id, *building['points'].T)
+
+                dataset['idx'].append(id)
+                dataset['sizes'][id] = size
+                dataset['truths'][id] = building['truth']
+                dataset['city_map'][id] = {'floorplan': building['floorplan']}
+                dataset['city_outline'][id] = {'outline': building['outline']}
+
+    city_json = {'type': 'CityJSON', 'version': '1.0', 'CityObjects': city_objects, 'vertices': vertices, 'transform': {'scale': [0.001, 0.001, 0.001], 'translate': [0.0, 0.0, 0.0]}}
+    with open(os.path.join(root, 'synthetic.json'), 'w') as f:
+        json.dump(city_json, f)
+    compile_mesh_store([os.path.join(root, 'synthetic.json')], os.path.join(root, 'meshes'), 'synthetic', overwrite=True)
+
+    dataset['city_model'] = MeshStore(os.path.join(root, 'meshes'), 'synthetic')
+    dataset['dataset_root'] = os.path.join(root, 'pointclouds')
+
+    # A store that was read before in this process is stale
+    open_store.cache_clear()
+    return dataset
+
+
+def benchmark_building(id, dataset, out_folder, stepsize=0.1, N=10000, smooth=True, search='sweep', scoring='samples', seed=0, adaptive=False, min_N=1000, height_tolerance=None, bootstraps=32):
+    """Runs intersect_building on one building and reads its stage records
+
+    Returns:
+        dict: time (s) and peak RSS (MB, None outside Linux) per stage, see STAGES, height and height error
+    """
+    recorder = StageRecorder(id)
+    result = intersect_building(id, out_folder, dataset['dataset_root'], city_model=dataset['city_model'], city_map=dataset['city_map'], city_outline=dataset['city_outline'], stepsize=stepsize, N=N, smooth=smooth, search=search, scoring=scoring, seed=seed, adaptive=adaptive, min_N=min_N, height_tolerance=height_tolerance, bootstraps=bootstraps, recorder=recorder)
+    result = dict(zip(RESULT_COLUMNS, result))
+
+    row = {'id': id, 'size': dataset['sizes'][id]}
+    for stage in STAGES:
+        records = [record for record in recorder.records if record['stage'] == stage]
+        peaks = [record['stage_peak_rss'] for record in records if record['stage_peak_rss'] is not None]
+        row[stage + '_time'] = sum(record['time'] for record in records)
+        row[stage + '_memory'] = max(peaks) if peaks else None
+
+    row['points'] = result['points']
+    row['triangles'] = result['faces']
+    row['bag_ann_score'] = result['bag_ann_score']
+    row['intersected_ann_score'] = result['intersected_ann_score']
+    row['evaluations'] = result['evaluations']
+    row['N'] = result['N']
+    row['height'] = result['height']
+    row['truth'] = dataset['truths'][id]
+    row['height_error'] = np.nan if result['height'] is None else abs(result['height'] - dataset['truths'][id])
+    row['total_time'] = sum(row[stage + '_time'] for stage in STAGES)
+    return row
+
+
+def summarize(results):
+    """Mean stage times, peak memory, throughput and height error per size class
+
+    Args:
+        results (pandas.DataFrame): Rows of benchmark_building
+
+    Returns:
+        pandas.DataFrame
+    """
+    summary = results.groupby('size', sort=False).agg(
+        buildings=('id', 'count'),
+        points=('points', 'mean'),
+        triangles=('triangles', 'mean'),
+        N=('N', 'mean'),
+        evaluations=('evaluations', 'mean'),
+        **{stage + '_time': (stage + '_time', 'mean') for stage in STAGES},
+        total_time=('total_time', 'mean'),
+        peak_memory=('peak_memory', 'max'),
+        height_error=('height_error', 'mean'),
+        max_height_error=('height_error', 'max'),
+    )
+    summary['buildings_per_second'] = 1 / summary['total_time']
+    summary['points_per_second'] = summary['points'] / summary['total_time']
+    return summary
+
+
+@contextmanager
+def nullcontext_dir(root):
+    os.makedirs(root, exist_ok=True)
+    yield root
+
+
+def run(sizes=('small', 'medium', 'large'), buildings_per_size=5, seed=0, point_density=20.0, root=None, output=None, **options):
+    """Generates a synthetic dataset and benchmarks the full intersection pipeline on it
+
+    Args:
+        sizes (list of str, optional): Size classes, see SIZES. Defaults to ('small', 'medium', 'large').
+        buildings_per_size (int, optional): Number of buildings per size class. Defaults to 5.
+        seed (int, optional): Seed of the dataset and the sampling. Defaults to 0.
+        point_density (float, optional): Facade points per m2. Defaults to 20.0.
+        root (str, optional): Folder for the dataset and output meshes. Defaults to None, a temporary folder.
+        output (str, optional): JSON lines file that receives the summary of this run, to compare runs over time. Defaults to None.
+        **options: stepsize, N, smooth, search, scoring, adaptive, min_N, height_tolerance and bootstraps, see intersect
+
+    Returns:
+        results (pandas.DataFrame): per building,
+        summary (pandas.DataFrame): per size class
+    """
+    with tempfile.TemporaryDirectory() if root is None else nullcontext_dir(root) as root:
+        dataset = make_dataset(root, sizes=sizes, buildings_per_size=buildings_per_size, seed=seed, point_density=point_density)
+        out_folder = os.path.join(root, 'out')
+        os.makedirs(out_folder, exist_ok=True)
+
+        # Compile the numba kernels outside of the measurements
+        benchmark_building(dataset['idx'][0], dataset, out_folder, seed=seed, **options)
+
+        rows = []
+        for id in dataset['idx']:
+            row = benchmark_building(id, dataset, out_folder, seed=seed, **options)
+            row['peak_memory'] = max([row[stage + '_memory'] for stage in STAGES if row[stage + '_memory'] is not None], default=None)
+            rows.append(row)
+            print(f'Benchmarked {id} ({row["size"]}) | {row["total_time"]:.3f} s | height error {row["height_error"]:.3f}')
+
+    results = pd.DataFrame(rows).set_index('id')
+    summary = summarize(results.reset_index())
+
+    if output:
+        record = {'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'options': options, 'seed': seed, 'lifetime_peak_rss': get_peak_rss(), 'summary': json.loads(summary.to_json(orient='index'))}
+        with open(output, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+
+    return results, summary
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the intersection pipeline on synthetic buildings')
+    parser.add_argument('--sizes', nargs='+', default=['small', 'medium', 'large'], choices=list(SIZES))
+    parser.add_argument('--buildings', type=int, default=5, help='Buildings per size class')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--density', type=float, default=20.0, help='Facade points per m2')
+    parser.add_argument('--stepsize', type=float, default=0.1)
+    parser.add_argument('--N', type=int, default=10000)
+    parser.add_argument('--search', default='sweep', choices=['sweep', 'coarse_to_fine'])
+    parser.add_argument('--scoring', default='samples', choices=['samples', 'exact'])
+    parser.add_argument('--adaptive', action='store_true', help='Grow the number of point cloud samples from --min-N up to --N')
+    parser.add_argument('--min-N', type=int, default=1000)
+    parser.add_argument('--height-tolerance', type=float, default=None)
+    parser.add_argument('--root', default=None, help='Keep the dataset and meshes in this folder')
+    parser.add_argument('--output', default=None, help='Append the summary to this JSON lines file')
+    args = parser.parse_args()
+
+    _, summary = run(sizes=args.sizes, buildings_per_size=args.buildings, seed=args.seed, point_density=args.density, root=args.root, output=args.output, stepsize=args.stepsize, N=args.N, search=args.search, scoring=args.scoring, adaptive=args.adaptive, min_N=args.min_N, height_tolerance=args.height_tolerance)
+    with pd.option_context('display.max_columns', None, 'display.width', 200):
+        print(summary.T)
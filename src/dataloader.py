@@ -4,7 +4,26 @@ import os
 import laspy
 import networkx as nx
 
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
 from src.utils.cityjson import geometry_part_to_trimesh
+from src.utils.mesh_store import MeshStore
+from src.utils.tile_index import TileIndex
+from src.utils.pointcloud_store import PointCloud, PointCloudStore, open_store
+
+AERIAL_ROOT = 'D:/datasets/Amsterdam/aerial/'
+
+# LAZ layers that hold every dimension, only LAS 1.4 point formats 6 to 10 decompress them separately
+DIMENSION_LAYERS = {
+    'x': laspy.DecompressionSelection.XY_RETURNS_CHANNEL,
+    'y': laspy.DecompressionSelection.XY_RETURNS_CHANNEL,
+    'z': laspy.DecompressionSelection.Z,
+    'red': laspy.DecompressionSelection.RGB,
+    'green': laspy.DecompressionSelection.RGB,
+    'blue': laspy.DecompressionSelection.RGB,
+}
+COLOURS = ('red', 'green', 'blue')
 
 
 def get_floorplan_from_mesh(mesh):
@@ -22,54 +41,192 @@ def get_floorplan_from_mesh(mesh):
     return [[list(node) for node in part] for part in floorplan]
 
 
-def get_item(id, dataset_root, city_model=None, city_map=None, city_outline=None, return_aer=False, center=True):
-    """_summary_
+def read_pointcloud(path, dimensions=None):
+    """Read a LAS/LAZ file, decoding only the requested dimensions
+
+    Args:
+        path (str): LAS/LAZ file
+        dimensions (list of str, optional): Any of x, y, z, red, green and blue. Defaults to None, every dimension.
+
+    Returns:
+        laspy.LasData without dimensions, PointCloud with x, y, z and the colours when any colour is requested
+    """
+    if dimensions is None:
+        return laspy.read(path)
+
+    selection = laspy.DecompressionSelection.XY_RETURNS_CHANNEL
+    for dimension in dimensions:
+        if dimension not in DIMENSION_LAYERS:
+            raise ValueError(f'Dimension <{dimension}> not available')
+        selection |= DIMENSION_LAYERS[dimension]
+
+    las = laspy.read(path, decompression_selection=selection)
+    x, y, z = np.array(las.x), np.array(las.y), np.array(las.z)
+    if any(dimension in COLOURS for dimension in dimensions):
+        return PointCloud(x, y, z, np.array(las.red), np.array(las.green), np.array(las.blue))
+    return PointCloud(x, y, z)
+
+
+class LazyPointCloud:
+    """Point cloud that is only read when it is first used"""
+
+    def __init__(self, path, dimensions=None, colour_scale=1):
+        """
+        Args:
+            path (str): LAS/LAZ file
+            dimensions (list of str, optional): See read_pointcloud. Defaults to None.
+            colour_scale (int, optional): Factor of the colours, e.g. 256 for 8-bit colours. Defaults to 1.
+        """
+        self.path = path
+        self.dimensions = dimensions
+        self.colour_scale = colour_scale
+        self._pcd = None
+
+    def load(self):
+        if self._pcd is None:
+            pcd = read_pointcloud(self.path, self.dimensions)
+            if self.colour_scale != 1 and pcd.red is not None:
+                pcd.red *= self.colour_scale
+                pcd.green *= self.colour_scale
+                pcd.blue *= self.colour_scale
+            self._pcd = pcd
+        return self._pcd
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self.load(), name)
+
+    def __len__(self):
+        return len(self.load())
+
+    def __getitem__(self, idx):
+        return self.load()[idx]
+
+
+class BuildingDataset:
+    """Buildings of a city model with their floorplan, outline and point cloud.
+
+    The building-part lookup of a cjio city model is built once instead of once per
+    building. prefetch() loads the next buildings on background threads while the caller
+    works on the current one.
+    """
+
+    def __init__(self, dataset_root, city_model=None, city_map=None, city_outline=None, return_aer=False, center=True, dimensions=None, aerial_root=AERIAL_ROOT, aerial_dimensions=None, max_points=None):
+        """
+        Args:
+            dataset_root (str): Folder with an {id}.laz per building, or a PointCloudStore folder
+            city_model (cjio.cityjson.CityJSON, MeshStore or TileIndex, optional): Building models. Defaults to None.
+            city_map (dict, optional): Floorplan per id. Defaults to None.
+            city_outline (dict, optional): Outline per id. Defaults to None.
+            return_aer (bool, optional): Also return the aerial point cloud, it is read when it is first used. Defaults to False.
+            center (bool, optional): Move the building to the mean of its point cloud. Defaults to True.
+            dimensions (list of str, optional): Point dimensions to decode, e.g. ['x', 'y', 'z'], see read_pointcloud. Defaults to None, every dimension.
+            aerial_root (str, optional): Folder with an {id}.laz aerial point cloud per building. Defaults to AERIAL_ROOT.
+            aerial_dimensions (list of str, optional): Point dimensions of the aerial point cloud. Defaults to None, every dimension.
+            max_points (int, optional): Read at most max_points random points per building from a shuffled PointCloudStore, ignored otherwise. Defaults to None, every point.
+        """
+        assert city_model, 'city_model required for Amsterdam dataset'
+        assert city_map, 'city_map required for Amsterdam dataset'
+        assert city_outline, 'city_outline required for Amsterdam dataset'
+
+        self.dataset_root = dataset_root
+        self.city_model = city_model
+        self.city_map = city_map
+        self.city_outline = city_outline
+        self.return_aer = return_aer
+        self.center = center
+        self.dimensions = dimensions
+        self.aerial_root = aerial_root
+        self.aerial_dimensions = aerial_dimensions
+        self.max_points = max_points
+
+        if isinstance(city_model, (MeshStore, TileIndex)):
+            self.buildings = None
+        else:
+            self.buildings = city_model.get_cityobjects(type=['building', 'buildingpart'])
+
+    def get_meshes(self, id):
+        if self.buildings is None:
+            _, wall, roof = self.city_model.get(f'NL.IMBAG.Pand.{id}-0')
+        else:
+            _, wall, roof = geometry_part_to_trimesh(self.buildings[f'NL.IMBAG.Pand.{id}-0'])
+        return wall, roof
+
+    def __getitem__(self, id):
+        """
+        Returns:
+            trimesh.Trimesh, trimesh.Trimesh, list[list[list]], shapely.multipolygon, laspy : wall, roof, floorplan, outline, pcd
+            and a LazyPointCloud of the aerial point cloud with return_aer
+        """
+        # Load building data
+        wall, roof = self.get_meshes(id)
+        floorplan = self.city_map[id]['floorplan']
+        outline = self.city_outline[id]['outline']
+        if PointCloudStore.is_store(self.dataset_root):
+            colours = self.dimensions is None or any(dimension in COLOURS for dimension in self.dimensions)
+            store = open_store(self.dataset_root)
+            pcd = store.get(id, max_points=self.max_points if store.shuffled else None, colours=colours)
+        else:
+            pcd = read_pointcloud(os.path.join(self.dataset_root, id + '.laz'), self.dimensions)
+
+        if self.center:
+            mean = np.array([np.array(pcd.x).mean(), np.array(pcd.y).mean(), np.array(pcd.z).mean()])
+            wall.vertices -= mean
+            roof.vertices -= mean
+            pcd.x -= mean[0]
+            pcd.y -= mean[1]
+            pcd.z -= mean[2]
+
+            floorplan = [[[c0 - mean[0], c1 - mean[1]] for c0, c1 in part] for part in floorplan]
+            outline = [[[c0 - mean[0], c1 - mean[1]] for c0, c1 in part] for part in outline]
+        
+        upscale = False
+        if upscale:
+            pcd.x *= 2
+            pcd.y *= 2
+            pcd.z *= 2
+
+        if self.return_aer:
+            pcd_aer = LazyPointCloud(os.path.join(self.aerial_root, id + '.laz'), self.aerial_dimensions, colour_scale=256)
+            return wall, roof, floorplan, outline, pcd, pcd_aer
+        return wall, roof, floorplan, outline, pcd
+
+    def prefetch(self, idx, k=2):
+        """Load buildings in order, at most k ahead of the consumer
+
+        Args:
+            idx (list of str): Building ids
+            k (int, optional): Number of buildings loaded ahead on background threads, at least 1. Defaults to 2.
+
+        Yields:
+            id (str), concurrent.futures.Future: the future of self[id], its result() raises the loading error
+        """
+        with ThreadPoolExecutor(max_workers=k) as executor:
+            pending = deque()
+            try:
+                for id in idx:
+                    pending.append((id, executor.submit(self.__getitem__, id)))
+                    if len(pending) > k:
+                        yield pending.popleft()
+                while pending:
+                    yield pending.popleft()
+            finally:
+                # Stop loading when the consumer stops early
+                for _, future in pending:
+                    future.cancel()
+
+
+def get_item(id, dataset_root, city_model=None, city_map=None, city_outline=None, return_aer=False, center=True, dimensions=None, aerial_root=AERIAL_ROOT, aerial_dimensions=None, max_points=None):
+    """Loads a single building, use BuildingDataset for many buildings
 
     Args:
-        id (_type_): _description_
-        city_model (_type_, optional): _description_. Defaults to None.
-        city_map (_type_, optional): _description_. Defaults to None.
-        dataset (str, optional): _description_. Defaults to 'Amsterdam'.
+        id (str): Building id
+        dataset_root (str): Folder with an {id}.laz per building, or a PointCloudStore folder
+        See BuildingDataset for the other arguments.
 
     Returns:
         trimesh.Trimesh, trimesh.Trimesh, list[list[list]], shapely.multipolygon, laspy : wall, roof, floorplan, outline, pcd
+        and a LazyPointCloud of the aerial point cloud with return_aer
     """
-    assert city_model, 'city_model required for Amsterdam dataset'
-    assert city_map, 'city_map required for Amsterdam dataset'
-    assert city_outline, 'city_outline required for Amsterdam dataset'
-
-    pcd_aer_dir = 'D:/datasets/Amsterdam/aerial/'
-
-    # Load building data
-    building = city_model.get_cityobjects(type=['building', 'buildingpart'])[f'NL.IMBAG.Pand.{id}-0']
-    _, wall, roof = geometry_part_to_trimesh(building)
-    floorplan = city_map[id]['floorplan']
-    outline = city_outline[id]['outline']
-    pcd = laspy.read(os.path.join(dataset_root, id + '.laz'))
-
-    if return_aer:
-        pcd_aer = laspy.read(os.path.join(pcd_aer_dir, id + '.laz'))
-
-        pcd_aer.red *= 256
-        pcd_aer.green *= 256
-        pcd_aer.blue *= 256
-
-
-    if center:
-        mean = np.array([np.array(pcd.x).mean(), np.array(pcd.y).mean(), np.array(pcd.z).mean()])
-        wall.vertices -= mean
-        roof.vertices -= mean
-        pcd.x -= mean[0]
-        pcd.y -= mean[1]
-        pcd.z -= mean[2]
-
-        floorplan = [[[c0 - mean[0], c1 - mean[1]] for c0, c1 in part] for part in floorplan]
-        outline = [[[c0 - mean[0], c1 - mean[1]] for c0, c1 in part] for part in outline]
-    
-    upscale = False
-    if upscale:
-        pcd.x *= 2
-        pcd.y *= 2
-        pcd.z *= 2
-
-    return wall, roof, floorplan, outline, pcd
\ No newline at end of file
+    return BuildingDataset(dataset_root, city_model=city_model, city_map=city_map, city_outline=city_outline, return_aer=return_aer, center=center, dimensions=dimensions, aerial_root=aerial_root, aerial_dimensions=aerial_dimensions, max_points=max_points)[id]
@@ -4,12 +4,24 @@ import os
 import trimesh
 import numpy as np
 import pandas as pd
-
-from scipy.spatial import cKDTree
+import laspy
+import cProfile
+import multiprocessing
+import heapq
+import marshal
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from contextlib import nullcontext, closing
 from timeit import default_timer as timer
 
-from src.utils.meshes import merge_wall_and_floorplan3d, add_color_to_mesh, floorplan3dfier, get_intersection
-from src.utils.metrics import average_nearest_neighbour
+from src.utils.meshes import merge_wall_and_floorplan3d, add_color_to_mesh, FloorplanExtrusion, get_intersection_geometry, sample_surfaces, footprints_match, to_shapely
+from src.utils.cityjson_writer import CityJSONSeqWriter, horizontal_surface_types, seq_to_cityjson
+from src.utils.metrics import average_nearest_neighbour, average_distance_to_mesh
+from src.utils.pointcloud_store import PointCloudStore, open_store
+from src.utils.results import ResultStore
+from src.utils.tile_index import TileIndex
+from src.utils.instrumentation import StageRecorder
+from src.utils.sweep import HeightSweep, ExactHeightSweep, SMOOTHING_KERNEL, adaptive_sweep, bootstrap_spread, coarse_to_fine_search, histogram_seeds
 import src.dataloader as dataloader
 
 
@@ -34,7 +46,32 @@ def sample_even_pcd(pcd, N=10000, bins=20, bottom=0.0):
     return pcd[clip_idx]
 
 
-def get_samples(building_model, floorplan3d, intersection, pcd, N=10000, bottom_buffer=0.0, top_buffer=0.0):
+def get_pointcloud_samples(pcd, building_model, N=10000, bottom_buffer=0.0, top_buffer=0.0, seed=None):
+    """Random point cloud samples within the height range of the building model
+
+    Returns:
+        np.array(N,3)
+    """
+    rng = np.random.default_rng(seed)
+
+    pcd = pcd[np.where(pcd.z > building_model.vertices.min(axis=0)[2] + bottom_buffer)]
+    pcd = pcd[np.where(pcd.z < building_model.vertices.max(axis=0)[2] - top_buffer)]
+    pcd = pcd[rng.choice(len(pcd), min(N, len(pcd)), replace=False)]
+
+    return np.array([pcd.x, pcd.y, pcd.z]).T
+
+
+def adaptive_sample_counts(N, min_N=1000):
+    """Sample counts of the adaptive mode, doubling from min_N up to N"""
+    counts = []
+    count = min(min_N, N)
+    while count < N:
+        counts.append(count)
+        count *= 2
+    return counts + [N]
+
+
+def get_samples(building_model, floorplan3d, intersection, pcd, N=10000, bottom_buffer=0.0, top_buffer=0.0, seed=None):
     """_summary_
 
     Args:
@@ -42,40 +79,28 @@ def get_samples(building_model, floorplan3d, intersection, pcd, N=10000, bottom_
         floorplan3d (trimesh.Trimesh): _description_
         intersection (trimesh.Trimesh): _description_
         pointcloud (laspy): _description_
-        N (int, optional): _description_. Defaults to 10000.
+        N (int, optional): Number of point cloud samples and the shared number of mesh samples. Defaults to 10000.
         bottom_buffer (float, optional): _description_. Defaults to 0.0.
         top_buffer (float, optional): _description_. Defaults to 0.0.
+        seed (int or np.random.Generator, optional): Seed of the sampling. Defaults to None.
 
     Returns:
-        samples_building_model (np.array(N,3)),
-        samples_floorplan3d (np.array(N,3)),
-        samples_intersection (np.array(N,3)),
-        samples_pointcloud (np.array(N,3)),
+        samples_building_model (np.array(n,3)),
+        samples_floorplan3d (np.array(m,3)),
+        samples_intersection (np.array(k,3), None without an intersection), the meshes split the N samples by area, n + m + k = N
+        samples_pointcloud (np.array(N,3)), fewer when fewer points lie within the height range
     """
 
-    if intersection:
-        total_area = sum([building_model.area, floorplan3d.area, intersection.area])
-
-        samples_building_model, _ = trimesh.sample.sample_surface_even(building_model, int(N * (building_model.area / np.   sum([building_model.area, intersection.area]))))
-        samples_floorplan3d, _ = trimesh.sample.sample_surface_even(floorplan3d, int(N * (floorplan3d.area / np.sum([floorplan3d.area, intersection.area]))))
-        samples_intersection, _ = trimesh.sample.sample_surface_even(intersection, int(N * (intersection.area / np.sum([np.mean([floorplan3d.area, building_model.area]), intersection.area]))))
-
-    else:
-        total_area = sum([building_model.area, floorplan3d.area])
-
-        samples_building_model, _ = trimesh.sample.sample_surface_even(building_model, int(N * (building_model.area / total_area)))
-        samples_floorplan3d, _ = trimesh.sample.sample_surface_even(floorplan3d, int(N * (floorplan3d.area / total_area)))
-        samples_intersection = None
+    rng = np.random.default_rng(seed)
 
-    pcd = pcd[np.where(pcd.z > building_model.vertices.min(axis=0)[2] + bottom_buffer)]
-    pcd = pcd[np.where(pcd.z < building_model.vertices.max(axis=0)[2] - top_buffer)]
-    pcd = pcd[np.random.choice(len(pcd), min(N, len(pcd)), replace=False)]
+    # Stratified samples with the same density on every mesh
+    samples_building_model, samples_floorplan3d, samples_intersection = sample_surfaces([building_model, floorplan3d, intersection], N, seed=rng)
 
-    samples_pointcloud = np.array([pcd.x, pcd.y, pcd.z]).T
+    samples_pointcloud = get_pointcloud_samples(pcd, building_model, N=N, bottom_buffer=bottom_buffer, top_buffer=top_buffer, seed=rng)
     return samples_building_model, samples_floorplan3d, samples_intersection, samples_pointcloud
 
 
-def optimal_intersection_height(samples_building_model, samples_floorplan3d, samples_intersection, samples_pointcloud, stepsize=0.2, bottom_buffer=0.0, top_buffer=0.0, smooth=False):
+def optimal_intersection_height(samples_building_model, samples_floorplan3d, samples_intersection, samples_pointcloud, stepsize=0.2, bottom_buffer=0.0, top_buffer=0.0, smooth=False, search='sweep', coarse_stepsize=1.0, tolerance=None, candidates=2, histogram_seed=False, return_evaluations=False, sweep=None, bootstraps=0, seed=None, sample_counts=None, height_tolerance=None):
     """_summary_
 
     Args:
@@ -86,136 +111,499 @@ def optimal_intersection_height(samples_building_model, samples_floorplan3d, sam
         stepsize (float, optional): _description_. Defaults to 0.2.
         buffer (float, optional): _description_. Defaults to 3.0.
         smooth (bool, optional): _description_. Defaults to False.
+        search (str, optional): 'sweep' scores every step, 'coarse_to_fine' scans every coarse_stepsize and refines the best candidates. Defaults to 'sweep'.
+        coarse_stepsize (float, optional): Interval of the coarse scan. Defaults to 1.0.
+        tolerance (float, optional): Height tolerance of the refinement. Defaults to the stepsize.
+        candidates (int, optional): Number of coarse minima to refine. Defaults to 2.
+        histogram_seed (bool, optional): Add the densest z-levels of the point cloud to the coarse scan. Defaults to False.
+        return_evaluations (bool, optional): Also return the number of score evaluations. Defaults to False.
+        sweep (HeightSweep, optional): Prebuilt scoring engine, e.g. an ExactHeightSweep. The building model samples then only set the height range. Defaults to None, a HeightSweep on the samples.
+        bootstraps (int, optional): Number of bootstrap resamples for the spread of the height, 'sweep' only. Defaults to 0, no spread.
+        seed (int or np.random.Generator, optional): Seed of the bootstrap. Defaults to None.
+        sample_counts (list of int, optional): Score the first sample_counts[0], sample_counts[1], .. point cloud samples until the height is stable, see adaptive_sweep. Needs 'sweep' and bootstraps, a prebuilt sweep holds the first sample_counts[0] samples. Defaults to None, all samples at once.
+        height_tolerance (float, optional): Spread at which sample_counts stops. Defaults to the stepsize.
 
     Returns:
         height: (float),
         score: (float),
-        scores: (np.array(M,)),
-        steps: (np.array(M,))
+        scores: (np.array(M,)), for 'coarse_to_fine' the unfiltered scores of the evaluated steps only
+        steps: (np.array(M,)),
+        evaluations: (int), only with return_evaluations
+        spread: (float), only with bootstraps, see bootstrap_spread
+        count: (int), number of point cloud samples used, only with sample_counts
     """
     # mean height from the building model ground
     min_height = (samples_building_model.min(axis=0)[2] // stepsize) * stepsize + bottom_buffer
     max_height = (samples_building_model.max(axis=0)[2] // stepsize) * stepsize - top_buffer
 
     steps = np.arange(min_height, max_height, stepsize)
-    scores = np.zeros_like(steps)
+
+    if bootstraps and search != 'sweep':
+        raise ValueError(f'Bootstrap needs the full sweep, not <{search}>')
+    if sample_counts and not bootstraps:
+        raise ValueError('Sample counts need bootstraps')
 
     # Exit if building is too small
     if steps.shape[0] == 0:
-        return None, np.inf, None, None
+        return (None, np.inf, None, None) + ((0,) if return_evaluations else ()) + ((0.0,) if bootstraps else ()) + ((samples_pointcloud.shape[0],) if sample_counts else ())
+
+    # Build the spatial structures once and score every step from them
+    if sweep is None:
+        sweep = HeightSweep(samples_building_model, samples_floorplan3d, samples_intersection, samples_pointcloud[:sample_counts[0]] if sample_counts else samples_pointcloud)
+
+    if search == 'sweep':
+        if sample_counts:
+            scores, count, spread = adaptive_sweep(sweep, samples_pointcloud, steps, sample_counts, smooth=smooth, height_tolerance=stepsize if height_tolerance is None else height_tolerance, bootstraps=bootstraps, seed=seed)
+        elif bootstraps:
+            scores, distances = sweep.sweep(steps, return_distances=True)
+            spread = bootstrap_spread(distances, steps, smooth=smooth, bootstraps=bootstraps, seed=seed)
+        else:
+            scores = sweep.sweep(steps)
 
-    samples_floorplan_z = samples_floorplan3d[:,2]
-    samples_building_model_z = samples_building_model[:,2]
+        if smooth:
+            # Apply a gaussian filter
+            scores = np.convolve(scores, SMOOTHING_KERNEL, mode='valid')
+            steps = steps[2:-2]
 
-    for i, intersection in enumerate(steps):
-        # Generate a cloud of the new merged building
-        samples_building = np.vstack((
-            samples_floorplan3d[np.where(samples_floorplan_z < intersection, True, False)], 
-            samples_building_model[np.where(samples_building_model_z >= intersection, True, False)],
-            ))
-        if not samples_intersection is None:
-            samples_building = np.vstack((
-                samples_building,
-                samples_intersection + np.array([0.0, 0.0, intersection])
-            ))
+        # Compute the extrema
+        height = steps[scores.argmin()]
+        score = scores.min()
 
-        # Construct a compact tree
-        tree_pointcloud = cKDTree(samples_building, compact_nodes=False, balanced_tree=False)
+    elif search == 'coarse_to_fine':
+        seeds = histogram_seeds(samples_pointcloud[:,2], steps) if histogram_seed else None
+        index, score, raw_scores = coarse_to_fine_search(sweep, steps, coarse_stepsize=coarse_stepsize, tolerance=tolerance, candidates=candidates, smooth=smooth, seeds=seeds)
+        height = None if index is None else steps[index]
 
-        distances, _  = tree_pointcloud.query(samples_pointcloud, workers=-1)
-        ann = distances.mean()
-        scores[i] = ann
+        evaluated = np.array(sorted(raw_scores), dtype=int)
+        scores = np.array([raw_scores[i] for i in evaluated])
+        steps = steps[evaluated]
 
-    if smooth:
-        # Apply a gaussian filter
-        scores = np.convolve(scores, np.array([0.1, 0.2, 0.4, 0.2, 0.1]), mode='valid')
-        steps = steps[2:-2]
+    else:
+        raise ValueError(f'Search strategy <{search}> not available')
 
-    # Compute the extrema
-    height = steps[scores.argmin()]
-    score = scores.min()
+    result = (height, score, scores, steps)
+    if return_evaluations:
+        result += (sweep.evaluations,)
+    if bootstraps:
+        result += (spread,)
+    if sample_counts:
+        result += (count,)
+    return result
 
-    return height, score, scores, steps
 
+# Only the coordinates of the point clouds are used
+POINT_DIMENSIONS = ['x', 'y', 'z']
 
-def intersect(out_folder, idx, dataset_root, stepsize=0.1, N=10000, improvement_threshold=0.0, bottom_buffer=0.0, top_buffer=0.0, smooth=True, city_model=None, city_map=None, city_outline=None):
-    """_summary_
+# Points read per point cloud sample from a shuffled PointCloudStore, the height filter of the sampling drops some
+STORE_POINTS_PER_SAMPLE = 2
 
-    Args:
-        idx (list): List of strings containing building idx for the dataloader
-        out_folder (str):  Output folder
-        dataset (str, optional): Switch for different datasets. Defaults to 'Amsterdam'.
-        stepsize (float, optional): Defines the interval to check the intersection. Defaults to 0.1.
-        N (int, optional): Number of samples. Defaults to 10000.
-        improvement_threshold (float, optional): Threshold to determine when the improvement is good enough. Defaults to 0.0.
-        bottom_buffer (float, optional): Defines the relative lowest intersection height with respect to the 3dbag bottom. Defaults to 0.0.
-        top_buffer (float, optional): Defines the highest intersection height with respect to the 3dbag top. Defaults to 0.0.
-        buffer (float, optional): _description_. Defaults to 3.0.
-        city_model (cjio.cityjson.CityJSON, optional): City model Defaults to None.
-        city_map (list[list[list[]]], optional): lists containing building floorplans. Defaults to None.
-        city_outline (list[list[list[]]], optional): lists containing building outlines. Defaults to None.
+# A prefetched building records the time spent waiting for it as 'load_wait' instead of 'load'
+STAGES = ['load', 'load_wait', 'floorplan3dfier', 'intersection', 'sampling', 'search', 'bag_score', 'crop', 'export']
 
-    Returns:
-        _type_: _description_
-    """
+RESULT_COLUMNS = ['id', 'bag_ann_score', 'intersected_ann_score', 'improvement', 'intersected_facets', 'intersected_triangles', 'height', 'time', 'evaluations', 'N'] + [stage + '_time' for stage in STAGES] + ['points', 'faces', 'stage_peak_rss', 'skipped']
 
-    results = []
+# Output files of the CityJSON output formats, in out_folder
+CITYJSONSEQ_FILE = 'buildings.city.jsonl'
 
-    for i, id in enumerate(idx):
-        print(f'Processing file {i} | bag_id {id} | ', end='')
-        # Load building data
-        wall, roof, floorplan, outline, pcd = dataloader.get_item(id, city_model=city_model, city_map=city_map, city_outline=city_outline, dataset_root=dataset_root, return_aer=True, center=False)
+CITYJSON_FILE = 'buildings.city.json'
 
-        # Create a 3D version of the footprint
-        floorplan3d = floorplan3dfier(floorplan, bottom_plane=False, top_plane=False, bottom=wall.vertices.min(axis=0)[2], top=wall.vertices.max(axis=0)[2])
+# Dataset of a worker process, set once by _init_worker
+_worker_city_data = {}
+
+
+def intersect_building(id, out_folder, dataset_root, city_model=None, city_map=None, city_outline=None, stepsize=0.1, N=10000, improvement_threshold=0.0, bottom_buffer=0.0, top_buffer=0.0, smooth=True, search='sweep', coarse_stepsize=1.0, tolerance=None, candidates=2, histogram_seed=False, scoring='samples', seed=None, adaptive=False, min_N=1000, height_tolerance=None, bootstraps=32, recorder=None, dataset=None, prefetched=None, encoder=None):
+    """Computes the optimal intersection height of a single building and writes the new mesh
+
+    Args:
+        id (str): Building id for the dataloader
+        recorder (StageRecorder, optional): Receives a record per stage. Defaults to None.
+        dataset (BuildingDataset, optional): Loads the building instead of a new dataset of dataset_root and the city data. Defaults to None.
+        prefetched (concurrent.futures.Future, optional): Building that is already being loaded, from BuildingDataset.prefetch. Defaults to None.
+        encoder (FeatureEncoder, optional): Encodes the new mesh as a CityJSONFeature instead of writing a PLY. Defaults to None.
+        See intersect for the other arguments.
+
+    Returns:
+        list: result row, see RESULT_COLUMNS, and the CityJSONFeature (dict) when an encoder is given
+    """
+    recorder = StageRecorder(id) if recorder is None else recorder
 
-        # Create a 3D version of the intersection
+    # Load building data
+    with recorder.stage('load' if prefetched is None else 'load_wait') as record:
+        if prefetched is not None:
+            wall, roof, floorplan, outline, pcd = prefetched.result()
+        else:
+            dataset = dataloader.BuildingDataset(dataset_root, city_model=city_model, city_map=city_map, city_outline=city_outline, center=False, dimensions=POINT_DIMENSIONS, max_points=STORE_POINTS_PER_SAMPLE * N) if dataset is None else dataset
+            wall, roof, floorplan, outline, pcd = dataset[id]
+        record['points'] = len(pcd)
+        record['faces'] = wall.faces.shape[0] + roof.faces.shape[0]
+
+    # Create a 3D version of the footprint
+    with recorder.stage('floorplan3dfier') as record:
+        floorplan_extrusion = FloorplanExtrusion(floorplan, bottom_plane=False, top_plane=False)
+        floorplan3d = floorplan_extrusion.to_trimesh(bottom=wall.vertices.min(axis=0)[2], top=wall.vertices.max(axis=0)[2])
+
+    # Create a 3D version of the intersection
+    with recorder.stage('intersection') as record:
         try:
-            intersection = get_intersection(floorplan, outline, 0)
+            intersection_geometry = get_intersection_geometry(floorplan, outline)
         except:
-            intersection = None
+            intersection_geometry = None
+        intersection = intersection_geometry.to_trimesh(0) if intersection_geometry else None
+
+    building_model = trimesh.util.concatenate(wall, roof)
+    rng = np.random.default_rng(seed)
+
+    # The adaptive mode scores a growing share of the N point cloud samples until the best height is stable
+    sample_counts = adaptive_sample_counts(N, min_N) if adaptive else None
+    with recorder.stage('sampling') as record:
+        if scoring == 'samples':
+            # Sample points
+            samples_wall, samples_floorplan3d, samples_intersection, samples_pointcloud = get_samples(building_model, floorplan3d, intersection, pcd, N=N, bottom_buffer=bottom_buffer, seed=rng)
+            sweep = None
+
+        elif scoring == 'exact':
+            # Only the point cloud is sampled, the meshes are scored by their triangles
+            samples_wall, samples_floorplan3d, samples_intersection = building_model.vertices, None, None
+            samples_pointcloud = get_pointcloud_samples(pcd, building_model, N=N, bottom_buffer=bottom_buffer, seed=rng)
+            sweep = ExactHeightSweep(building_model, floorplan, wall.vertices.min(axis=0)[2], intersection_geometry, samples_pointcloud[:sample_counts[0]] if adaptive else samples_pointcloud)
 
-        # Sample points
-        samples_wall, samples_floorplan3d, samples_intersection, samples_pointcloud = get_samples(trimesh.util.concatenate(wall, roof), floorplan3d, intersection, pcd, N=N, bottom_buffer=bottom_buffer)
-        
-        # Compute the original ann score
-        bag_ann_score = average_nearest_neighbour(samples_pointcloud, wall, N=N)
+        else:
+            raise ValueError(f'Scoring <{scoring}> not available')
+        record['points'] = samples_pointcloud.shape[0]
 
-        # Compute the optimal intersection height
+    # Compute the optimal intersection height
+    with recorder.stage('search') as record:
         start = timer()
-        optimal_height, intersected_ann_score, _, _ = optimal_intersection_height(samples_wall, samples_floorplan3d, samples_intersection, samples_pointcloud, stepsize=stepsize, bottom_buffer=bottom_buffer, top_buffer=top_buffer, smooth=smooth)
+        optimal_height, intersected_ann_score, _, _, evaluations, *adaptive_result = optimal_intersection_height(samples_wall, samples_floorplan3d, samples_intersection, samples_pointcloud, stepsize=stepsize, bottom_buffer=bottom_buffer, top_buffer=top_buffer, smooth=smooth, search=search, coarse_stepsize=coarse_stepsize, tolerance=tolerance, candidates=candidates, histogram_seed=histogram_seed, return_evaluations=True, sweep=sweep, bootstraps=bootstraps if adaptive else 0, seed=rng, sample_counts=sample_counts, height_tolerance=height_tolerance)
         time = round(timer() - start, 3)
-        print(f'finished in {time}')
-        improvement = (intersected_ann_score - bag_ann_score) / bag_ann_score
-        print(improvement)
+        record['evaluations'] = evaluations
+
+    # The original score uses the same point cloud samples as the search
+    sample_count = adaptive_result[1] if adaptive else samples_pointcloud.shape[0]
+    with recorder.stage('bag_score') as record:
+        if scoring == 'samples':
+            bag_ann_score = average_nearest_neighbour(samples_pointcloud[:sample_count], wall, N=sample_count, seed=rng)
+        else:
+            bag_ann_score = average_distance_to_mesh(samples_pointcloud[:sample_count], wall)
+    improvement = (intersected_ann_score - bag_ann_score) / bag_ann_score
 
-        # If improvement is bigger than a threshold, export new building
+    # If improvement is bigger than a threshold, export new building
+    with recorder.stage('crop') as record:
         if (bag_ann_score - intersected_ann_score) > improvement_threshold:
-            floorplan3d = floorplan3dfier(floorplan, bottom_plane=False, top_plane=False, bottom=wall.vertices.min(axis=0)[2], top=optimal_height)
+            floorplan3d = floorplan_extrusion.to_trimesh(bottom=wall.vertices.min(axis=0)[2], top=optimal_height)
             output_wall = merge_wall_and_floorplan3d(wall, floorplan3d, intersection_height=optimal_height)
-            intersection = get_intersection(floorplan, outline, optimal_height)
-        
+            intersection = intersection_geometry.to_trimesh(optimal_height) if intersection_geometry else None
+
         # Otherwise, return original building
         else:
             optimal_height = None
             output_wall = wall
             intersected_ann_score = bag_ann_score
 
-        # Add colors
-        add_color_to_mesh(output_wall, [1.0, 1.0, 1.0])
-        add_color_to_mesh(roof, [1.0, 0.0, 0.0])
+    with recorder.stage('export') as record:
+        if encoder is not None:
+            # The semantics come from the parts, the intersection is horizontal
+            parts = [(output_wall, 'WallSurface'), (roof, 'RoofSurface')]
+            if optimal_height and intersection:
+                parts.append((intersection, horizontal_surface_types(intersection)))
+            full_building = trimesh.util.concatenate([mesh for mesh, _ in parts])
+            feature = encoder.encode(id, parts, {'intersection_height': optimal_height})
+        else:
+            # Add colors
+            add_color_to_mesh(output_wall, [1.0, 1.0, 1.0])
+            add_color_to_mesh(roof, [1.0, 0.0, 0.0])
+
+            if optimal_height and intersection:
+                add_color_to_mesh(intersection, [1.0, 1.0, 0.0])
+                output_wall = trimesh.util.concatenate([output_wall, intersection])
+            full_building = trimesh.util.concatenate([output_wall, roof])
 
-        if optimal_height and intersection:
-            add_color_to_mesh(intersection, [1.0, 1.0, 0.0])
-            output_wall = trimesh.util.concatenate([output_wall, intersection])
-        full_building = trimesh.util.concatenate([output_wall, roof])
+            # Write new mesh
+            trimesh.exchange.export.export_mesh(full_building, os.path.join(out_folder, id + '.ply'))
+        record['faces'] = full_building.faces.shape[0]
 
-        # Write new mesh
-        trimesh.exchange.export.export_mesh(full_building, os.path.join(out_folder, id + '.ply'))
+    row = [id, bag_ann_score, intersected_ann_score, improvement, len(full_building.facets), full_building.faces.shape[0], optimal_height, time, evaluations, sample_count] + recorder.summary(STAGES) + [False]
+    return (row, feature) if encoder is not None else row
+
+
+def passthrough_building(id, out_folder, dataset, recorder=None, encoder=None):
+    """Writes the original mesh of a building that the triage skipped, without reading its point cloud
+
+    Args:
+        id (str): Building id for the dataloader
+        out_folder (str): Output folder
+        dataset (BuildingDataset): Loads the building model
+        recorder (StageRecorder, optional): Receives a record per stage. Defaults to None.
+        encoder (FeatureEncoder, optional): Encodes the mesh as a CityJSONFeature instead of writing a PLY. Defaults to None.
+
+    Returns:
+        list: result row without scores, see RESULT_COLUMNS, and the CityJSONFeature (dict) when an encoder is given
+    """
+    recorder = StageRecorder(id) if recorder is None else recorder
 
-        # Log results
-        result = [id, bag_ann_score, intersected_ann_score, improvement, len(full_building.facets), full_building.faces.shape[0], optimal_height, time]
-        results.append(result)
+    with recorder.stage('load') as record:
+        wall, roof = dataset.get_meshes(id)
+        record['faces'] = wall.faces.shape[0] + roof.faces.shape[0]
+
+    with recorder.stage('export') as record:
+        if encoder is not None:
+            full_building = trimesh.util.concatenate([wall, roof])
+            feature = encoder.encode(id, [(wall, 'WallSurface'), (roof, 'RoofSurface')])
+        else:
+            add_color_to_mesh(wall, [1.0, 1.0, 1.0])
+            add_color_to_mesh(roof, [1.0, 0.0, 0.0])
+            full_building = trimesh.util.concatenate([wall, roof])
+
+            trimesh.exchange.export.export_mesh(full_building, os.path.join(out_folder, id + '.ply'))
+        record['faces'] = full_building.faces.shape[0]
+
+    row = [id, None, None, 0.0, len(full_building.facets), full_building.faces.shape[0], None, 0.0, 0, 0] + recorder.summary(STAGES) + [True]
+    return (row, feature) if encoder is not None else row
+
+
+def is_skipped(id, city_map, city_outline, thresholds):
+    """True when the triage thresholds let a building keep its mesh, buildings without footprints are not skipped"""
+    try:
+        return footprints_match(city_map[id]['floorplan'], city_outline[id]['outline'], thresholds)
+    except Exception:
+        return False
+
+
+def _init_worker(dataset_root, city_model, city_map, city_outline, max_points=None):
+    _worker_city_data['dataset'] = dataloader.BuildingDataset(dataset_root, city_model=city_model, city_map=city_map, city_outline=city_outline, center=False, dimensions=POINT_DIMENSIONS, max_points=max_points)
+
+
+def _intersect_worker(id, out_folder, dataset_root, options, profile=False, prefetched=None, skip=False, encoder=None):
+    """Runs intersect_building and catches its errors
+
+    Returns:
+        result (list or None), error (str or None), stage records (list of dict), profile stats (dict or None), CityJSONFeature (dict or None)
+    """
+    recorder = StageRecorder(id)
+    profiler = cProfile.Profile() if profile else None
+    feature = None
+    try:
+        if profiler:
+            profiler.enable()
+        if skip:
+            result, error = passthrough_building(id, out_folder, _worker_city_data['dataset'], recorder=recorder, encoder=encoder), None
+        else:
+            result, error = intersect_building(id, out_folder, dataset_root, **_worker_city_data, **options, recorder=recorder, prefetched=prefetched, encoder=encoder), None
+        if encoder is not None:
+            result, feature = result
+    except Exception as exception:
+        result, error = None, repr(exception)
+    finally:
+        if profiler:
+            profiler.disable()
+
+    stats = None
+    if profiler:
+        profiler.create_stats()
+        stats = profiler.stats
+    return result, error, recorder.records, stats, feature
+
+
+def get_translate(ids, city_outline):
+    """Whole-metre lower left corner of the building outlines, the translate of the CityJSON transform"""
+    bounds = []
+    for id in ids:
+        try:
+            bounds.append(to_shapely(city_outline[id]['outline']).bounds)
+        except Exception:
+            continue
+    if not bounds:
+        return [0.0, 0.0, 0.0]
+    bounds = np.array(bounds)
+    return [float(np.floor(bounds[:,0].min())), float(np.floor(bounds[:,1].min())), 0.0]
+
+
+def get_tile_file(id, city_model):
+    """3DBAG tile file of a building model, an empty string when the city model is not a TileIndex"""
+    if isinstance(city_model, TileIndex):
+        return city_model.tile_file(f'NL.IMBAG.Pand.{id}-0') or ''
+    return ''
+
+
+def get_point_count(id, dataset_root):
+    """Number of points of a building point cloud, read from the LAS header or store index only"""
+    if PointCloudStore.is_store(dataset_root):
+        store = open_store(dataset_root)
+        return store.count(id) if id in store else 0
+
+    try:
+        with laspy.open(os.path.join(dataset_root, id + '.laz')) as reader:
+            return reader.header.point_count
+    except (OSError, laspy.errors.LaspyException):
+        return 0
+
+
+def intersect_iter(out_folder, idx, dataset_root, stepsize=0.1, N=10000, improvement_threshold=0.0, bottom_buffer=0.0, top_buffer=0.0, smooth=True, city_model=None, city_map=None, city_outline=None, search='sweep', coarse_stepsize=1.0, tolerance=None, candidates=2, histogram_seed=False, scoring='samples', seed=None, adaptive=False, min_N=1000, height_tolerance=None, bootstraps=32, triage=None, workers=1, result_store=None, sinks=None, profile=0, profile_folder=None, prefetch=2, output_format='ply'):
+    """Generator version of intersect, yields every building as soon as it is finished.
+
+    With a result_store every finished row is committed to disk before it is yielded, and
+    ids that already have a row in the store and an output mesh are skipped, so an
+    interrupted run can be restarted with the same arguments. The CityJSON output formats
+    write every building, in the main process, before its row is committed. The CityJSONSeq
+    file is only continued with a result_store, a building that is in the file but has no
+    row is computed again for its row and is not written twice.
+
+    Args:
+        See intersect.
+
+    Yields:
+        id (str), result (list, see RESULT_COLUMNS, None on failure), error (str or None)
+    """
+    options = dict(stepsize=stepsize, N=N, improvement_threshold=improvement_threshold, bottom_buffer=bottom_buffer, top_buffer=top_buffer, smooth=smooth, search=search, coarse_stepsize=coarse_stepsize, tolerance=tolerance, candidates=candidates, histogram_seed=histogram_seed, scoring=scoring, seed=seed, adaptive=adaptive, min_N=min_N, height_tolerance=height_tolerance, bootstraps=bootstraps)
+
+    store = ResultStore(result_store, RESULT_COLUMNS) if isinstance(result_store, str) else result_store
+    finished = store.ids() if store else set()
+
+    # Without a result store there is nothing to continue, the CityJSONSeq file starts over
+    writer = None
+    if output_format != 'ply':
+        seq_path = os.path.join(out_folder, CITYJSONSEQ_FILE)
+        writer = CityJSONSeqWriter(seq_path, translate=get_translate(idx, city_outline), append=store is not None)
+    encoder = writer.encoder if writer else None
+
+    if output_format == 'ply':
+        todo = [(i, id) for i, id in enumerate(idx) if not (id in finished and os.path.isfile(os.path.join(out_folder, id + '.ply')))]
+    else:
+        todo = [(i, id) for i, id in enumerate(idx) if not (id in finished and id in writer.ids)]
+    if len(todo) < len(idx):
+        print(f'Skipping {len(idx) - len(todo)} finished buildings')
+
+    sinks = list(sinks) if sinks else []
+    profiles = []
+
+    # Buildings whose floorplan and outline agree keep their mesh, their point cloud is never read
+    skipped = {id for _, id in todo if is_skipped(id, city_map, city_outline, triage)} if triage else set()
+
+    def log(i, id, result, error, records=(), stats=None, feature=None):
+        if feature is not None:
+            writer.write_feature(feature)
+
+        if error:
+            print(f'Processing file {i} | bag_id {id} | WARNING: failed with {error}')
+        else:
+            if result[-1]:
+                print(f'Processing file {i} | bag_id {id} | skipped, floorplan matches outline')
+            else:
+                print(f'Processing file {i} | bag_id {id} | finished in {result[7]} ({result[8]} evaluations) | improvement {result[3]}')
+            if store:
+                store.append(result)
+
+        for record in records:
+            for sink in sinks:
+                sink.write(record)
+
+        # Keep the profiles of the slowest buildings only
+        if stats is not None:
+            heapq.heappush(profiles, (sum(record['time'] for record in records), id, stats))
+            if len(profiles) > profile:
+                heapq.heappop(profiles)
+        return id, result, error
+
+    try:
+        if workers == 1:
+            # Load the next buildings while the current one is processed
+            _init_worker(dataset_root, city_model, city_map, city_outline, STORE_POINTS_PER_SAMPLE * N)
+            ids = [id for _, id in todo if id not in skipped]
+            items = _worker_city_data['dataset'].prefetch(ids, k=prefetch) if prefetch > 0 else ((id, None) for id in ids)
+            with closing(items):
+                for i, id in todo:
+                    prefetched = None if id in skipped else next(items)[1]
+                    yield log(i, id, *_intersect_worker(id, out_folder, dataset_root, options, profile=profile > 0, prefetched=prefetched, skip=id in skipped, encoder=encoder))
+
+        else:
+            # Schedule the buildings tile by tile, so the tile cache of the workers is hit, and the
+            # largest buildings first, the tile with the largest building first, so they do not end up as stragglers
+            sizes = {id: 0 if id in skipped else get_point_count(id, dataset_root) for _, id in todo}
+            tiles = {id: get_tile_file(id, city_model) for id in sizes}
+            tile_sizes = {}
+            for id, size in sizes.items():
+                tile_sizes[tiles[id]] = max(tile_sizes.get(tiles[id], 0), size)
+            todo = sorted(todo, key=lambda task: (-tile_sizes[tiles[task[1]]], tiles[task[1]], -sizes[task[1]]))
+
+            # Spawn, forking after the numba and scipy thread pools have started can deadlock
+            with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'), initializer=_init_worker, initargs=(dataset_root, city_model, city_map, city_outline, STORE_POINTS_PER_SAMPLE * N)) as executor:
+                futures = {executor.submit(_intersect_worker, id, out_folder, dataset_root, options, profile > 0, None, id in skipped, encoder): (i, id) for i, id in todo}
+                for future in as_completed(futures):
+                    i, id = futures[future]
+                    try:
+                        yield log(i, id, *future.result())
+                    except Exception as exception:
+                        yield log(i, id, None, repr(exception))
+
+    finally:
+        _worker_city_data.clear()
+        if store is not None and store is not result_store:
+            store.close()
+
+        if writer is not None:
+            writer.close()
+            if output_format == 'cityjson':
+                seq_to_cityjson(seq_path, os.path.join(out_folder, CITYJSON_FILE))
+
+        # Same format as cProfile.Profile.dump_stats, readable with pstats.Stats
+        if profiles:
+            profile_folder = os.path.join(out_folder, 'profiles') if profile_folder is None else profile_folder
+            os.makedirs(profile_folder, exist_ok=True)
+            for _, id, stats in profiles:
+                with open(os.path.join(profile_folder, id + '.prof'), 'wb') as f:
+                    marshal.dump(stats, f)
+
+
+def intersect(out_folder, idx, dataset_root, stepsize=0.1, N=10000, improvement_threshold=0.0, bottom_buffer=0.0, top_buffer=0.0, smooth=True, city_model=None, city_map=None, city_outline=None, search='sweep', coarse_stepsize=1.0, tolerance=None, candidates=2, histogram_seed=False, scoring='samples', seed=None, adaptive=False, min_N=1000, height_tolerance=None, bootstraps=32, triage=None, workers=1, result_store=None, sinks=None, profile=0, profile_folder=None, prefetch=2, output_format='ply'):
+    """_summary_
+
+    Args:
+        idx (list): List of strings containing building idx for the dataloader
+        out_folder (str):  Output folder
+        dataset (str, optional): Switch for different datasets. Defaults to 'Amsterdam'.
+        stepsize (float, optional): Defines the interval to check the intersection. Defaults to 0.1.
+        N (int, optional): Number of point cloud samples and of mesh samples. The building model, floorplan extrusion and intersection share the N mesh samples by area, so every mesh is sampled less densely than with N samples per mesh. Defaults to 10000.
+        improvement_threshold (float, optional): Threshold to determine when the improvement is good enough. Defaults to 0.0.
+        bottom_buffer (float, optional): Defines the relative lowest intersection height with respect to the 3dbag bottom. Defaults to 0.0.
+        top_buffer (float, optional): Defines the highest intersection height with respect to the 3dbag top. Defaults to 0.0.
+        buffer (float, optional): _description_. Defaults to 3.0.
+        city_model (cjio.cityjson.CityJSON, MeshStore or TileIndex, optional): City model Defaults to None.
+        city_map (list[list[list[]]], optional): lists containing building floorplans. Defaults to None.
+        city_outline (list[list[list[]]], optional): lists containing building outlines. Defaults to None.
+        search (str, optional): Height search strategy, 'sweep' or 'coarse_to_fine'. 'coarse_to_fine' measured 1.1-1.9x faster than 'sweep' on the synthetic benchmark. Defaults to 'sweep'.
+        coarse_stepsize (float, optional): Interval of the coarse scan for 'coarse_to_fine'. Defaults to 1.0.
+        tolerance (float, optional): Height tolerance for 'coarse_to_fine'. Defaults to the stepsize.
+        candidates (int, optional): Number of coarse minima that 'coarse_to_fine' refines. Defaults to 2.
+        histogram_seed (bool, optional): Seed the coarse scan with the densest z-levels of the point cloud. Defaults to False.
+        scoring (str, optional): 'samples' scores against N surface samples of the meshes, 'exact' against the mesh triangles, which needs fewer point cloud samples N for the same accuracy. Defaults to 'samples'.
+        seed (int, optional): Seed of the sampling, every building starts from it so results do not depend on the order or the number of workers. Defaults to None.
+        adaptive (bool, optional): Score the first min_N of the N point cloud samples and double them, up to N, until the bootstrap spread of the best height is within height_tolerance and the best height agrees with the previous round. Every round only scores its extra samples. Needs search 'sweep'. Defaults to False.
+        min_N (int, optional): First sample count of the adaptive mode. Defaults to 1000.
+        height_tolerance (float, optional): Spread of the best height at which the adaptive mode stops. Defaults to the stepsize.
+        bootstraps (int, optional): Number of bootstrap resamples of the adaptive mode. Defaults to 32.
+        triage (dict, optional): Skip buildings whose floorplan and outline agree within these thresholds, e.g. TRIAGE_THRESHOLDS, see footprints_match. They keep their original mesh and get no scores. Defaults to None, no triage.
+        workers (int, optional): Number of worker processes, 1 runs in this process. The city data is sent once per worker and the buildings are scheduled largest point cloud first. Defaults to 1.
+        result_store (str or ResultStore, optional): SQLite file that receives every result row as it finishes. Finished ids are skipped on a restart. Defaults to None.
+        sinks (list, optional): Receive a record with the wall time, counts and peak RSS of every stage of every building, e.g. JsonLinesSink, MemorySink or LoggingSink. Defaults to None.
+        profile (int, optional): Profile every building with cProfile and keep the profiles of the slowest `profile` buildings. Defaults to 0.
+        profile_folder (str, optional): Folder for the {id}.prof files. Defaults to out_folder/profiles.
+        prefetch (int, optional): Number of buildings loaded ahead on background threads while a building is processed, with one worker. 0 loads every building in turn. Defaults to 2.
+        output_format (str, optional): 'ply' writes {id}.ply per building. 'cityjsonseq' streams every building to out_folder/CITYJSONSEQ_FILE as soon as it is finished, with semantic surfaces and vertices quantized to 1 mm, and appends to it on a restart. 'cityjson' does the same and merges it into out_folder/CITYJSON_FILE, with one deduplicated vertex pool, at the end. Defaults to 'ply'.
+
+    Returns:
+        pandas.DataFrame: results per building in the order of idx, failed buildings are left out. Besides the scores it has the number of samples N that was used, the wall time of every stage (see STAGES), the number of points and faces of the input, the peak RSS (MB) and whether the triage skipped the building.
+    """
+    results = {}
+    for id, result, _ in intersect_iter(out_folder, idx, dataset_root, stepsize=stepsize, N=N, improvement_threshold=improvement_threshold, bottom_buffer=bottom_buffer, top_buffer=top_buffer, smooth=smooth, city_model=city_model, city_map=city_map, city_outline=city_outline, search=search, coarse_stepsize=coarse_stepsize, tolerance=tolerance, candidates=candidates, histogram_seed=histogram_seed, scoring=scoring, seed=seed, adaptive=adaptive, min_N=min_N, height_tolerance=height_tolerance, bootstraps=bootstraps, triage=triage, workers=workers, result_store=result_store, sinks=sinks, profile=profile, profile_folder=profile_folder, prefetch=prefetch, output_format=output_format):
+        if result:
+            results[id] = result
+
+    # Include the rows of an earlier, interrupted, run
+    if result_store:
+        with ResultStore(result_store, RESULT_COLUMNS) if isinstance(result_store, str) else nullcontext(result_store) as store:
+            results = store.rows(idx)
+    else:
+        results = [results[id] for id in idx if id in results]
 
-    results_summary = pd.DataFrame(results, columns = ['id', 'bag_ann_score', 'intersected_ann_score', 'improvement', 'intersected_facets', 'intersected_triangles', 'height', 'time']).set_index('id')
-    return results_summary
\ No newline at end of file
+    results_summary = pd.DataFrame(results, columns=RESULT_COLUMNS).set_index('id')
+    return results_summary
@@ -1,14 +1,14 @@
 import requests
-import urllib.request, json 
+import urllib.request, urllib.parse, json 
 from cjio import cityjson
 
-from requests.adapters import HTTPAdapter
-from requests.packages.urllib3.util.retry import Retry
-
+from functools import lru_cache
 from concurrent.futures import ThreadPoolExecutor, as_completed
 import os.path
 # from os import path
 
+from src.scrapers.downloader import Downloader, DownloadError
+from src.scrapers.wfs_cache import resolve_cache
 from src.utils.pointclouds import get_bbox_from_tile_codes
 
 max_jobs = 10
@@ -21,36 +21,71 @@ local_filename = "{}_{}_bbox_{}_{}_{}_{}.json"
 local_path = "C:/Users/boble/Documents/AI-year2/Thesis/data/"
 
 
-def download_tile(url, file_name):
+@lru_cache(maxsize=None)
+def get_downloader():
+    """Downloader shared by all tile downloads of this process, one connection pool of max_jobs connections"""
+    return Downloader(max_concurrent=max_jobs)
+
+
+def download_tile(url, file_name, downloader=None, size=None, checksum=None):
+    """Streams a tile to disk, resuming a partial download
+
+    Args:
+        url (str): Tile url
+        file_name (str): Destination path
+        downloader (Downloader, optional): Defaults to None, the shared downloader.
+        size (int, optional): Expected size in bytes. Defaults to None, the size the server reports.
+        checksum (str, optional): Expected sha256 of the tile. Defaults to None.
+
+    Returns:
+        str or Exception: status line, or the exception of a failed download
+    """
     try:
         #skip stuff we already downloaded
         if skip_existing and os.path.isfile(file_name):
             return "- " + file_name
-            
-        #download the download URL, with a delay and retry for when we get blocked
-        session = requests.Session()
-        retry = Retry(connect=3, backoff_factor=1.0)
-        adapter = HTTPAdapter(max_retries=retry)
-        session.mount('http://', adapter)
-        session.mount('https://', adapter)
-        downloaded_obj = session.get(url, stream=True)
-        
-        #if downloaded data has enough content
-        if len(downloaded_obj.content) > 15:
-            open(file_name, 'wb').write(downloaded_obj.content)
-            return "+ " + file_name
-            
-        return "Not CityJSON: " + url
-        #return downloaded_obj.status_code
-    except requests.exceptions.RequestException as exception:
+
+        downloader = downloader if downloader is not None else get_downloader()
+        downloader.download(url, file_name, size=size, checksum=checksum)
+        return "+ " + file_name
+    except (requests.exceptions.RequestException, DownloadError) as exception:
        return exception
 
 
-def parse_wfs_json(wfs_url):
-    """_summary_
+def fetch_wfs_tiles(wfs_url):
+    """Tiles of a 3DBAG tile index WFS request
+
+    Args:
+        wfs_url (str): url to the containing bounding box
+
+    Returns:
+        list of (str, int, list of float): tile id, building count and bbox per tile
+    """
+    with urllib.request.urlopen(wfs_url) as url:
+        print(wfs_url)
+        data = json.loads(url.read().decode())
+    print("Found features:" + str(data["totalFeatures"]))
+    return [(feature["properties"]["tile_id"], feature["properties"]["cnt"], feature["bbox"]) for feature in data["features"]]
+
+
+def get_wfs_tiles(wfs_url, cache=None):
+    """fetch_wfs_tiles, cached by endpoint, type name, bbox, srs and version_substring"""
+    cache = resolve_cache(cache)
+    if cache is None:
+        return fetch_wfs_tiles(wfs_url)
+
+    endpoint, query = wfs_url.split('?', 1)
+    params = {key.lower(): value for key, value in urllib.parse.parse_qsl(query)}
+    bbox = [float(value) for value in params['bbox'].split(',')[:4]] if 'bbox' in params else None
+    return cache.fetch(lambda: fetch_wfs_tiles(wfs_url), endpoint, params.get('typename'), bbox, params.get('srsname'), version_substring)
+
+
+def parse_wfs_json(wfs_url, cache=None):
+    """Download the 3DBAG tiles of a tile index WFS request
 
     Args:
         wfs_url (str): url to the containing bounding box
+        cache (WFSCache or False, optional): Cache of the tile index response. Defaults to None, the default cache. False disables it.
 
     Returns:
         list of str: containing all filepaths
@@ -65,41 +100,33 @@ def parse_wfs_json(wfs_url):
             if exc.errno != errno.EEXIST:
                 raise  
 
-    with urllib.request.urlopen(wfs_url) as url:
-        print(wfs_url)
-        data = json.loads(url.read().decode())
-        
-        #Now do the downloads in multiple threads for speeeed
-        threads = []
-        with ThreadPoolExecutor(max_workers=max_jobs) as executor:
-            print("Starting threads")
-            print("Found features:" + str(data["totalFeatures"])) 
-            for feature in data["features"]:   
-                tile_id = feature["properties"]["tile_id"]
-                cnt = feature["properties"]["cnt"]
-                bbox_minx = feature["bbox"][0]
-                bbox_miny = feature["bbox"][1]
-                bbox_maxx = feature["bbox"][2]
-                bbox_maxy = feature["bbox"][3]
-                
-                download_url = download_path.format(version_substring,version_substring,tile_id)
-                print(feature["properties"]["tile_id"] + " -> " + download_url)
-
-                filepath = local_path + local_filename.format(tile_id,cnt,bbox_minx,bbox_miny,bbox_maxx,bbox_maxy)
-                threads.append(executor.submit(download_tile, download_path.format(version_substring,version_substring,tile_id), filepath))
-                filepaths.append(filepath)
-            for task in as_completed(threads):
-                print(task.result())  
+    tiles = get_wfs_tiles(wfs_url, cache=cache)
+
+    #Now do the downloads in multiple threads for speeeed
+    threads = []
+    with ThreadPoolExecutor(max_workers=max_jobs) as executor:
+        print("Starting threads")
+        for tile_id, cnt, (bbox_minx, bbox_miny, bbox_maxx, bbox_maxy) in tiles:
+            download_url = download_path.format(version_substring,version_substring,tile_id)
+            print(tile_id + " -> " + download_url)
+
+            filepath = local_path + local_filename.format(tile_id,cnt,bbox_minx,bbox_miny,bbox_maxx,bbox_maxy)
+            threads.append(executor.submit(download_tile, download_url, filepath))
+            filepaths.append(filepath)
+        for task in as_completed(threads):
+            print(task.result())  
     return filepaths
 
 
-def get_bag3d_as_json(tile_codes, padding=0.0):
-    """
+def get_bag3d_tile_files(tile_codes, padding=0.0, cache=None):
+    """Download the 3DBAG tiles that cover the tile codes
+
     Args:
         tile_codes (list of str): The tile codes, e.g. [2386_9702, 2446_9521].
         padding (float, optional): Add padding to bounding box. Defaults to 0.0.
+        cache (WFSCache or False, optional): Cache of the tile index response. Defaults to None, the default cache. False disables it.
     Returns:
-        cjio
+        list of str: tile files, e.g. for src.utils.tile_index.TileIndex
     """
 
     (bbox_min_x, bbox_max_y), (bbox_max_x, bbox_min_y) = get_bbox_from_tile_codes(tile_codes, padding=padding)
@@ -107,7 +134,24 @@ def get_bag3d_as_json(tile_codes, padding=0.0):
     wfs_url = f"https://data.3dbag.nl/api/BAG3D_v2/wfs?version=1.1.0&request=GetFeature&typename=BAG3d_v2:bag_tiles_3k&outputFormat=application/json&srsname=EPSG:28992&bbox={bbox_min_x},{bbox_min_y},{bbox_max_x},{bbox_max_y},EPSG:28992"
 
     # Download the files and save locally
-    parsed_filedirs = parse_wfs_json(wfs_url)
+    return parse_wfs_json(wfs_url, cache=cache)
+
+
+def get_bag3d_as_json(tile_codes, padding=0.0, cache=None):
+    """Merge all 3DBAG tiles that cover the tile codes in one city model.
+
+    Holds the whole area in memory, TileIndex(get_bag3d_tile_files(tile_codes)) only loads
+    the tiles of the requested buildings.
+
+    Args:
+        tile_codes (list of str): The tile codes, e.g. [2386_9702, 2446_9521].
+        padding (float, optional): Add padding to bounding box. Defaults to 0.0.
+        cache (WFSCache or False, optional): Cache of the tile index response. Defaults to None, the default cache. False disables it.
+    Returns:
+        cjio
+    """
+
+    parsed_filedirs = get_bag3d_tile_files(tile_codes, padding=padding, cache=cache)
 
     # Load the files and merge
     city_model = cityjson.load(parsed_filedirs[0])
@@ -1,31 +1,50 @@
 import json
 from owslib.wfs import WebFeatureService
 
+from src.scrapers.wfs_cache import resolve_cache
 from src.utils.pointclouds import get_bbox_from_tile_codes
 
 WFS_URL = "https://data.3dbag.nl/api/BAG3D_v2/wfs"
 WFS_LAYER = "BAG3D_v2:lod12"
+WFS_SRS = "urn:x-ogc:def:crs:EPSG:28992"
+DATA_VERSION = "BAG3D_v2"
 
 
-def get_bag_by_tile_codes(tile_codes, padding=5):
+def get_bag_by_tile_codes(tile_codes, padding=5, cache=None):
     """
     Args:
         tile_codes (list of str): The tile codes, e.g. [2386_9702, 2446_9521].
         padding (float, optional): Add padding to bounding box. Defaults to 0.0.
+        cache (WFSCache or False, optional): Cache of the parsed response. Defaults to None, the default cache. False disables it.
     Returns:
         dict: containing an outline per id
     """
 
-    parsed_content = {}
-
     (xmin, ymax), (xmax, ymin) = get_bbox_from_tile_codes(tile_codes, padding)
+    bbox = [xmin, ymin, xmax, ymax]
+
+    cache = resolve_cache(cache)
+    if cache is None:
+        return fetch_bag(bbox)
+    return cache.fetch(lambda: fetch_bag(bbox), WFS_URL, WFS_LAYER, bbox, WFS_SRS, DATA_VERSION)
+
+
+def fetch_bag(bbox):
+    """
+    Args:
+        bbox (list of float): xmin, ymin, xmax, ymax
+    Returns:
+        dict: containing an outline per id
+    """
+
+    parsed_content = {}
 
     wfs = WebFeatureService(url=WFS_URL, version='1.1.0')
 
     response = wfs.getfeature(
         typename=WFS_LAYER,
-        bbox=[xmin, ymin, xmax, ymax],
-        srsname='urn:x-ogc:def:crs:EPSG:28992',
+        bbox=bbox,
+        srsname=WFS_SRS,
         outputFormat='json'
     )
 
@@ -1,7 +1,14 @@
 from re import L
 import requests
+from src.scrapers.wfs_cache import resolve_cache
 from src.utils.pointclouds import get_bbox_from_tile_codes
 
+WFS_URL = 'https://map.data.amsterdam.nl/maps/bgtobjecten?'
+WFS_LAYER = 'BGT_PND_pand'
+WFS_SRS = 'EPSG:28992'
+# Part of the cache key, the service has no dataset version so the default cache expires its entries
+DATA_VERSION = 'bgtobjecten'
+
 
 def scrape_amsterdam_bgt(layer_name, bbox=None):
     """
@@ -23,8 +30,6 @@ def scrape_amsterdam_bgt(layer_name, bbox=None):
              'TYPENAME=' \
              + layer_name + '&'
 
-    WFS_URL = 'https://map.data.amsterdam.nl/maps/bgtobjecten?'
-
     if bbox is not None:
         bbox_string = str(bbox[0][0]) + ',' + str(bbox[0][1]) + ',' \
                       + str(bbox[1][0]) + ',' + str(bbox[1][1])
@@ -73,23 +78,36 @@ def parse_polygons(json_response, include_bbox=True):
 #     return bgt_floorplans[id]['floorplan']
 
 
-def get_bgt_by_tile_codes(tile_codes, padding=0.0):
+def get_bgt_by_tile_codes(tile_codes, padding=0.0, cache=None):
     """
     Args:
         tile_codes (list of str): The tile codes, e.g. [2386_9702, 2446_9521].
         padding (float, optional): Add padding to bounding box. Defaults to 0.0.
+        cache (WFSCache or False, optional): Cache of the parsed response. Defaults to None, the default cache. False disables it.
     Returns:
         dict: containing an floorplan per id
     """
 
-    parsed_content = {}
-
     # Specify the bounding box we want to work with
     tile_bbox = get_bbox_from_tile_codes(tile_codes, padding=padding)
-    parsed_content['tile_bbox'] = tile_bbox
+
+    cache = resolve_cache(cache)
+    if cache is None:
+        return fetch_bgt(tile_bbox)
+    bbox = [tile_bbox[0][0], tile_bbox[0][1], tile_bbox[1][0], tile_bbox[1][1]]
+    return cache.fetch(lambda: fetch_bgt(tile_bbox), WFS_URL, WFS_LAYER, bbox, WFS_SRS, DATA_VERSION)
+
+
+def fetch_bgt(tile_bbox):
+    """
+    Args:
+        tile_bbox (((float, float), (float, float))): bounding box as from get_bbox_from_tile_codes
+    Returns:
+        dict: containing an floorplan per id
+    """
 
     # Scrape data from the Amsterdam WFS, this will return a json response.
-    json_response = scrape_amsterdam_bgt('BGT_PND_pand', bbox=tile_bbox)
+    json_response = scrape_amsterdam_bgt(WFS_LAYER, bbox=tile_bbox)
 
     # Parse the downloaded json response.
     parsed_content = parse_polygons(json_response)
@@ -0,0 +1,129 @@
+import os
+import hashlib
+import threading
+import requests
+
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+class DownloadError(Exception):
+    pass
+
+
+class Downloader:
+    """Downloads files over one shared, pooled HTTP session.
+
+    Every download streams to `{file_name}.part` and is renamed to `file_name` only after
+    its size, and optionally its checksum, is verified. A `.part` file left behind by an
+    interrupted download is resumed with an HTTP range request. At most `max_concurrent`
+    downloads run at the same time, also when the downloader is shared by many threads.
+    """
+
+    def __init__(self, max_concurrent=10, retries=3, backoff_factor=1.0, chunk_size=2 ** 20, timeout=60, session=None):
+        """
+        Args:
+            max_concurrent (int, optional): Maximum number of simultaneous downloads. Defaults to 10.
+            retries (int, optional): Attempts per download after the first, an interrupted or short download resumes where it stopped. Defaults to 3.
+            backoff_factor (float, optional): Backoff of the connection retries. Defaults to 1.0.
+            chunk_size (int, optional): Bytes written per chunk. Defaults to 1 MB.
+            timeout (float, optional): Connect and read timeout in seconds. Defaults to 60.
+            session (requests.Session, optional): Session to use instead of a new pooled one. Defaults to None.
+        """
+        if session is None:
+            session = requests.Session()
+            retry = Retry(connect=retries, read=retries, status=retries, backoff_factor=backoff_factor, status_forcelist=[429, 500, 502, 503, 504])
+            adapter = HTTPAdapter(pool_connections=max_concurrent, pool_maxsize=max_concurrent, max_retries=retry)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+
+        self.session = session
+        self.retries = retries
+        self.chunk_size = chunk_size
+        self.timeout = timeout
+        self.slots = threading.BoundedSemaphore(max_concurrent)
+
+    def download(self, url, file_name, size=None, checksum=None, algorithm='sha256'):
+        """Download a file, resuming a partial download
+
+        Args:
+            url (str): File url
+            file_name (str): Destination path
+            size (int, optional): Expected size in bytes. Defaults to None, the size the server reports.
+            checksum (str, optional): Expected hex digest of the file. Defaults to None, no checksum.
+            algorithm (str, optional): hashlib algorithm of the checksum. Defaults to 'sha256'.
+
+        Raises:
+            DownloadError: when the file of the last attempt does not match its size or checksum
+            requests.exceptions.RequestException: when the last attempt fails
+
+        Returns:
+            str: file_name
+        """
+        with self.slots:
+            for attempt in range(self.retries + 1):
+                try:
+                    return self._download(url, file_name, size, checksum, algorithm)
+                except (DownloadError, requests.exceptions.ChunkedEncodingError, requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                    if attempt == self.retries:
+                        raise
+
+    def _download(self, url, file_name, size, checksum, algorithm):
+        part_name = file_name + '.part'
+        offset = os.path.getsize(part_name) if os.path.isfile(part_name) else 0
+
+        headers = {'Range': f'bytes={offset}-'} if offset else {}
+        with self.session.get(url, headers=headers, stream=True, timeout=self.timeout) as response:
+            # The part file holds the whole file already, or more than the server has
+            if response.status_code == 416:
+                os.remove(part_name)
+                return self._download(url, file_name, size, checksum, algorithm)
+            response.raise_for_status()
+
+            # Servers that ignore the range send the whole file again
+            if response.status_code != 206:
+                offset = 0
+
+            total = size
+            if total is None and 'Content-Range' in response.headers:
+                total = int(response.headers['Content-Range'].rsplit('/', 1)[-1])
+            elif total is None and 'Content-Length' in response.headers and 'Content-Encoding' not in response.headers:
+                total = offset + int(response.headers['Content-Length'])
+
+            with open(part_name, 'ab' if offset else 'wb') as f:
+                for chunk in response.iter_content(chunk_size=self.chunk_size):
+                    f.write(chunk)
+
+        actual = os.path.getsize(part_name)
+        if total is not None and actual != total:
+            # Too short can be resumed, too long cannot
+            if actual > total:
+                os.remove(part_name)
+            raise DownloadError(f'{url}: expected {total} bytes, got {actual}')
+
+        if checksum is not None:
+            digest = file_digest(part_name, algorithm)
+            if digest != checksum.lower():
+                os.remove(part_name)
+                raise DownloadError(f'{url}: expected {algorithm} {checksum}, got {digest}')
+
+        os.replace(part_name, file_name)
+        return file_name
+
+    def close(self):
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def file_digest(file_name, algorithm='sha256', chunk_size=2 ** 20):
+    """Hex digest of a file, read in chunks"""
+    digest = hashlib.new(algorithm)
+    with open(file_name, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
@@ -0,0 +1,164 @@
+import os
+import json
+import time
+import zlib
+import pickle
+import hashlib
+
+from functools import lru_cache
+
+CACHE_ROOT = os.path.join(os.path.expanduser('~'), '.cache', '3dbag_bgt_intersect', 'wfs')
+
+# Lifetime of the entries of the default cache in seconds, BGT and BAG change without a new data version
+DEFAULT_TTL = 7 * 24 * 3600
+
+# Age in seconds after which a temporary file is left over from an interrupted put
+STALE_TEMP_AGE = 3600
+
+
+class OfflineCacheMiss(LookupError):
+    pass
+
+
+class WFSCache:
+    """Persistent, content-addressed cache of parsed WFS responses.
+
+    An entry is keyed by the sha256 of its endpoint, layer, bounding box, srs and data
+    version and is stored as a zlib-compressed pickle in `{root}/{key[:2]}/{key}.bin`.
+    Entries older than `ttl` are fetched again, and the least recently used entries are
+    removed when the cache grows beyond `max_size`. An offline cache never fetches: it
+    serves every entry it has, also expired ones, and raises OfflineCacheMiss otherwise.
+    """
+
+    def __init__(self, root=CACHE_ROOT, ttl=None, max_size=None, offline=False):
+        """
+        Args:
+            root (str, optional): Cache folder. Defaults to CACHE_ROOT.
+            ttl (float, optional): Lifetime of an entry in seconds. Defaults to None, forever.
+            max_size (int, optional): Maximum size of the cache in bytes. Defaults to None, unbounded.
+            offline (bool, optional): Never query the WFS. Defaults to False.
+        """
+        self.root = root
+        self.ttl = ttl
+        self.max_size = max_size
+        self.offline = offline
+
+    @staticmethod
+    def key(endpoint, layer, bbox, srs, version):
+        """Hex sha256 of the request"""
+        request = [endpoint, layer, [round(float(value), 6) for value in bbox] if bbox is not None else None, srs, version]
+        return hashlib.sha256(json.dumps(request).encode()).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.root, key[:2], key + '.bin')
+
+    def get(self, key):
+        """Cached value, None when it is missing or expired"""
+        try:
+            with open(self.path(key), 'rb') as f:
+                created, value = pickle.loads(zlib.decompress(f.read()))
+        except (OSError, EOFError, zlib.error, pickle.UnpicklingError):
+            return None
+
+        if self.ttl is not None and not self.offline and time.time() - created > self.ttl:
+            return None
+
+        # The modification time is the last use, for the eviction
+        os.utime(self.path(key))
+        return value
+
+    def put(self, key, value):
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        temp_path = f'{path}.{os.getpid()}.tmp'
+        with open(temp_path, 'wb') as f:
+            f.write(zlib.compress(pickle.dumps((time.time(), value), protocol=pickle.HIGHEST_PROTOCOL)))
+        os.replace(temp_path, path)
+
+        if self.max_size is not None:
+            self.evict(self.max_size)
+
+    def fetch(self, fetch, endpoint, layer, bbox, srs, version):
+        """Cached result of a WFS request, fetch() is only called on a miss
+
+        Args:
+            fetch (callable): Queries the WFS and returns the parsed result
+            endpoint (str): WFS url
+            layer (str): Layer or type name
+            bbox (list of float): Bounding box of the request
+            srs (str): Spatial reference system of the request
+            version (str): Version of the data
+
+        Raises:
+            OfflineCacheMiss: when an offline cache does not have the request
+
+        Returns:
+            the parsed result
+        """
+        key = self.key(endpoint, layer, bbox, srs, version)
+        value = self.get(key)
+        if value is not None:
+            return value
+
+        if self.offline:
+            raise OfflineCacheMiss(f'{layer} {bbox} of {endpoint} is not cached')
+
+        value = fetch()
+        if value is not None:
+            self.put(key, value)
+        return value
+
+    def entries(self):
+        """(path, size, last use) of every entry, temporary files of interrupted puts included so they are evicted first"""
+        entries = []
+        if not os.path.isdir(self.root):
+            return entries
+
+        now = time.time()
+        for folder in os.listdir(self.root):
+            if not os.path.isdir(os.path.join(self.root, folder)):
+                continue
+            for file_name in os.listdir(os.path.join(self.root, folder)):
+                path = os.path.join(self.root, folder, file_name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                if file_name.endswith('.bin'):
+                    entries.append((path, stat.st_size, stat.st_mtime))
+                elif file_name.endswith('.tmp') and now - stat.st_mtime > STALE_TEMP_AGE:
+                    entries.append((path, stat.st_size, 0.0))
+        return entries
+
+    def size(self):
+        return sum([size for _, size, _ in self.entries()])
+
+    def evict(self, max_size):
+        """Remove the least recently used entries until the cache is at most max_size bytes"""
+        entries = sorted(self.entries(), key=lambda entry: entry[2])
+        total = sum([size for _, size, _ in entries])
+        for path, size, _ in entries:
+            if total <= max_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def clear(self):
+        self.evict(0)
+
+
+@lru_cache(maxsize=None)
+def get_default_cache():
+    """Cache used by the scrapers when none is given, entries expire after WFS_CACHE_TTL seconds (DEFAULT_TTL), offline when WFS_CACHE_OFFLINE=1"""
+    return WFSCache(os.environ.get('WFS_CACHE_ROOT', CACHE_ROOT), ttl=float(os.environ.get('WFS_CACHE_TTL', DEFAULT_TTL)), offline=os.environ.get('WFS_CACHE_OFFLINE') == '1')
+
+
+def resolve_cache(cache):
+    """The default cache for None, no cache for False"""
+    if cache is None:
+        return get_default_cache()
+    return cache or None
@@ -0,0 +1,220 @@
+import numba
+import numpy as np
+
+from numba import njit
+
+
+@njit
+def _segment_distance2(px, py, pz, ax, ay, az, bx, by, bz):
+    abx, aby, abz = bx - ax, by - ay, bz - az
+    length2 = abx * abx + aby * aby + abz * abz
+    t = 0.0
+    if length2 > 0:
+        t = min(max(((px - ax) * abx + (py - ay) * aby + (pz - az) * abz) / length2, 0.0), 1.0)
+    dx, dy, dz = px - (ax + t * abx), py - (ay + t * aby), pz - (az + t * abz)
+    return dx * dx + dy * dy + dz * dz
+
+
+@njit
+def _triangle_distance2(px, py, pz, ax, ay, az, bx, by, bz, cx, cy, cz):
+    """Squared distance from a point to a triangle, closest point by Voronoi regions"""
+    abx, aby, abz = bx - ax, by - ay, bz - az
+    acx, acy, acz = cx - ax, cy - ay, cz - az
+    apx, apy, apz = px - ax, py - ay, pz - az
+
+    d1 = abx * apx + aby * apy + abz * apz
+    d2 = acx * apx + acy * apy + acz * apz
+    if d1 <= 0 and d2 <= 0:
+        return apx * apx + apy * apy + apz * apz
+
+    bpx, bpy, bpz = px - bx, py - by, pz - bz
+    d3 = abx * bpx + aby * bpy + abz * bpz
+    d4 = acx * bpx + acy * bpy + acz * bpz
+    if d3 >= 0 and d4 <= d3:
+        return bpx * bpx + bpy * bpy + bpz * bpz
+
+    cpx, cpy, cpz = px - cx, py - cy, pz - cz
+    d5 = abx * cpx + aby * cpy + abz * cpz
+    d6 = acx * cpx + acy * cpy + acz * cpz
+    if d6 >= 0 and d5 <= d6:
+        return cpx * cpx + cpy * cpy + cpz * cpz
+
+    vc = d1 * d4 - d3 * d2
+    if vc <= 0 and d1 >= 0 and d3 <= 0:
+        return _segment_distance2(px, py, pz, ax, ay, az, bx, by, bz)
+
+    vb = d5 * d2 - d1 * d6
+    if vb <= 0 and d2 >= 0 and d6 <= 0:
+        return _segment_distance2(px, py, pz, ax, ay, az, cx, cy, cz)
+
+    va = d3 * d6 - d5 * d4
+    if va <= 0 and (d4 - d3) >= 0 and (d5 - d6) >= 0:
+        return _segment_distance2(px, py, pz, bx, by, bz, cx, cy, cz)
+
+    # Degenerate triangles have no interior
+    if va + vb + vc <= 0:
+        return min(_segment_distance2(px, py, pz, ax, ay, az, bx, by, bz),
+                   _segment_distance2(px, py, pz, bx, by, bz, cx, cy, cz),
+                   _segment_distance2(px, py, pz, cx, cy, cz, ax, ay, az))
+
+    v = vb / (va + vb + vc)
+    w = vc / (va + vb + vc)
+    dx = px - (ax + abx * v + acx * w)
+    dy = py - (ay + aby * v + acy * w)
+    dz = pz - (az + abz * v + acz * w)
+    return dx * dx + dy * dy + dz * dz
+
+
+@njit
+def _clipped_triangle_distance2(px, py, pz, triangle, height, polygon):
+    """Squared distance from a point to the part of a triangle at or above a height"""
+    if triangle[0,2] >= height and triangle[1,2] >= height and triangle[2,2] >= height:
+        return _triangle_distance2(px, py, pz, triangle[0,0], triangle[0,1], triangle[0,2], triangle[1,0], triangle[1,1], triangle[1,2], triangle[2,0], triangle[2,1], triangle[2,2])
+
+    # Clip against the plane, the result has at most four vertices
+    n = 0
+    for i in range(3):
+        j = (i + 1) % 3
+        inside_i, inside_j = triangle[i,2] >= height, triangle[j,2] >= height
+        if inside_i:
+            polygon[n,:] = triangle[i,:]
+            n += 1
+        if inside_i != inside_j:
+            t = (height - triangle[i,2]) / (triangle[j,2] - triangle[i,2])
+            for k in range(3):
+                polygon[n,k] = triangle[i,k] + t * (triangle[j,k] - triangle[i,k])
+            n += 1
+
+    best = np.inf
+    for k in range(1, n - 1):
+        best = min(best, _triangle_distance2(px, py, pz, polygon[0,0], polygon[0,1], polygon[0,2], polygon[k,0], polygon[k,1], polygon[k,2], polygon[k + 1,0], polygon[k + 1,1], polygon[k + 1,2]))
+    return best
+
+
+@njit(parallel=True)
+def _clipped_distances(points, heights, order, upper_bounds, node_min, node_max, node_children, node_start, node_count, triangles):
+    distances = np.empty((points.shape[0], heights.shape[0]))
+
+    for i in numba.prange(points.shape[0]):
+        px, py, pz = points[i,0], points[i,1], points[i,2]
+        stack = np.empty(128, dtype=np.int64)
+        polygon = np.empty((4, 3))
+        previous = np.inf
+
+        # A lower height keeps more of the mesh, so the mesh distance at the height above bounds it
+        for j in order:
+            height = heights[j]
+            bound = upper_bounds[i,j] * upper_bounds[i,j]
+            nearest = previous
+            best = min(bound, nearest)
+
+            stack[0] = 0
+            top = 1
+            while top > 0:
+                top -= 1
+                node = stack[top]
+                if node_max[node,2] < height:
+                    continue
+
+                # Only the part of the box at or above the height can hold clipped triangles
+                dx = max(node_min[node,0] - px, 0.0, px - node_max[node,0])
+                dy = max(node_min[node,1] - py, 0.0, py - node_max[node,1])
+                dz = max(max(node_min[node,2], height) - pz, 0.0, pz - node_max[node,2])
+                if dx * dx + dy * dy + dz * dz >= best:
+                    continue
+
+                if node_count[node] > 0:
+                    for t in range(node_start[node], node_start[node] + node_count[node]):
+                        distance = _clipped_triangle_distance2(px, py, pz, triangles[t], height, polygon)
+                        if distance < nearest:
+                            nearest = distance
+                            best = min(best, distance)
+                else:
+                    stack[top] = node_children[node,1]
+                    stack[top + 1] = node_children[node,0]
+                    top += 2
+
+            distances[i,j] = np.sqrt(best)
+            previous = nearest
+    return distances
+
+
+class TriangleBVH:
+    """Bounding volume hierarchy over the triangles of a mesh for exact point-to-mesh distances.
+
+    The hierarchy is built once. Queries can clip the mesh to the part at or above a height
+    without rebuilding, because the bounding boxes are clipped on the fly.
+    """
+
+    def __init__(self, vertices, faces, leaf_size=4):
+        """
+        Args:
+            vertices (np.array(V,3)): Mesh vertices
+            faces (np.array(F,3)): Mesh triangles
+            leaf_size (int, optional): Maximum number of triangles per leaf. Defaults to 4.
+        """
+        triangles = np.asarray(vertices, dtype=np.float64)[np.asarray(faces, dtype=np.int64).reshape(-1, 3)]
+        centroids = triangles.mean(axis=1)
+        triangle_min, triangle_max = triangles.min(axis=1), triangles.max(axis=1)
+
+        order = np.arange(triangles.shape[0])
+        node_min, node_max, node_children, node_start, node_count = [], [], [], [], []
+
+        # Median split along the longest centroid extent
+        stack = [(0, triangles.shape[0], -1, 0)]
+        while stack:
+            start, end, parent, side = stack.pop()
+            node = len(node_min)
+            if parent >= 0:
+                node_children[parent][side] = node
+
+            members = order[start:end]
+            node_min.append(triangle_min[members].min(axis=0) if end > start else np.full(3, np.inf))
+            node_max.append(triangle_max[members].max(axis=0) if end > start else np.full(3, -np.inf))
+            node_children.append([-1, -1])
+
+            if end - start <= leaf_size:
+                node_start.append(start)
+                node_count.append(end - start)
+                continue
+
+            axis = np.ptp(centroids[members], axis=0).argmax()
+            middle = (end - start) // 2
+            order[start:end] = members[np.argpartition(centroids[members,axis], middle)]
+            node_start.append(start)
+            node_count.append(0)
+            stack.append((start + middle, end, node, 1))
+            stack.append((start, start + middle, node, 0))
+
+        self.triangles = np.ascontiguousarray(triangles[order])
+        self.node_min = np.array(node_min).reshape(-1, 3)
+        self.node_max = np.array(node_max).reshape(-1, 3)
+        self.node_children = np.array(node_children, dtype=np.int64).reshape(-1, 2)
+        self.node_start = np.array(node_start, dtype=np.int64)
+        self.node_count = np.array(node_count, dtype=np.int64)
+
+    def distances(self, points, heights=None, upper_bounds=None):
+        """Exact distances from points to the mesh, clipped to the part at or above every height
+
+        Args:
+            points (np.array(N,3)): Query points
+            heights (np.array(M,), optional): Clipping heights. Defaults to None, no clipping.
+            upper_bounds (np.array(N,M), optional): Known distances to other geometry, the result is the minimum with them. Defaults to None.
+
+        Returns:
+            np.array(N,M), or np.array(N,) without heights
+        """
+        points = np.ascontiguousarray(points, dtype=np.float64).reshape(-1, 3)
+        clip = heights is not None
+        heights = np.atleast_1d(np.asarray(heights if clip else -np.inf, dtype=np.float64))
+
+        if upper_bounds is None:
+            upper_bounds = np.full((points.shape[0], heights.shape[0]), np.inf)
+        upper_bounds = np.ascontiguousarray(np.broadcast_to(upper_bounds, (points.shape[0], heights.shape[0])), dtype=np.float64)
+
+        if self.triangles.shape[0] == 0:
+            distances = upper_bounds.copy()
+        else:
+            order = np.argsort(heights, kind='stable')[::-1].copy()
+            distances = _clipped_distances(points, heights, order, upper_bounds, self.node_min, self.node_max, self.node_children, self.node_start, self.node_count, self.triangles)
+        return distances if clip else distances[:,0]
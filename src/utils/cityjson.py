@@ -6,6 +6,8 @@ from vedo.shapes import Mesh
 from vedo import merge
 
 from cjio.models import Geometry
+from numba import njit
+from shapely.geometry import Polygon
 
 
 def to_vedo_surface(surfaces):
@@ -50,6 +52,285 @@ def geometry_part_to_vedo_mesh(city_object, triangulate=False, lod=2.2):
     return None, None, None
 
 
+# Mesh order of the converters, the index doubles as the mesh label
+SURFACE_TYPES = ('GroundSurface', 'WallSurface', 'RoofSurface')
+
+
+@njit
+def _ear_clip(points):
+    """Ear clipping of a simple, counter-clockwise 2D polygon
+
+    Returns:
+        np.array(N-2,3): triangles as indices into points
+    """
+    n = points.shape[0]
+    idx = np.arange(n)
+    triangles = np.empty((max(n - 2, 0), 3), dtype=np.int64)
+    t = 0
+
+    while n > 3:
+        found = False
+        for k in range(n):
+            a, b, c = idx[(k - 1) % n], idx[k], idx[(k + 1) % n]
+            ax, ay = points[a]
+            bx, by = points[b]
+            cx, cy = points[c]
+
+            # Skip reflex and collinear corners
+            if (bx - ax) * (cy - by) - (by - ay) * (cx - bx) <= 0:
+                continue
+
+            # An ear contains none of the other vertices
+            ear = True
+            for m in range(n):
+                p = idx[m]
+                if p == a or p == b or p == c:
+                    continue
+                px, py = points[p]
+                d0 = (bx - ax) * (py - ay) - (by - ay) * (px - ax)
+                d1 = (cx - bx) * (py - by) - (cy - by) * (px - bx)
+                d2 = (ax - cx) * (py - cy) - (ay - cy) * (px - cx)
+                if d0 >= 0 and d1 >= 0 and d2 >= 0:
+                    ear = False
+                    break
+
+            if ear:
+                triangles[t] = (a, b, c)
+                t += 1
+                idx = np.concatenate((idx[:k], idx[k + 1:]))
+                n -= 1
+                found = True
+                break
+
+        # Degenerate polygon, fan the rest
+        if not found:
+            break
+
+    for k in range(1, n - 1):
+        triangles[t] = (idx[0], idx[k], idx[k + 1])
+        t += 1
+    return triangles[:t]
+
+
+def get_polygon_normals(points):
+    """Newell normals of a batch of polygons with the same number of vertices (M,N,3)"""
+    following = np.roll(points, -1, axis=1)
+    return np.cross(points, following).sum(axis=1)
+
+
+def project_polygon(points, normal):
+    """Drop the dominant axis of the normal, keeping the polygon orientation counter-clockwise
+
+    Returns:
+        np.array(N,2): projected points, int: dropped axis, list of int: kept axes
+    """
+    axis = np.abs(normal).argmax()
+    # The cyclic successors of the dropped axis form a right-handed pair, e.g. (z, x) for y
+    keep = [(axis + 1) % 3, (axis + 2) % 3]
+    if normal[axis] < 0:
+        keep = keep[::-1]
+    return points[:,keep], axis, keep
+
+
+def polygon_area(points):
+    """Signed shoelace area of a 2D polygon, positive when counter-clockwise"""
+    x, y = points[:,0], points[:,1]
+    return 0.5 * (x @ np.roll(y, -1) - y @ np.roll(x, -1))
+
+
+def triangles_area(points, triangles):
+    """Total signed area of 2D triangles"""
+    a, b, c = points[triangles[:,0]], points[triangles[:,1]], points[triangles[:,2]]
+    return 0.5 * np.sum((b[:,0] - a[:,0]) * (c[:,1] - a[:,1]) - (b[:,1] - a[:,1]) * (c[:,0] - a[:,0]))
+
+
+def triangulate_polygons(vertices, polygons):
+    """Triangulate planar 3D polygons without VTK.
+
+    Convex polygons without holes are fanned in one vectorized step per vertex count. Other
+    single-ring polygons are ear clipped and polygons with holes go through
+    trimesh.creation.triangulate_polygon, as do ear clipped polygons whose triangles do not
+    cover the polygon area. The triangles keep the orientation of the rings.
+
+    Args:
+        vertices (np.array(V,3)): Vertex coordinates
+        polygons (list of list of list of int): Rings of vertex indices per polygon, the first ring is the exterior
+
+    Returns:
+        vertices (np.array(V',3)): The input vertices, followed by vertices added for holes
+        faces (np.array(F,3)): Triangles
+        face_polygons (np.array(F,)): Polygon index per triangle
+    """
+    vertices = np.asarray(vertices, dtype=np.float64)
+    faces, face_polygons = [np.zeros((0, 3), dtype=np.int64)], [np.zeros(0, dtype=np.int64)]
+    extra_vertices = []
+    num_vertices = vertices.shape[0]
+
+    # Group the single-ring polygons by vertex count
+    groups = {}
+    complex_polygons = []
+    for i, polygon in enumerate(polygons):
+        if len(polygon) == 1 and len(polygon[0]) >= 3:
+            groups.setdefault(len(polygon[0]), []).append(i)
+        elif len(polygon) > 1 and len(polygon[0]) >= 3:
+            complex_polygons.append(i)
+
+    for n, group in groups.items():
+        group = np.array(group)
+        rings = np.array([polygons[i][0] for i in group], dtype=np.int64)
+        points = vertices[rings]
+        normals = get_polygon_normals(points)
+
+        # Convex when every corner turns the same way as the polygon normal
+        edges = np.roll(points, -1, axis=1) - points
+        turns = np.einsum('mnk,mk->mn', np.cross(edges, np.roll(edges, -1, axis=1)), normals)
+        convex = (turns >= -1e-9 * np.abs(turns).max(initial=1.0)).all(axis=1)
+
+        fan = np.stack([np.zeros(n - 2, dtype=np.int64), np.arange(1, n - 1), np.arange(2, n)], axis=1)
+        faces.append(rings[convex][:,fan].reshape(-1, 3))
+        face_polygons.append(np.repeat(group[convex], n - 2))
+
+        for ring, normal, i in zip(rings[~convex], normals[~convex], group[~convex]):
+            projected = np.ascontiguousarray(project_polygon(vertices[ring], normal)[0])
+            triangles = _ear_clip(projected)
+
+            # Overlapping triangles of a failed ear clip cover more than the polygon
+            if not np.isclose(triangles_area(projected, triangles), polygon_area(projected), rtol=1e-6, atol=1e-9):
+                complex_polygons.append(i)
+                continue
+            faces.append(ring[triangles])
+            face_polygons.append(np.full(triangles.shape[0], i))
+
+    for i in complex_polygons:
+        rings = [np.asarray(ring, dtype=np.int64) for ring in polygons[i]]
+        normal = get_polygon_normals(vertices[rings[0]][None])[0]
+        projected = [project_polygon(vertices[ring], normal)[0] for ring in rings]
+        _, axis, keep = project_polygon(vertices[rings[0]], normal)
+
+        try:
+            points, triangles = trimesh.creation.triangulate_polygon(Polygon(projected[0], projected[1:]))
+        except Exception:
+            print('WARNING: triangulation of a polygon with holes failed')
+            continue
+
+        # Lift the 2D result back onto the plane of the polygon
+        lifted = np.zeros((points.shape[0], 3))
+        lifted[:,keep] = points
+        origin = vertices[rings[0][0]]
+        lifted[:,axis] = origin[axis] - ((lifted[:,keep] - origin[keep]) @ normal[keep]) / normal[axis]
+
+        extra_vertices.append(lifted)
+        faces.append(np.asarray(triangles, dtype=np.int64) + num_vertices)
+        face_polygons.append(np.full(len(triangles), i))
+        num_vertices += lifted.shape[0]
+
+    if extra_vertices:
+        vertices = np.vstack([vertices] + extra_vertices)
+    return vertices, np.vstack(faces), np.concatenate(face_polygons)
+
+
+def split_meshes(vertices, faces, face_labels, num_labels):
+    """Split a triangle soup into one compact mesh per label
+
+    Returns:
+        list of (np.array(V,3), np.array(F,3)): vertices and faces per label
+    """
+    order = np.argsort(face_labels, kind='stable')
+    bounds = np.searchsorted(face_labels[order], np.arange(num_labels + 1))
+
+    meshes = []
+    for label in range(num_labels):
+        label_faces = faces[order[bounds[label]:bounds[label + 1]]]
+        used, inverse = np.unique(label_faces, return_inverse=True)
+        meshes.append((vertices[used], inverse.reshape(-1, 3)))
+    return meshes
+
+
+def is_lod(geometry_lod, lod):
+    try:
+        return float(geometry_lod) == float(lod)
+    except (TypeError, ValueError):
+        return False
+
+
+def cityjson_to_meshes(j, ids=None, lod=2.2, transform=None):
+    """Convert the LoD surfaces of many city objects straight from CityJSON to ground, wall and roof meshes.
+
+    All polygons of all requested objects are triangulated in one call.
+
+    Args:
+        j (dict): CityJSON, e.g. json.load of a 3DBAG tile or cjio's CityJSON.j
+        ids (list of str, optional): City object ids. Defaults to None, all objects.
+        lod (float, optional): Level of detail. Defaults to 2.2.
+        transform (dict, optional): CityJSON transform of the vertices. Defaults to j['transform'].
+
+    Returns:
+        dict: id -> ((vertices, faces) ground, (vertices, faces) wall, (vertices, faces) roof)
+    """
+    transform = j.get('transform') if transform is None else transform
+    vertices = np.asarray(j['vertices'], dtype=np.float64)
+    if transform:
+        vertices = vertices * np.array(transform['scale']) + np.array(transform['translate'])
+
+    object_ids, polygons, labels = [], [], []
+
+    for id in (j['CityObjects'] if ids is None else ids):
+        for geometry in j['CityObjects'][id].get('geometry', []):
+            if not is_lod(geometry.get('lod'), lod) or 'semantics' not in geometry:
+                continue
+
+            surface_types = [SURFACE_TYPES.index(surface['type']) if surface['type'] in SURFACE_TYPES else -1 for surface in geometry['semantics']['surfaces']]
+
+            # Solids nest their surfaces in shells
+            boundaries, values = geometry['boundaries'], geometry['semantics']['values']
+            if geometry['type'] == 'Solid':
+                boundaries = [surface for shell in boundaries for surface in shell]
+                values = [value for shell in values for value in shell]
+
+            for surface, value in zip(boundaries, values):
+                if value is not None and surface_types[value] >= 0:
+                    polygons.append(surface)
+                    labels.append(len(object_ids) * len(SURFACE_TYPES) + surface_types[value])
+            object_ids.append(id)
+            break
+
+    vertices, faces, face_polygons = triangulate_polygons(vertices, polygons)
+    meshes = split_meshes(vertices, faces, np.asarray(labels, dtype=np.int64)[face_polygons], len(object_ids) * len(SURFACE_TYPES))
+
+    return {id: tuple(meshes[i * len(SURFACE_TYPES):(i + 1) * len(SURFACE_TYPES)]) for i, id in enumerate(object_ids)}
+
+
+def city_object_to_meshes(city_object, lod=2.2):
+    """Convert the LoD surfaces of a cjio city object to ground, wall and roof meshes
+
+    Args:
+        city_object (cjio.models.CityObject): City object
+        lod (float, optional): Level of detail. Defaults to 2.2.
+
+    Returns:
+        ((vertices, faces) ground, (vertices, faces) wall, (vertices, faces) roof) or None
+    """
+    for geom in city_object.geometry:
+        if is_lod(geom.lod, lod):
+            coordinates, polygons, labels = [], [], []
+
+            for surface in geom.surfaces.values():
+                if surface['type'] not in SURFACE_TYPES or not surface['surface_idx']:
+                    continue
+                for shell_id, surface_id in surface['surface_idx']:
+                    rings = []
+                    for ring in geom.boundaries[shell_id][surface_id]:
+                        rings.append(list(range(len(coordinates), len(coordinates) + len(ring))))
+                        coordinates += ring
+                    polygons.append(rings)
+                    labels.append(SURFACE_TYPES.index(surface['type']))
+
+            vertices, faces, face_polygons = triangulate_polygons(np.array(coordinates, dtype=np.float64).reshape(-1, 3), polygons)
+            return tuple(split_meshes(vertices, faces, np.asarray(labels, dtype=np.int64)[face_polygons], len(SURFACE_TYPES)))
+    print(f'LOD {lod} not found')
+    return None
+
+
 def geometry_part_to_trimesh(city_object, lod=2.2):
     """
     Args:
@@ -59,15 +340,12 @@ def geometry_part_to_trimesh(city_object, lod=2.2):
     Returns:
         (trimesh.Trimesh, trimesh.Trimesh, trimesh.Trimesh): ground, wall, roof
     """
-    ground, wall, roof = geometry_part_to_vedo_mesh(city_object, triangulate=True, lod=lod)
-
-    if ground and wall and roof:
-        roof = trimesh.Trimesh(roof.points(), roof.faces())
-        wall = trimesh.Trimesh(wall.points(), wall.faces())
-        ground = trimesh.Trimesh(ground.points(), ground.faces())
+    meshes = city_object_to_meshes(city_object, lod=lod)
 
+    if meshes:
+        ground, wall, roof = [trimesh.Trimesh(vertices, faces) for vertices, faces in meshes]
         return ground, wall, roof
-    
+
     else:
         return None, None, None
 
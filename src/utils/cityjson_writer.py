@@ -0,0 +1,220 @@
+import os
+import json
+import numpy as np
+
+REFERENCE_SYSTEM = 'https://www.opengis.net/def/crs/EPSG/0/7415'
+
+
+def horizontal_surface_types(mesh):
+    """Surface type per face of a horizontal mesh, e.g. the intersection
+
+    Returns:
+        list of str: 'OuterFloorSurface' for faces that point up, 'OuterCeilingSurface' for faces that point down
+    """
+    return np.where(mesh.face_normals[:,2] >= 0, 'OuterFloorSurface', 'OuterCeilingSurface').tolist()
+
+
+class FeatureEncoder:
+    """Encodes building meshes as CityJSONFeatures with quantized, deduplicated vertices.
+
+    Picklable, so worker processes can encode and only send the feature to the writer.
+    """
+
+    def __init__(self, scale, translate, lod='2.2'):
+        """
+        Args:
+            scale (list of float): CityJSON transform scale, e.g. [0.001, 0.001, 0.001]
+            translate (list of float): CityJSON transform translate
+            lod (str, optional): Level of detail of the geometries. Defaults to '2.2'.
+        """
+        self.scale = np.asarray(scale, dtype=np.float64)
+        self.translate = np.asarray(translate, dtype=np.float64)
+        self.lod = lod
+
+    def encode(self, id, parts, attributes=None):
+        """
+        Args:
+            id (str): City object id
+            parts (list of (trimesh.Trimesh, str or list of str)): Meshes with the surface type of all, or of every, face. None meshes are left out.
+            attributes (dict, optional): City object attributes. Defaults to None.
+
+        Returns:
+            dict: CityJSONFeature with a MultiSurface of one triangle per surface
+        """
+        vertices, faces, types = [], [], []
+        num_vertices = 0
+        for mesh, surface_types in parts:
+            if mesh is None or len(mesh.faces) == 0:
+                continue
+            vertices.append(np.asarray(mesh.vertices, dtype=np.float64))
+            faces.append(np.asarray(mesh.faces, dtype=np.int64) + num_vertices)
+            types += [surface_types] * len(mesh.faces) if isinstance(surface_types, str) else list(surface_types)
+            num_vertices += len(mesh.vertices)
+
+        vertices = np.vstack(vertices) if vertices else np.zeros((0, 3))
+        faces = np.vstack(faces) if faces else np.zeros((0, 3), dtype=np.int64)
+
+        # Vertices that fall on the same grid point become one, which can collapse triangles
+        quantized = np.round((vertices - self.translate) / self.scale).astype(np.int64)
+        quantized, inverse = np.unique(quantized, axis=0, return_inverse=True)
+        faces = inverse.reshape(-1)[faces]
+        keep = (faces[:,0] != faces[:,1]) & (faces[:,1] != faces[:,2]) & (faces[:,2] != faces[:,0])
+        faces = faces[keep]
+        types = np.asarray(types, dtype=object)[keep] if types else np.zeros(0, dtype=object)
+
+        # Drop the vertices of collapsed triangles
+        used, faces = np.unique(faces, return_inverse=True)
+        faces = faces.reshape(-1, 3)
+        quantized = quantized[used]
+
+        surfaces = sorted(set(types.tolist()))
+        values = np.searchsorted(surfaces, types.astype(str)).tolist() if len(surfaces) else []
+
+        city_object = {
+            'type': 'Building',
+            'attributes': attributes or {},
+            'geometry': [{
+                'type': 'MultiSurface',
+                'lod': self.lod,
+                'boundaries': faces[:,None,:].tolist(),
+                'semantics': {'surfaces': [{'type': surface} for surface in surfaces], 'values': values},
+            }],
+        }
+        return {'type': 'CityJSONFeature', 'id': id, 'CityObjects': {id: city_object}, 'vertices': quantized.tolist()}
+
+
+class CityJSONSeqWriter:
+    """Streams buildings to a CityJSONSeq (CityJSON Text Sequences) file.
+
+    The first line holds the transform that every feature shares, every next line is one
+    CityJSONFeature, written as soon as the building is done. With append=True an existing
+    file is continued with its own transform, so an interrupted run can continue: a line
+    that was cut off is dropped and a building that is already in the file is not written
+    again.
+    """
+
+    def __init__(self, path, scale=(0.001, 0.001, 0.001), translate=(0.0, 0.0, 0.0), lod='2.2', reference_system=REFERENCE_SYSTEM, append=True):
+        """
+        Args:
+            path (str): Output file, e.g. 'buildings.city.jsonl'
+            scale (list of float, optional): Transform scale, the precision of the vertices. Defaults to 1 mm.
+            translate (list of float, optional): Transform translate. Defaults to the origin.
+            lod (str, optional): Level of detail of the geometries. Defaults to '2.2'.
+            reference_system (str, optional): CRS of the vertices. Defaults to EPSG:7415 (RD New + NAP).
+            append (bool, optional): Continue an existing file instead of overwriting it. Defaults to True.
+        """
+        self.path = path
+        self.ids = set()
+
+        header = read_seq_header(path) if append else None
+        if header is not None:
+            scale, translate = header['transform']['scale'], header['transform']['translate']
+
+            # Ids of the complete features, everything after the last complete line is dropped
+            with open(path, 'rb+') as f:
+                f.readline()
+                end = f.tell()
+                for line in iter(f.readline, b''):
+                    try:
+                        self.ids.add(json.loads(line)['id'])
+                    except ValueError:
+                        break
+                    if not line.endswith(b'\n'):
+                        break
+                    end = f.tell()
+                f.truncate(end)
+            self.file = open(path, 'a')
+        else:
+            header = {
+                'type': 'CityJSON',
+                'version': '2.0',
+                'transform': {'scale': list(scale), 'translate': list(translate)},
+                'metadata': {'referenceSystem': reference_system},
+                'CityObjects': {},
+                'vertices': [],
+            }
+            self.file = open(path, 'w')
+            self.file.write(json.dumps(header, separators=(',', ':')) + '\n')
+
+        self.encoder = FeatureEncoder(scale, translate, lod=lod)
+
+    def write_feature(self, feature):
+        """Write a CityJSONFeature, unless its building is already in the file
+
+        Returns:
+            bool: False when the building was already in the file
+        """
+        if feature['id'] in self.ids:
+            return False
+        self.file.write(json.dumps(feature, separators=(',', ':')) + '\n')
+        self.file.flush()
+        self.ids.add(feature['id'])
+        return True
+
+    def write(self, id, parts, attributes=None):
+        """Encode and write a building, see FeatureEncoder.encode"""
+        return self.write_feature(self.encoder.encode(id, parts, attributes))
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def read_seq_header(path):
+    """First line of a CityJSONSeq file, None when the file does not exist or has no complete header"""
+    if not os.path.isfile(path):
+        return None
+    with open(path) as f:
+        line = f.readline()
+    try:
+        return json.loads(line) if line.endswith('\n') else None
+    except ValueError:
+        return None
+
+
+def _remap(boundaries, mapping):
+    return [_remap(boundary, mapping) if isinstance(boundary, list) else mapping[boundary] for boundary in boundaries]
+
+
+def seq_to_cityjson(seq_path, path):
+    """Merge a CityJSONSeq file into one CityJSON file with a shared, deduplicated vertex pool.
+
+    The features are read one line at a time and the city objects are streamed to the
+    output, only the vertex pool is kept in memory. A building that occurs more than once,
+    e.g. after a restarted run, keeps its last version.
+
+    Args:
+        seq_path (str): CityJSONSeq file, e.g. from CityJSONSeqWriter
+        path (str): CityJSON file
+    """
+    # Last line per id
+    with open(seq_path) as f:
+        header = json.loads(f.readline())
+        offsets, offset = {}, f.tell()
+        for line in iter(f.readline, ''):
+            id = json.loads(line)['id'] if line.strip() else None
+            if id is not None:
+                offsets[id] = offset
+            offset = f.tell()
+
+    pool = {}
+    with open(seq_path) as f, open(path, 'w') as out:
+        header = {key: value for key, value in header.items() if key not in ('CityObjects', 'vertices')}
+        out.write(json.dumps(header, separators=(',', ':'))[:-1] + ',"CityObjects":{')
+
+        for i, offset in enumerate(sorted(offsets.values())):
+            f.seek(offset)
+            feature = json.loads(f.readline())
+
+            mapping = [pool.setdefault(tuple(vertex), len(pool)) for vertex in feature['vertices']]
+            for j, (id, city_object) in enumerate(feature['CityObjects'].items()):
+                for geometry in city_object.get('geometry', []):
+                    geometry['boundaries'] = _remap(geometry['boundaries'], mapping)
+                out.write((',' if i or j else '') + json.dumps(id) + ':' + json.dumps(city_object, separators=(',', ':')))
+
+        out.write('},"vertices":' + json.dumps([list(vertex) for vertex in pool], separators=(',', ':')) + '}')
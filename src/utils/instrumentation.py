@@ -0,0 +1,142 @@
+import os
+import sys
+import json
+import logging
+
+from contextlib import contextmanager
+from timeit import default_timer as timer
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+def get_rss():
+    """Current resident set size of the process in MB, None when it is not available"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def get_peak_rss():
+    """Peak resident set size over the lifetime of the process in MB, None when it is not available"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 2 ** 20 if sys.platform == 'darwin' else peak / 2 ** 10
+
+
+def reset_peak_rss():
+    """Reset the peak resident set size of the process (Linux only)
+
+    Returns:
+        bool: True when the peak was reset, get_rss_high_water_mark then gives the peak since this call
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+def get_rss_high_water_mark():
+    """Peak resident set size in MB since the last reset_peak_rss (Linux only), None when it is not available"""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 2 ** 10
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+class StageRecorder:
+    """Collects one record per pipeline stage of a building.
+
+    Every record has the building id, the stage name, the wall time (s), the resident set
+    size of the process at the end of the stage (MB), the peak resident set size of the
+    process during the stage (MB, None where the peak cannot be reset, i.e. outside Linux)
+    and any counts that the stage adds to it, e.g. points or faces. The stage peak includes
+    the memory of other threads of the process, e.g. the prefetching of the next buildings.
+    """
+
+    def __init__(self, id):
+        self.id = id
+        self.records = []
+
+    @contextmanager
+    def stage(self, name):
+        record = {'id': self.id, 'stage': name}
+        reset = reset_peak_rss()
+        start = timer()
+        try:
+            yield record
+        finally:
+            record['time'] = timer() - start
+            record['rss'] = get_rss()
+            record['stage_peak_rss'] = get_rss_high_water_mark() if reset else None
+            self.records.append(record)
+
+    def summary(self, stages):
+        """Stage times, input counts and the largest stage peak RSS as result columns
+
+        Args:
+            stages (list of str): Stage names, missing stages are None
+
+        Returns:
+            list: a time per stage, points, faces and stage_peak_rss
+        """
+        # A stage that is entered more than once adds up
+        times = {}
+        for record in self.records:
+            times[record['stage']] = times.get(record['stage'], 0.0) + record['time']
+        points = max([record.get('points', 0) for record in self.records], default=0)
+        faces = max([record.get('faces', 0) for record in self.records], default=0)
+        stage_peak_rss = max([record['stage_peak_rss'] for record in self.records if record['stage_peak_rss'] is not None], default=None)
+        return [times.get(stage) for stage in stages] + [points, faces, stage_peak_rss]
+
+
+class JsonLinesSink:
+    """Appends every record as a line of JSON to a file"""
+
+    def __init__(self, path):
+        self.file = open(path, 'a')
+
+    def write(self, record):
+        self.file.write(json.dumps(record) + '\n')
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class MemorySink:
+    """Keeps every record in a list"""
+
+    def __init__(self):
+        self.records = []
+
+    def write(self, record):
+        self.records.append(record)
+
+    def close(self):
+        pass
+
+
+class LoggingSink:
+    """Logs every record as JSON"""
+
+    def __init__(self, logger=None, level=logging.INFO):
+        self.logger = logger if logger is not None else logging.getLogger('src.intersect')
+        self.level = level
+
+    def write(self, record):
+        self.logger.log(self.level, json.dumps(record))
+
+    def close(self):
+        pass
@@ -0,0 +1,113 @@
+import os
+import json
+import trimesh
+import numpy as np
+
+from src.utils.cityjson import cityjson_to_meshes
+
+
+def compile_mesh_store(filedirs, store_root, version, lod=2.2, overwrite=False):
+    """Triangulate the buildings of downloaded 3DBAG tiles once and store them as flat arrays.
+
+    Every tile becomes a folder `{store_root}/{version}/{tile}` with `vertices.npy`
+    (float64, V x 3), `faces.npy` (int64, F x 3, indices local to each mesh) and an
+    `index.json` that maps every city object id to the (vertex offset, vertex count,
+    face offset, face count) of its ground, wall and roof mesh. Tiles that are already
+    compiled are skipped.
+
+    Args:
+        filedirs (list of str): 3DBAG CityJSON tiles, e.g. from parse_wfs_json
+        store_root (str): Root folder of the store
+        version (str): 3DBAG version, e.g. 'v210908_fd2cee53'
+        lod (float, optional): Level of detail. Defaults to 2.2.
+        overwrite (bool, optional): Compile tiles that already exist again. Defaults to False.
+    """
+    for filedir in filedirs:
+        tile = os.path.splitext(os.path.basename(filedir))[0]
+        tile_dir = os.path.join(store_root, version, tile)
+        if not overwrite and os.path.isfile(os.path.join(tile_dir, 'index.json')):
+            continue
+
+        print('Processing:', tile)
+        with open(filedir) as f:
+            j = json.load(f)
+
+        ids = [id for id, city_object in j['CityObjects'].items() if city_object['type'] in ('Building', 'BuildingPart')]
+
+        vertices, faces, index = [], [], {}
+        num_vertices, num_faces = 0, 0
+
+        for id, meshes in cityjson_to_meshes(j, ids=ids, lod=lod).items():
+            index[id] = []
+            for mesh_vertices, mesh_faces in meshes:
+                index[id].append([num_vertices, mesh_vertices.shape[0], num_faces, mesh_faces.shape[0]])
+                vertices.append(mesh_vertices)
+                faces.append(mesh_faces)
+                num_vertices += mesh_vertices.shape[0]
+                num_faces += mesh_faces.shape[0]
+
+        os.makedirs(tile_dir, exist_ok=True)
+        np.save(os.path.join(tile_dir, 'vertices.npy'), np.vstack(vertices) if vertices else np.zeros((0, 3)))
+        np.save(os.path.join(tile_dir, 'faces.npy'), np.vstack(faces) if faces else np.zeros((0, 3), dtype=np.int64))
+        with open(os.path.join(tile_dir, 'index.json'), 'w') as f:
+            json.dump(index, f)
+
+
+class MeshStore:
+    """Read-only, memory-mapped access to a compiled 3DBAG mesh store.
+
+    Can be passed as `city_model` to the dataloader. Only file paths are pickled, so worker
+    processes map the same files instead of receiving a copy of the city model.
+    """
+
+    def __init__(self, store_root, version, tiles=None):
+        """
+        Args:
+            store_root (str): Root folder of the store
+            version (str): 3DBAG version
+            tiles (list of str, optional): Only use these tiles. Defaults to None, all tiles.
+        """
+        self.store_root = store_root
+        self.version = version
+        self.tiles = sorted(os.listdir(os.path.join(store_root, version))) if tiles is None else list(tiles)
+
+        self.index = {}
+        for tile in self.tiles:
+            with open(os.path.join(store_root, version, tile, 'index.json')) as f:
+                for id, parts in json.load(f).items():
+                    self.index[id] = (tile, parts)
+        self.arrays = {}
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['arrays'] = {}
+        return state
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, id):
+        return id in self.index
+
+    def load_tile(self, tile):
+        if tile not in self.arrays:
+            tile_dir = os.path.join(self.store_root, self.version, tile)
+            self.arrays[tile] = (np.load(os.path.join(tile_dir, 'vertices.npy'), mmap_mode='r'), np.load(os.path.join(tile_dir, 'faces.npy'), mmap_mode='r'))
+        return self.arrays[tile]
+
+    def get(self, id):
+        """Meshes of a city object
+
+        Args:
+            id (str): City object id, e.g. 'NL.IMBAG.Pand.0363100012165490-0'
+
+        Returns:
+            (trimesh.Trimesh, trimesh.Trimesh, trimesh.Trimesh): ground, wall, roof
+        """
+        tile, parts = self.index[id]
+        vertices, faces = self.load_tile(tile)
+
+        meshes = []
+        for vertex_offset, vertex_count, face_offset, face_count in parts:
+            meshes.append(trimesh.Trimesh(np.array(vertices[vertex_offset:vertex_offset + vertex_count]), np.array(faces[face_offset:face_offset + face_count])))
+        return tuple(meshes)
@@ -5,6 +5,8 @@ from shapely.geometry import Polygon, MultiPolygon
 from vedo.mesh import Mesh
 from vedo import merge
 
+from src.utils.cityjson import triangulate_polygons
+
 
 def to_vedo_surface(surfaces):
     return [surfaces, [tuple(range(len(surfaces)))]]
@@ -52,6 +54,85 @@ def floorplan3dfier_vedo(floorplan, bottom=0, top=3, bottom_plane=False, top_pla
     return meshes
 
 
+class FloorplanExtrusion:
+    """Triangulated prism of a 2D floorplan, extruded to any bottom and top height.
+
+    The faces are built once for all rings with NumPy index arithmetic. Every ring point has
+    a bottom vertex (first half of the vertices) and a top vertex (second half), so a new
+    extrusion only writes the z column.
+    """
+
+    def __init__(self, floorplan, bottom_plane=False, top_plane=False):
+        """
+        Args:
+            floorplan (list[list[list]]]): list of polygons
+            bottom_plane (bool, optional): Add a bottom polygon?. Defaults to False.
+            top_plane (bool, optional): Add a top polygon?. Defaults to False.
+        """
+        rings, closed = [], []
+        for polygon in floorplan:
+            ring = np.asarray(polygon, dtype=np.float64).reshape(-1, 2)
+            is_closed = ring.shape[0] > 1 and (ring[0] == ring[-1]).all()
+            rings.append(ring[:-1] if is_closed else ring)
+            closed.append(is_closed)
+
+        sizes = np.array([ring.shape[0] for ring in rings], dtype=np.int64)
+        offsets = np.concatenate(([0], np.cumsum(sizes)[:-1])).astype(np.int64)
+        self.xy = np.vstack(rings) if rings else np.zeros((0, 2))
+        num_points = self.xy.shape[0]
+
+        # Edge i of a ring runs from point i to point i + 1, wrapping around for closed rings
+        num_edges = np.where(closed, sizes, np.maximum(sizes - 1, 0))
+        ring_ids = np.repeat(np.arange(sizes.shape[0]), num_edges)
+        local = np.arange(num_edges.sum()) - np.repeat(np.cumsum(num_edges) - num_edges, num_edges)
+        start = offsets[ring_ids] + local
+        end = offsets[ring_ids] + (local + 1) % np.maximum(sizes[ring_ids], 1)
+
+        # Quad (bottom a, top a, top b, bottom b) as two triangles
+        faces = [np.stack([
+            np.stack([start, start + num_points, end + num_points], axis=1),
+            np.stack([start, end + num_points, end], axis=1)
+        ], axis=1).reshape(-1, 3)]
+
+        if bottom_plane or top_plane:
+            caps = [[list(range(offset, offset + size))] for offset, size in zip(offsets, sizes) if size >= 3]
+            _, cap_faces, _ = triangulate_polygons(np.hstack((self.xy, np.zeros((num_points, 1)))), caps)
+            if bottom_plane:
+                faces.append(cap_faces)
+            if top_plane:
+                faces.append(cap_faces + num_points)
+
+        self.faces = np.vstack(faces)
+
+    def vertices(self, bottom=0, top=3):
+        """
+        Args:
+            bottom (float, optional): Bottom height. Defaults to 0.
+            top (float, optional): Top height. Defaults to 3.
+
+        Returns:
+            np.array(V,3)
+        """
+        num_points = self.xy.shape[0]
+        vertices = np.empty((2 * num_points, 3))
+        vertices[:num_points,:2] = self.xy
+        vertices[num_points:,:2] = self.xy
+        vertices[:num_points,2] = bottom
+        vertices[num_points:,2] = top
+        return vertices
+
+    def to_trimesh(self, bottom=0, top=3):
+        """
+        Args:
+            bottom (float, optional): Bottom height. Defaults to 0.
+            top (float, optional): Top height. Defaults to 3.
+
+        Returns:
+            trimesh.Trimesh
+        """
+        return trimesh.Trimesh(self.vertices(bottom, top), self.faces, process=False)
+
+
 def floorplan3dfier(floorplan, bottom=0, top=3, bottom_plane=False, top_plane=False):
     """Constructs a 3D version of a 2d floorplan
 
@@ -65,8 +146,126 @@ def floorplan3dfier(floorplan, bottom=0, top=3, bottom_plane=False, top_plane=Fa
     Returns:
         trimesh.Trimesh
     """
-    vedo_mesh = floorplan3dfier_vedo(floorplan, bottom=bottom, top=top, bottom_plane=bottom_plane, top_plane=top_plane, triangulate=True)
-    return trimesh.Trimesh(vedo_mesh.points(), vedo_mesh.faces())
+    return FloorplanExtrusion(floorplan, bottom_plane=bottom_plane, top_plane=top_plane).to_trimesh(bottom=bottom, top=top)
+
+
+def to_shapely(parts):
+    """Valid shapely version of a list of rings"""
+    polygons = [Polygon(part) for part in parts if len(part) >= 3]
+    return MultiPolygon(polygons).buffer(0)
+
+
+# Footprints that differ less than this cannot gain from an intersection
+TRIAGE_THRESHOLDS = {'symmetric_difference': 1.0, 'iou': 0.98, 'hausdorff': 0.3}
+
+
+def footprint_metrics(floorplan, outline):
+    """2D agreement between a floorplan and an outline
+
+    Args:
+        floorplan (list[list[list]]]): Building floorplan
+        outline (list[list[list]]]): Building outline
+
+    Returns:
+        dict: symmetric_difference (area), iou and hausdorff (distance between the boundaries)
+    """
+    floorplan_sh = to_shapely(floorplan)
+    outline_sh = to_shapely(outline)
+
+    union = floorplan_sh.union(outline_sh).area
+    return {
+        'symmetric_difference': floorplan_sh.symmetric_difference(outline_sh).area,
+        'iou': floorplan_sh.intersection(outline_sh).area / union if union > 0 else 0.0,
+        'hausdorff': floorplan_sh.boundary.hausdorff_distance(outline_sh.boundary) if not (floorplan_sh.is_empty or outline_sh.is_empty) else np.inf,
+    }
+
+
+def footprints_match(floorplan, outline, thresholds=TRIAGE_THRESHOLDS):
+    """True when a floorplan and an outline agree within every threshold
+
+    Args:
+        floorplan (list[list[list]]]): Building floorplan
+        outline (list[list[list]]]): Building outline
+        thresholds (dict, optional): Maximum symmetric_difference, minimum iou and maximum hausdorff, missing metrics are not checked. Defaults to TRIAGE_THRESHOLDS.
+
+    Returns:
+        bool
+    """
+    metrics = footprint_metrics(floorplan, outline)
+    return (metrics['symmetric_difference'] <= thresholds.get('symmetric_difference', np.inf)
+            and metrics['iou'] >= thresholds.get('iou', -np.inf)
+            and metrics['hausdorff'] <= thresholds.get('hausdorff', np.inf))
+
+
+class IntersectionGeometry:
+    """Triangulated 2D difference between a floorplan and an outline, placed at any height.
+
+    The parts of the outline outside the floorplan face up and the parts of the floorplan
+    outside the outline face down. Everything but the z coordinate is computed once. The
+    triangulated parts are also kept as polygon coordinates in `polygons`.
+    """
+
+    def __init__(self, floorplan, outline):
+        """
+        Args:
+            floorplan (list[list[list]]]): Building floorplan
+            outline (list[list[list]]]): Building outline
+        """
+        floorplan_sh = to_shapely(floorplan)
+        outline_sh = to_shapely(outline)
+
+        xy, faces = [np.zeros((0, 2))], [np.zeros((0, 3), dtype=np.int64)]
+        self.polygons = []
+        num_vertices = 0
+        for difference, flip in [(outline_sh.difference(floorplan_sh), True), (floorplan_sh.difference(outline_sh), False)]:
+            parts = [difference] if type(difference) == Polygon else getattr(difference, 'geoms', [])
+            for part in parts:
+                if part.is_empty:
+                    continue
+                try:
+                    vertices, part_faces = trimesh.creation.triangulate_polygon(part)
+                except:
+                    print('ERROR: in shapely intersection ' + ('up' if flip else 'down'))
+                    continue
+                part_faces = np.asarray(part_faces, dtype=np.int64)
+                self.polygons.append([list(part.exterior.coords)] + [list(interior.coords) for interior in part.interiors])
+                xy.append(np.asarray(vertices, dtype=np.float64))
+                faces.append((part_faces[:,::-1] if flip else part_faces) + num_vertices)
+                num_vertices += len(vertices)
+
+        self.xy = np.vstack(xy)
+        self.faces = np.vstack(faces)
+
+    def __bool__(self):
+        return self.faces.shape[0] > 0
+
+    def vertices(self, height=0):
+        return np.hstack((self.xy, np.full((self.xy.shape[0], 1), float(height))))
+
+    def to_trimesh(self, height=0):
+        """
+        Args:
+            height (float, optional): Height of the intersection plane. Defaults to 0.
+
+        Returns:
+            trimesh.Trimesh or None when the floorplan and outline coincide
+        """
+        if not self:
+            return None
+        return trimesh.Trimesh(self.vertices(height), self.faces, process=False)
+
+
+def get_intersection_geometry(floorplan, outline):
+    """IntersectionGeometry of a (floorplan, outline) pair
+
+    Args:
+        floorplan (list[list[list]]]): Building floorplan
+        outline (list[list[list]]]): Building outline
+
+    Returns:
+        IntersectionGeometry
+    """
+    return IntersectionGeometry(floorplan, outline)
 
 
 def get_intersection(floorplan, outline, height=5):
@@ -80,71 +279,43 @@ def get_intersection(floorplan, outline, height=5):
     Returns:
         trimesh.Trimesh
     """
-    # Obtain the shapely (sh) floorplan 
-    floorplan_polygons = []
-    for floorplan_part in floorplan:
-        if len(floorplan_part) >= 3:
-            floorplan_polygons.append(Polygon(floorplan_part))
-    floorplan_sh = MultiPolygon(floorplan_polygons)
-
-    # Obtain the shapely (sh) outline
-    outline_polygons = []
-    for outline_part in outline:
-        if len(outline_part) >= 3:
-            outline_polygons.append(Polygon(outline_part))
-    outline_sh = MultiPolygon(outline_polygons)    
-
-    # Return the difference
-    intersection_up = outline_sh.buffer(0).difference(floorplan_sh.buffer(0))
-    intersection_down = floorplan_sh.buffer(0).difference(outline_sh.buffer(0))
-
-    if type(intersection_up) == Polygon:
-        intersection_up = [intersection_up]
-    if type(intersection_down) == Polygon:
-        intersection_down = [intersection_down]
-
-    # Convert to trimesh UP
-    intersections_up = []
-    for intersection_part in intersection_up:
-        try:
-            vertices, faces = trimesh.creation.triangulate_polygon(intersection_part)
-            vertices = np.hstack((vertices, np.ones((vertices.shape[0], 1)) * height))
-            mesh = trimesh.Trimesh(vertices, faces)
-            mesh.invert()
-            intersections_up.append(mesh)
-        except:
-            print('ERROR: in shapely intersection down')
-
-    if len(intersections_up) > 0:
-        up = trimesh.util.concatenate(intersections_up)
-    elif len(intersections_up) == 0:
-        up = intersections_up
-    else:
-        up = None
-
-    # Convert to trimesh DOWN
-    intersections_down = []
-    for intersection_part in intersection_down:
-        try:
-            vertices, faces = trimesh.creation.triangulate_polygon(intersection_part)
-            vertices = np.hstack((vertices, np.ones((vertices.shape[0], 1)) * height))
-            mesh = trimesh.Trimesh(vertices, faces)
-            intersections_down.append(mesh)
-        except:
-            print('ERROR: in shapely intersection down')
-    if len(intersections_down) > 0:
-        down = trimesh.util.concatenate(intersections_down)
-    elif len(intersections_down) == 0:
-        down = intersections_down
-    else:
-        down = None
-
-    if up and down:
-        return trimesh.util.concatenate(up, down)
-    elif up and not down:
-        return up
-    elif not up and down:
-        return down
+    return get_intersection_geometry(floorplan, outline).to_trimesh(height)
+
+
+def sample_surfaces(meshes, N, seed=None):
+    """Stratified, area-weighted surface samples of several meshes with one shared budget.
+
+    The cumulative area of all triangles is split into N equal strata with one sample each,
+    placed uniformly within its triangle. Every mesh gets its share of the N samples by area.
+
+    Args:
+        meshes (list of trimesh.Trimesh): Meshes, None entries are skipped
+        N (int): Total number of samples
+        seed (int or np.random.Generator, optional): Seed or random generator. Defaults to None.
+
+    Returns:
+        list of np.array(n,3): samples per mesh, None for None meshes
+    """
+    rng = np.random.default_rng(seed)
+    triangles = [mesh.triangles for mesh in meshes if mesh is not None]
+    triangles = np.concatenate(triangles) if triangles else np.zeros((0, 3, 3))
+    offsets = np.cumsum([0] + [len(mesh.faces) for mesh in meshes if mesh is not None])
+
+    cumulative_area = np.cumsum(np.linalg.norm(np.cross(triangles[:,1] - triangles[:,0], triangles[:,2] - triangles[:,0]), axis=1) / 2)
+    if cumulative_area.shape[0] == 0 or cumulative_area[-1] <= 0:
+        N = 0
+
+    # One sample per stratum of the cumulative area, the triangle indices come out sorted
+    strata = (np.arange(N) + rng.random(N)) / max(N, 1) * (cumulative_area[-1] if N else 0)
+    idx = np.minimum(np.searchsorted(cumulative_area, strata, side='right'), max(triangles.shape[0] - 1, 0))
+
+    # Uniform barycentric coordinates
+    r1, r2 = np.sqrt(rng.random(N)), rng.random(N)
+    samples = triangles[idx,0] * (1 - r1)[:,None] + triangles[idx,1] * (r1 * (1 - r2))[:,None] + triangles[idx,2] * (r1 * r2)[:,None]
+
+    bounds = np.searchsorted(idx, offsets)
+    parts = iter(np.split(samples, bounds[1:-1]))
+    return [None if mesh is None else next(parts) for mesh in meshes]
 
 
 def auto_crop_mesh_bottom(mesh, intersection_height=3.0):
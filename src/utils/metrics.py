@@ -2,6 +2,9 @@ import trimesh
 import numpy as np
 from scipy.spatial import cKDTree
 
+from src.utils.bvh import TriangleBVH
+from src.utils.meshes import sample_surfaces
+
 
 def get_distances(cloud_a, cloud_b):
     kd_tree = cKDTree(cloud_b, compact_nodes=False, balanced_tree=False)
@@ -10,17 +13,31 @@ def get_distances(cloud_a, cloud_b):
     return distances
 
 
-def average_nearest_neighbour(pcd, trmesh, N=10000):
+def average_nearest_neighbour(pcd, trmesh, N=10000, seed=None):
+    rng = np.random.default_rng(seed)
 
-    pcd_samples = pcd[np.random.choice(len(pcd), min(N, len(pcd)), replace=False)]
-    mesh_samples, _ = trimesh.sample.sample_surface_even(trmesh, N)
+    pcd_samples = pcd[rng.choice(len(pcd), min(N, len(pcd)), replace=False)]
+    mesh_samples = sample_surfaces([trmesh], N, seed=rng)[0]
     distances = get_distances(pcd_samples, mesh_samples)
     
     return distances.mean()
 
 
-def average_nearest_neighbour_ratio(pcd, trmesh, A=None, N=10000):
-    ann = average_nearest_neighbour(pcd, trmesh, N)
+def average_distance_to_mesh(pcd, trmesh):
+    """Average exact distance from points to the triangles of a mesh
+
+    Args:
+        pcd (np.array(N,3)): Points
+        trmesh (trimesh.Trimesh): A mesh
+
+    Returns:
+        float
+    """
+    return TriangleBVH(trmesh.vertices, trmesh.faces).distances(pcd).mean()
+
+
+def average_nearest_neighbour_ratio(pcd, trmesh, A=None, N=10000, seed=None):
+    ann = average_nearest_neighbour(pcd, trmesh, N, seed=seed)
 
     min = trmesh.vertices.min(axis=0)
     max = trmesh.vertices.max(axis=0)
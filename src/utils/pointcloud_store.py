@@ -0,0 +1,183 @@
+import os
+import json
+import numpy as np
+
+from functools import lru_cache
+
+
+class PointCloud:
+    """Minimal point cloud with the laspy attributes that the intersection pipeline uses"""
+
+    def __init__(self, x, y, z, red=None, green=None, blue=None):
+        self.x, self.y, self.z = x, y, z
+        self.red, self.green, self.blue = red, green, blue
+
+    def __len__(self):
+        return self.x.shape[0]
+
+    def __getitem__(self, idx):
+        if self.red is None:
+            return PointCloud(self.x[idx], self.y[idx], self.z[idx])
+        return PointCloud(self.x[idx], self.y[idx], self.z[idx], self.red[idx], self.green[idx], self.blue[idx])
+
+
+class PointCloudStore:
+    """All building point clouds packed in one pair of memory-mapped arrays.
+
+    A store is a folder with `xyz.f8` (float64, N x 3), `rgb.u2` (uint16, N x 3) and an
+    `index.json` that maps every id to the (offset, count) of its points. Reading a
+    building is a slice of the memory map, without any decompression. A store written with
+    `shuffle=True` keeps the points of every building in random order, so the first n points
+    are a random sample.
+
+    The index is rewritten every `flush_every` buildings and on close, after the points it
+    refers to. Reopening an interrupted store drops the points that are not in the index, so
+    an interrupted run continues where its index ends.
+    """
+
+    INDEX = 'index.json'
+
+    def __init__(self, root, mode='r', shuffle=False, seed=None, flush_every=100):
+        """
+        Args:
+            root (str): Store folder
+            mode (str, optional): 'r' to read, 'a' to append, 'w' to start a new store in place of an existing one. Defaults to 'r'.
+            shuffle (bool, optional): Store the points of new buildings in random order. Defaults to False.
+            seed (int, optional): Seed of the shuffle. Defaults to None.
+            flush_every (int, optional): Number of appended buildings between index writes. Defaults to 100.
+        """
+        self.root = root
+        self.mode = mode
+        self.index = {'shuffled': shuffle, 'ids': {}}
+        self.rng = np.random.default_rng(seed)
+        self.flush_every = flush_every
+        self.unflushed = 0
+
+        if mode == 'w' and os.path.isfile(os.path.join(root, self.INDEX)):
+            os.remove(os.path.join(root, self.INDEX))
+
+        if os.path.isfile(os.path.join(root, self.INDEX)):
+            with open(os.path.join(root, self.INDEX)) as f:
+                self.index = json.load(f)
+
+        if mode in ('a', 'w'):
+            os.makedirs(root, exist_ok=True)
+            self.xyz_file = open(os.path.join(root, 'xyz.f8'), mode + 'b')
+            self.rgb_file = open(os.path.join(root, 'rgb.u2'), mode + 'b')
+
+            # Points of an interrupted run that are not in the index are overwritten
+            available = min(self.xyz_file.tell() // 24, self.rgb_file.tell() // 6)
+            self.index['ids'] = {id: [offset, count] for id, (offset, count) in self.index['ids'].items() if offset + count <= available}
+            self.size = max([offset + count for offset, count in self.index['ids'].values()], default=0)
+            self.xyz_file.truncate(self.size * 24)
+            self.rgb_file.truncate(self.size * 6)
+
+        elif mode == 'r':
+            size = os.path.getsize(os.path.join(root, 'xyz.f8')) // 24
+            self.xyz = np.memmap(os.path.join(root, 'xyz.f8'), dtype=np.float64, mode='r', shape=(size, 3)) if size else np.zeros((0, 3))
+            self.rgb = np.memmap(os.path.join(root, 'rgb.u2'), dtype=np.uint16, mode='r', shape=(size, 3)) if size else np.zeros((0, 3), dtype=np.uint16)
+
+        else:
+            raise ValueError(f'Mode <{mode}> not available')
+
+    @classmethod
+    def is_store(cls, root):
+        return os.path.isfile(os.path.join(root, cls.INDEX))
+
+    def __contains__(self, id):
+        return id in self.index['ids']
+
+    def ids(self):
+        return list(self.index['ids'])
+
+    @property
+    def shuffled(self):
+        return self.index['shuffled']
+
+    def count(self, id):
+        return self.index['ids'][id][1]
+
+    def append(self, id, x, y, z, red=None, green=None, blue=None):
+        """Append the point cloud of one building, a building that is already in the store is skipped
+
+        Args:
+            id (str): Building id
+            x, y, z (np.array(N,)): Coordinates
+            red, green, blue (np.array(N,), optional): Colours, zero when None. Defaults to None.
+
+        Returns:
+            bool: False when the building was already in the store
+        """
+        if id in self:
+            return False
+
+        xyz = np.stack([x, y, z], axis=1).astype(np.float64)
+        if red is None:
+            rgb = np.zeros(xyz.shape, dtype=np.uint16)
+        else:
+            rgb = np.stack([red, green, blue], axis=1).astype(np.uint16)
+
+        if self.index['shuffled']:
+            order = self.rng.permutation(xyz.shape[0])
+            xyz, rgb = xyz[order], rgb[order]
+
+        self.xyz_file.write(np.ascontiguousarray(xyz).tobytes())
+        self.rgb_file.write(np.ascontiguousarray(rgb).tobytes())
+        self.index['ids'][id] = [self.size, xyz.shape[0]]
+        self.size += xyz.shape[0]
+
+        self.unflushed += 1
+        if self.unflushed >= self.flush_every:
+            self.flush()
+        return True
+
+    def get(self, id, max_points=None, colours=True):
+        """Point cloud of one building, copied out of the memory map
+
+        Args:
+            id (str): Building id
+            max_points (int, optional): Only return the first max_points points, a random sample for a shuffled store. Defaults to None.
+            colours (bool, optional): Also return the colours. Defaults to True.
+
+        Returns:
+            PointCloud
+        """
+        offset, count = self.index['ids'][id]
+        if max_points is not None:
+            count = min(count, max_points)
+
+        xyz = np.array(self.xyz[offset:offset + count])
+        if not colours:
+            return PointCloud(xyz[:,0], xyz[:,1], xyz[:,2])
+
+        rgb = np.array(self.rgb[offset:offset + count])
+        return PointCloud(xyz[:,0], xyz[:,1], xyz[:,2], rgb[:,0], rgb[:,1], rgb[:,2])
+
+    def flush(self):
+        """Write the points and then the index, which replaces the old index at once"""
+        self.xyz_file.flush()
+        self.rgb_file.flush()
+
+        temp_path = os.path.join(self.root, self.INDEX + '.tmp')
+        with open(temp_path, 'w') as f:
+            json.dump(self.index, f)
+        os.replace(temp_path, os.path.join(self.root, self.INDEX))
+        self.unflushed = 0
+
+    def close(self):
+        if self.mode in ('a', 'w'):
+            self.flush()
+            self.xyz_file.close()
+            self.rgb_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+@lru_cache(maxsize=None)
+def open_store(root):
+    """Read-only store, opened once per process"""
+    return PointCloudStore(root, mode='r')
@@ -3,8 +3,13 @@ from numba import jit, njit
 import numba
 import numpy as np
 import os
-import open3d as o3d
+import copy
 import laspy
+import multiprocessing
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from src.utils.pointcloud_store import PointCloudStore
 
 
 def get_bbox_from_tile_code(tile_code, padding=0, width=50, height=50):
@@ -88,147 +93,441 @@ def numba_parallel_points_in_polygon(points, polygon):
     return D
 
 
+def get_rings(coordinates):
+    """Flatten GeoJSON-like polygon or multipolygon coordinates to a list of rings
+
+    Args:
+        coordinates (list): A ring, a polygon (list of rings) or a multipolygon (list of polygons)
+
+    Returns:
+        list of np.array(N,2)
+    """
+    if len(coordinates) == 0:
+        return []
+    if np.isscalar(coordinates[0][0]):
+        ring = np.asarray(coordinates, dtype=float)[:,:2]
+        return [ring] if ring.shape[0] >= 3 else []
+    return [ring for part in coordinates for ring in get_rings(part)]
+
+
+def get_edges(rings):
+    """All ring edges as rows of x0, y0, x1, y1"""
+    if len(rings) == 0:
+        return np.zeros((0, 4))
+    return np.vstack([np.hstack((ring, np.roll(ring, -1, axis=0))) for ring in rings])
+
+
+@njit
+def _bucket_edges(edges, x_min, y_min, cell_size, nx, ny):
+    """Compressed lists of the edges per grid cell and per grid row"""
+    cell_counts = np.zeros(nx * ny + 1, dtype=np.int64)
+    row_counts = np.zeros(ny + 1, dtype=np.int64)
+    bounds = np.empty((edges.shape[0], 4), dtype=np.int64)
+
+    for e in range(edges.shape[0]):
+        x0, y0, x1, y1 = edges[e]
+        bounds[e, 0] = min(max(int((min(x0, x1) - x_min) / cell_size), 0), nx - 1)
+        bounds[e, 1] = min(max(int((max(x0, x1) - x_min) / cell_size), 0), nx - 1)
+        bounds[e, 2] = min(max(int((min(y0, y1) - y_min) / cell_size), 0), ny - 1)
+        bounds[e, 3] = min(max(int((max(y0, y1) - y_min) / cell_size), 0), ny - 1)
+        for j in range(bounds[e, 2], bounds[e, 3] + 1):
+            row_counts[j + 1] += 1
+            for i in range(bounds[e, 0], bounds[e, 1] + 1):
+                cell_counts[j * nx + i + 1] += 1
+
+    cell_offsets = np.cumsum(cell_counts)
+    row_offsets = np.cumsum(row_counts)
+    cell_edges = np.empty(cell_offsets[-1], dtype=np.int64)
+    row_edges = np.empty(row_offsets[-1], dtype=np.int64)
+    cell_fill = cell_offsets[:-1].copy()
+    row_fill = row_offsets[:-1].copy()
+
+    for e in range(edges.shape[0]):
+        for j in range(bounds[e, 2], bounds[e, 3] + 1):
+            row_edges[row_fill[j]] = e
+            row_fill[j] += 1
+            for i in range(bounds[e, 0], bounds[e, 1] + 1):
+                cell_edges[cell_fill[j * nx + i]] = e
+                cell_fill[j * nx + i] += 1
+
+    return cell_offsets, cell_edges, row_offsets, row_edges
+
+
+@njit
+def _point_segment_distance(px, py, x0, y0, x1, y1):
+    dx, dy = x1 - x0, y1 - y0
+    length = dx * dx + dy * dy
+    t = 0.0
+    if length > 0:
+        t = min(max(((px - x0) * dx + (py - y0) * dy) / length, 0.0), 1.0)
+    ex, ey = px - (x0 + t * dx), py - (y0 + t * dy)
+    return np.sqrt(ex * ex + ey * ey)
+
+
+@njit(parallel=True)
+def _signed_distances(points, edges, x_min, y_min, cell_size, nx, ny, cell_offsets, cell_edges, row_offsets, row_edges):
+    D = np.empty(points.shape[0])
+
+    for p in numba.prange(points.shape[0]):
+        px, py = points[p, 0], points[p, 1]
+        ci = min(max(int(np.floor((px - x_min) / cell_size)), 0), nx - 1)
+        cj = min(max(int(np.floor((py - y_min) / cell_size)), 0), ny - 1)
+
+        # Even-odd ray casting over the edges in the row of the point, holes flip it back
+        inside = False
+        if py >= y_min and py <= y_min + ny * cell_size:
+            for k in range(row_offsets[cj], row_offsets[cj + 1]):
+                x0, y0, x1, y1 = edges[row_edges[k]]
+                if (y0 > py) != (y1 > py):
+                    if px < (x1 - x0) * (py - y0) / (y1 - y0) + x0:
+                        inside = not inside
+
+        # Search the grid in rings of cells around the point until no closer edge is possible
+        best = np.inf
+        for r in range(max(nx, ny)):
+            for j in range(cj - r, cj + r + 1):
+                if j < 0 or j >= ny:
+                    continue
+                step = 1 if (j == cj - r or j == cj + r) else 2 * r
+                for i in range(ci - r, ci + r + 1, max(step, 1)):
+                    if i < 0 or i >= nx:
+                        continue
+                    for k in range(cell_offsets[j * nx + i], cell_offsets[j * nx + i + 1]):
+                        x0, y0, x1, y1 = edges[cell_edges[k]]
+                        best = min(best, _point_segment_distance(px, py, x0, y0, x1, y1))
+            if best <= r * cell_size:
+                break
+
+        D[p] = -best if inside else best
+    return D
+
+
+def signed_distance_to_polygons(points, polygons):
+    """Signed distance from 2D points to the boundary of one or more polygons.
+
+    Negative inside, positive outside. Interior rings are holes, multipolygons are
+    supported. The edges are bucketed in a uniform grid, so the cost scales with the
+    number of points plus the number of edges.
+
+    Args:
+        points (np.array(N,2)): xy coordinates
+        polygons (list): Ring, polygon or multipolygon coordinates
+
+    Returns:
+        np.array(N,)
+    """
+    points = np.ascontiguousarray(points, dtype=float)[:,:2]
+    edges = get_edges(get_rings(polygons))
+    if edges.shape[0] == 0:
+        return np.full(points.shape[0], np.inf)
+
+    x_min, y_min = edges[:,[0, 2]].min(), edges[:,[1, 3]].min()
+    width, height = edges[:,[0, 2]].max() - x_min, edges[:,[1, 3]].max() - y_min
+    cell_size = max(np.sqrt(max(width * height, 1e-12) / edges.shape[0]), max(width, height) / 1024, 1e-6)
+    nx, ny = int(width // cell_size) + 1, int(height // cell_size) + 1
+
+    grid = _bucket_edges(edges, x_min, y_min, cell_size, nx, ny)
+    return _signed_distances(points, edges, x_min, y_min, cell_size, nx, ny, *grid)
+
+
 def filter_roi(pcd, buffer_inside=0.0, buffer_outside=0.0, bgt_floorplan=None, bag_floorplan=None):
-    if bgt_floorplan:
-        clip_idx_inside_floorplan = np.zeros(len(pcd), dtype=bool)
-        # Remove every point within a buffer inside of the floorplan
-        if buffer_inside != 0:
-            for polygon in bgt_floorplan:
-                clip_idx = numba_parallel_points_in_polygon(np.array([pcd.x, pcd.y]).T, np.array(Polygon(polygon).buffer(buffer_inside, cap_style=2, resolution=2).exterior))
-                clip_idx_inside_floorplan = np.logical_or(clip_idx_inside_floorplan, clip_idx)
-            pcd = pcd[np.invert(clip_idx_inside_floorplan)]
-
-        # # Keep every point within a buffer outside of the floorplan
-        # clip_idx_outside_floorplan = np.zeros(len(pcd), dtype=bool)
-
-        # if buffer_outside != 0:
-        #     for polygon in bgt_floorplan:
-        #         clip_idx = numba_parallel_points_in_polygon(np.array([pcd.x, pcd.y]).T, np.array(Polygon(polygon).buffer(buffer_outside, cap_style=2, resolution=2).exterior))
-        #         clip_idx_outside_floorplan = np.logical_or(clip_idx_outside_floorplan, clip_idx)
-        #     pcd = pcd[clip_idx_outside_floorplan]
-
-    if bag_floorplan:
-        # clip_idx_inside_floorplan = np.zeros(len(pcd), dtype=bool)
-        # # Remove every point within a buffer inside of the floorplan
-        # if buffer_inside != 0:
-        #     for polygon in bag_floorplan:
-        #         clip_idx = numba_parallel_points_in_polygon(np.array([pcd.x, pcd.y]).T, np.array(Polygon(polygon).buffer(buffer_inside, cap_style=2, resolution=2).exterior))
-        #         clip_idx_inside_floorplan = np.logical_or(clip_idx_inside_floorplan, clip_idx)
-        #     pcd = pcd[np.invert(clip_idx_inside_floorplan)]
-
-        # Keep every point within a buffer outside of the floorplan
-        clip_idx_outside_floorplan = np.zeros(len(pcd), dtype=bool)
-
-        if buffer_outside != 0:
-            for polygon in bag_floorplan:
-                clip_idx = numba_parallel_points_in_polygon(np.array([pcd.x, pcd.y]).T, np.array(Polygon(polygon).buffer(buffer_outside, cap_style=2, resolution=2).exterior))
-                clip_idx_outside_floorplan = np.logical_or(clip_idx_outside_floorplan, clip_idx)
-            pcd = pcd[clip_idx_outside_floorplan]
+    """Clip a point cloud to the facade region of a building.
+
+    Args:
+        pcd (laspy): Point cloud
+        buffer_inside (float, optional): Remove every point closer than this signed distance to the BGT floorplan boundary, negative is inside. Defaults to 0.0.
+        buffer_outside (float, optional): Keep every point closer than this signed distance to the BAG outline boundary. Defaults to 0.0.
+        bgt_floorplan (list, optional): Floorplan coordinates. Defaults to None.
+        bag_floorplan (list, optional): Outline coordinates. Defaults to None.
+
+    Returns:
+        laspy
+    """
+    # Remove every point within a buffer inside of the floorplan
+    if bgt_floorplan and buffer_inside != 0:
+        distances = signed_distance_to_polygons(np.array([pcd.x, pcd.y]).T, bgt_floorplan)
+        pcd = pcd[distances >= buffer_inside]
+
+    # Keep every point within a buffer outside of the outline
+    if bag_floorplan and buffer_outside != 0:
+        distances = signed_distance_to_polygons(np.array([pcd.x, pcd.y]).T, bag_floorplan)
+        pcd = pcd[distances < buffer_outside]
 
     return pcd
 
 
-def clean_pointcloud_tiles(input_dir, output_dir, save_colors=True, voxel_size=0.1):
-    for file in os.listdir(input_dir):
-        print('Processing:', file)
-        lascloud = laspy.read(os.path.join(input_dir, file))
+# Rough memory use per point of a chunk in the streaming mode: the raw record, the
+# float64 copies and the voxel bookkeeping of the chunk
+STREAMING_BYTES_PER_POINT = 256
 
-        xyz = np.array([lascloud.x, lascloud.y, lascloud.z]).T
-        rgb = np.array([lascloud.red, lascloud.green, lascloud.blue]).T
+# Point dimensions that are averaged per voxel, all others are taken from the first point
+AVERAGED_DIMENSIONS = ('X', 'Y', 'Z', 'intensity', 'red', 'green', 'blue', 'nir')
 
-        pcd = o3d.geometry.PointCloud()
-        pcd.points = o3d.utility.Vector3dVector(xyz)
-        pcd.colors = o3d.utility.Vector3dVector(rgb)
 
-        # Reduce size
-        pcd = pcd.voxel_down_sample(voxel_size=voxel_size)
+def get_voxel_keys(xyz, origin, dims, voxel_size):
+    """One int64 key per point for the voxel it falls in"""
+    idx = np.floor((xyz - origin) / voxel_size).astype(np.int64)
+    idx = np.clip(idx, 0, dims - 1)
+    return np.ravel_multi_index(idx.T, dims)
 
-        output_lascloud = laspy.create()
-        output_lascloud.x = np.array(pcd.points)[:,0]
-        output_lascloud.y = np.array(pcd.points)[:,1]
-        output_lascloud.z = np.array(pcd.points)[:,2]
 
-        if save_colors:
-            output_lascloud.red = np.array(pcd.colors)[:,0]
-            output_lascloud.green = np.array(pcd.colors)[:,1]
-            output_lascloud.blue = np.array(pcd.colors)[:,2]
+def merge_voxels(voxels):
+    """Merge sets of voxels, keeping the first record and summing the averaged dimensions
 
-        output_lascloud.write(os.path.join(output_dir, 'cleaned_' + file))      
-        
+    Args:
+        voxels (list of tuple): keys (np.array(V,)), records (np.ndarray(V,)), sums (np.array(V,D)), counts (np.array(V,)) per set
 
+    Returns:
+        keys (np.array(V,)), records (np.ndarray(V,)), sums (np.array(V,D)), counts (np.array(V,))
+    """
+    keys, records, sums, counts = [np.concatenate(part) for part in zip(*voxels)]
+    keys, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    records = records[first]
+    sums = np.stack([np.bincount(inverse, weights=sums[:,i], minlength=keys.shape[0]) for i in range(sums.shape[1])], axis=1)
+    counts = np.bincount(inverse, weights=counts, minlength=keys.shape[0])
+    return keys, records, sums, counts
 
-def divide_tiles_per_building(input_dir, output_dir, city_map, city_outlines, buffer_inside=0.5, buffer_outside=0.5, save_colours=True):
-    for id, outline in list(city_outlines.items()):
-        print('Processing:', id)
 
-        # Get all points in floorplan
-        coords_list = []
-        for polygon in outline['outline']:
-            for coord in polygon:
-                coords_list.append(coord)
-        coords = np.array(coords_list)
+def voxel_down_sample(chunks, header, voxel_size=0.1):
+    """NumPy voxel downsampling of raw LAS point records.
 
-        # # Get all rijksdriehoek extrema of the polygon
-        # rd_x_min, rd_y_min = coords.min(axis=0) - buffer_outside
-        # rd_x_max, rd_y_max = coords.max(axis=0) + buffer_outside
+    Works directly on the structured point arrays of laspy, so every point dimension and
+    its dtype is kept. Per voxel the AVERAGED_DIMENSIONS (position, intensity and colour)
+    are averaged and all other dimensions are taken from the first point. The grid origin
+    is the header minimum minus half a voxel, like Open3D's voxel_down_sample. Voxels that
+    span several chunks are merged, so the result does not depend on the chunking.
 
-        # Get all cyclomedia floor extrema of the polygon
-        cm_x_min, cm_y_min = np.floor((coords.min(axis=0) - buffer_outside) / 50).astype(int) 
-        cm_x_max, cm_y_max = np.floor((coords.max(axis=0) + buffer_outside) / 50).astype(int) 
+    Every chunk is reduced to its voxels on its own. The reduced chunks are merged into the
+    voxels of the tile once they hold as many voxels as the tile so far, so every voxel is
+    merged a logarithmic number of times instead of once per chunk. The voxels of the tile
+    stay in memory, at most twice over.
 
-        # Check if all required pointcloud tiles are available
-        id_filedirs = []
-        id_filedirs_available = []
+    Args:
+        chunks (iterable of np.ndarray): Structured point arrays, e.g. `las.points.array`
+        header (laspy.LasHeader): Header with the scales, offsets and bounds of the points
+        voxel_size (float, optional): Voxel size. Defaults to 0.1.
 
-        for rd_x in np.arange(cm_x_min, cm_x_max + 1, 1):
-            for rd_y in np.arange(cm_y_min, cm_y_max + 1, 1):
-                filedir = os.path.join(input_dir, f'cleaned_filtered_{rd_x}_{rd_y}.laz')
-                id_filedirs.append(filedir)
-                id_filedirs_available.append(os.path.isfile(filedir))
+    Returns:
+        np.ndarray: Structured point array with one point per voxel
+    """
+    scales, offsets = np.array(header.scales), np.array(header.offsets)
+    origin = np.array(header.mins) - voxel_size * 0.5
+    dims = np.floor((np.array(header.maxs) - origin) / voxel_size).astype(np.int64) + 1
 
-        # When all needed pointclouds available, add info to dict
-        if np.array(id_filedirs_available).all():
-            # # Loop over all dirs and stack afterwards
-            # pcds_to_stack = []
-            # N = 0
+    voxels, pending = None, []
 
-            x = np.array([])
-            y = np.array([])
-            z = np.array([])
+    for array in chunks:
+        averaged = [name for name in AVERAGED_DIMENSIONS if name in array.dtype.names]
+        xyz = np.stack([array['X'], array['Y'], array['Z']], axis=1) * scales + offsets
 
-            if save_colours:
-                red = np.array([])
-                green = np.array([])
-                blue = np.array([])
+        chunk_keys = get_voxel_keys(xyz, origin, dims, voxel_size)
+        chunk_sums = np.stack([array[name] for name in averaged], axis=1).astype(float)
+        pending.append(merge_voxels([(chunk_keys, array, chunk_sums, np.ones(chunk_keys.shape[0]))]))
 
-            for i, dir in enumerate(id_filedirs):
-                pcd = laspy.read(dir)
+        if voxels is None or sum(part[0].shape[0] for part in pending) >= voxels[0].shape[0]:
+            voxels = merge_voxels(([voxels] if voxels is not None else []) + pending)
+            pending = []
 
-                try:
-                    pcd = filter_roi(pcd, buffer_inside, buffer_outside, bgt_floorplan=city_map[id]['floorplan'], bag_floorplan=outline['outline'])
-                except:
-                    print('WARNING: interior failed')
-                    pcd = filter_roi(pcd, 0, buffer_outside, bag_floorplan=outline['outline'])
+    if voxels is None:
+        return np.zeros(0, dtype=header.point_format.dtype())
+    keys, records, sums, counts = merge_voxels([voxels] + pending) if pending else voxels
 
-                x = np.concatenate([x, pcd.x])
-                y = np.concatenate([y, pcd.y])
-                z = np.concatenate([z, pcd.z])
+    means = sums / counts[:,None]
+    for i, name in enumerate(averaged):
+        records[name] = np.round(means[:,i]).astype(records.dtype[name])
+    return records
 
-                if save_colours:
-                    red = np.concatenate([red, pcd.red])
-                    green = np.concatenate([green, pcd.green])
-                    blue = np.concatenate([blue, pcd.blue])
 
-                print(x.shape, y.shape)
+def clean_pointcloud_tile(filedir, output_filedir, save_colors=True, voxel_size=0.1, streaming=False, chunk_size=1000000):
+    """Voxel downsample a single point cloud tile and write it with all of its point dimensions
+
+    Args:
+        filedir (str): Input point cloud
+        output_filedir (str): Output point cloud
+        save_colors (bool, optional): Write the colours, otherwise they are set to zero. Defaults to True.
+        voxel_size (float, optional): Voxel size. Defaults to 0.1.
+        streaming (bool, optional): Read the tile in chunks of chunk_size points. Defaults to False.
+        chunk_size (int, optional): Number of points per chunk. Defaults to 1000000.
+    """
+    print('Processing:', os.path.basename(filedir))
+
+    if streaming:
+        with laspy.open(filedir) as reader:
+            header = reader.header
+            array = voxel_down_sample((points.array for points in reader.chunk_iterator(chunk_size)), header, voxel_size=voxel_size)
+
+    else:
+        lascloud = laspy.read(filedir)
+        header = lascloud.header
+        array = voxel_down_sample([lascloud.points.array], header, voxel_size=voxel_size)
+
+    if not save_colors:
+        for name in ('red', 'green', 'blue'):
+            if name in array.dtype.names:
+                array[name] = 0
 
-            output_pcd = laspy.create()
-            output_pcd.x = x
-            output_pcd.y = y
-            output_pcd.z = z
+    output_lascloud = laspy.LasData(header=copy.deepcopy(header), points=laspy.PackedPointRecord(array, header.point_format))
+    output_lascloud.write(output_filedir)
 
-            if save_colours:
-                output_pcd.red = red
-                output_pcd.green = green
-                output_pcd.blue = blue
 
-            output_pcd.write(os.path.join(output_dir, f'{id}.laz'))
\ No newline at end of file
+def clean_pointcloud_tiles(input_dir, output_dir, save_colors=True, voxel_size=0.1, streaming=False, max_memory=None, chunk_size=1000000, workers=1):
+    """Voxel downsample every point cloud tile in a folder
+
+    Args:
+        input_dir (str): Folder with point cloud tiles
+        output_dir (str): Output folder, files are prefixed with 'cleaned_'
+        save_colors (bool, optional): Write the colours. Defaults to True.
+        voxel_size (float, optional): Voxel size. Defaults to 0.1.
+        streaming (bool, optional): Read the tiles in chunks instead of at once. Defaults to False.
+        max_memory (int, optional): Memory for the chunks of a worker in bytes for the streaming mode, sets chunk_size. The downsampled voxels of a tile are kept in memory on top of it. Defaults to None.
+        chunk_size (int, optional): Number of points per chunk for the streaming mode. Defaults to 1000000.
+        workers (int, optional): Number of tiles processed concurrently in a process pool. Defaults to 1.
+    """
+    if max_memory:
+        # Keep half of the memory free for the reduction of a chunk
+        chunk_size = max(1, int(max_memory // (2 * STREAMING_BYTES_PER_POINT)))
+
+    tasks = [(os.path.join(input_dir, file), os.path.join(output_dir, 'cleaned_' + file)) for file in os.listdir(input_dir)]
+    options = dict(save_colors=save_colors, voxel_size=voxel_size, streaming=streaming, chunk_size=chunk_size)
+
+    if workers == 1:
+        for filedir, output_filedir in tasks:
+            clean_pointcloud_tile(filedir, output_filedir, **options)
+
+    else:
+        # Spawn, forking after laspy has decompressed in this process can deadlock
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+            futures = [executor.submit(clean_pointcloud_tile, filedir, output_filedir, **options) for filedir, output_filedir in tasks]
+            for future in as_completed(futures):
+                future.result()
+
+
+def get_tile_codes_from_outline(outline, buffer=0.0):
+    """Get the codes of all 50 m point cloud tiles that a buffered outline touches
+
+    Args:
+        outline (list[list[list]]]): Building outline
+        buffer (float, optional): Buffer around the outline. Defaults to 0.0.
+
+    Returns:
+        list of tuple: (x, y) tile codes
+    """
+    coords = np.array([coord for polygon in outline for coord in polygon])
+
+    # Get all cyclomedia floor extrema of the polygon
+    cm_x_min, cm_y_min = np.floor((coords.min(axis=0) - buffer) / 50).astype(int)
+    cm_x_max, cm_y_max = np.floor((coords.max(axis=0) + buffer) / 50).astype(int)
+
+    return [(rd_x, rd_y) for rd_x in range(cm_x_min, cm_x_max + 1) for rd_y in range(cm_y_min, cm_y_max + 1)]
+
+
+def crop_pointcloud_to_outline(pcd, outline, buffer=0.0):
+    """Cheap bounding box crop of a point cloud to a buffered outline"""
+    coords = np.array([coord for polygon in outline for coord in polygon])
+    x_min, y_min = coords.min(axis=0) - buffer
+    x_max, y_max = coords.max(axis=0) + buffer
+
+    x, y = np.asarray(pcd.x), np.asarray(pcd.y)
+    return pcd[(x >= x_min) & (x <= x_max) & (y >= y_min) & (y <= y_max)]
+
+
+def write_building_pointcloud(filedir, parts, save_colours=True):
+    """Write the point cloud parts of a building, collected from several tiles, to one file
+
+    Args:
+        filedir (str): Output file
+        parts (list of dict): Arrays x, y, z and optionally red, green, blue per tile
+        save_colours (bool, optional): Write the colours. Defaults to True.
+    """
+    output_pcd = laspy.create()
+    output_pcd.x = np.concatenate([part['x'] for part in parts])
+    output_pcd.y = np.concatenate([part['y'] for part in parts])
+    output_pcd.z = np.concatenate([part['z'] for part in parts])
+
+    if save_colours:
+        output_pcd.red = np.concatenate([part['red'] for part in parts])
+        output_pcd.green = np.concatenate([part['green'] for part in parts])
+        output_pcd.blue = np.concatenate([part['blue'] for part in parts])
+
+    output_pcd.write(filedir)
+
+
+def divide_tiles_per_building(input_dir, output_dir, city_map, city_outlines, buffer_inside=0.5, buffer_outside=0.5, save_colours=True, store=False, shuffle=False):
+    """Split the cleaned point cloud tiles into one point cloud per building.
+
+    Every tile is read exactly once. A grid index maps each tile to the buildings whose
+    buffered outline touches it, the filtered points are collected per building and a
+    building is written to disk as soon as its last tile has been processed. Buildings
+    with a missing tile are skipped.
+
+    With store=True the buildings are appended to a PointCloudStore in output_dir instead
+    of being written as one {id}.laz each. Buildings that are already in the store are
+    skipped, so an interrupted run can be restarted.
+
+    Args:
+        input_dir (str): Folder with the cleaned_filtered_{x}_{y}.laz tiles
+        output_dir (str): Folder for the {id}.laz building point clouds
+        city_map (dict): BGT floorplans per id
+        city_outlines (dict): BAG outlines per id
+        buffer_inside (float, optional): Buffer inside of the floorplan to remove. Defaults to 0.5.
+        buffer_outside (float, optional): Buffer outside of the outline to keep. Defaults to 0.5.
+        save_colours (bool, optional): Write the colours. Defaults to True.
+        store (bool, optional): Write to a packed PointCloudStore. Defaults to False.
+        shuffle (bool, optional): Store the points of every building in random order. Defaults to False.
+    """
+    building_store = PointCloudStore(output_dir, mode='a', shuffle=shuffle) if store else None
+
+    try:
+        # Map every tile to the buildings that need it
+        remaining_tiles = {}
+        tile_buildings = {}
+
+        for id, outline in city_outlines.items():
+            if building_store and id in building_store:
+                continue
+
+            tile_codes = get_tile_codes_from_outline(outline['outline'], buffer_outside)
+
+            # Only use buildings for which all needed point cloud tiles are available
+            if all(os.path.isfile(os.path.join(input_dir, f'cleaned_filtered_{rd_x}_{rd_y}.laz')) for rd_x, rd_y in tile_codes):
+                remaining_tiles[id] = len(tile_codes)
+                for tile_code in tile_codes:
+                    tile_buildings.setdefault(tile_code, []).append(id)
+
+        parts = {id: [] for id in remaining_tiles}
+
+        for rd_x, rd_y in sorted(tile_buildings):
+            filedir = os.path.join(input_dir, f'cleaned_filtered_{rd_x}_{rd_y}.laz')
+            print('Processing:', filedir)
+            tile_pcd = laspy.read(filedir)
+
+            for id in tile_buildings[(rd_x, rd_y)]:
+                outline = city_outlines[id]['outline']
+
+                pcd = tile_pcd
+                if buffer_outside != 0:
+                    pcd = crop_pointcloud_to_outline(tile_pcd, outline, buffer_outside)
+
+                try:
+                    pcd = filter_roi(pcd, buffer_inside, buffer_outside, bgt_floorplan=city_map[id]['floorplan'], bag_floorplan=outline)
+                except:
+                    print(f'WARNING: interior failed for {id}')
+                    pcd = filter_roi(pcd, 0, buffer_outside, bag_floorplan=outline)
+
+                part = {'x': np.asarray(pcd.x), 'y': np.asarray(pcd.y), 'z': np.asarray(pcd.z)}
+                if save_colours:
+                    part.update(red=np.asarray(pcd.red), green=np.asarray(pcd.green), blue=np.asarray(pcd.blue))
+                parts[id].append(part)
+
+                # Write the building once all of its tiles are processed
+                remaining_tiles[id] -= 1
+                if remaining_tiles[id] == 0:
+                    if building_store:
+                        building_parts = parts.pop(id)
+                        building_store.append(id, **{key: np.concatenate([part[key] for part in building_parts]) for key in building_parts[0]})
+                    else:
+                        write_building_pointcloud(os.path.join(output_dir, f'{id}.laz'), parts.pop(id), save_colours)
+    finally:
+        if building_store:
+            building_store.close()
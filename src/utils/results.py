@@ -0,0 +1,67 @@
+import sqlite3
+import numpy as np
+
+
+class ResultStore:
+    """On-disk SQLite table with one result row per building.
+
+    Rows are committed as soon as they are appended, so a crashed run keeps everything
+    that finished before the crash. The first column is the primary key; columns that are
+    missing from an existing store are added when it is opened.
+    """
+
+    def __init__(self, path, columns):
+        """
+        Args:
+            path (str): SQLite file, created when it does not exist
+            columns (list of str): Column names, the first one is the building id
+        """
+        self.path = path
+        self.columns = list(columns)
+        self.connection = sqlite3.connect(path)
+
+        self.connection.execute(f'CREATE TABLE IF NOT EXISTS results ("{self.columns[0]}" TEXT PRIMARY KEY)')
+        existing = [row[1] for row in self.connection.execute('PRAGMA table_info(results)')]
+        for column in self.columns:
+            if column not in existing:
+                self.connection.execute(f'ALTER TABLE results ADD COLUMN "{column}"')
+        self.connection.commit()
+
+    def append(self, row):
+        """Insert (or replace) the result row of a building and commit it
+
+        Args:
+            row (list): Values in the order of the columns
+        """
+        row = [value.item() if isinstance(value, np.generic) else value for value in row]
+        columns = ', '.join(f'"{column}"' for column in self.columns)
+        placeholders = ', '.join('?' for _ in self.columns)
+        self.connection.execute(f'INSERT OR REPLACE INTO results ({columns}) VALUES ({placeholders})', row)
+        self.connection.commit()
+
+    def ids(self):
+        return {row[0] for row in self.connection.execute(f'SELECT "{self.columns[0]}" FROM results')}
+
+    def rows(self, ids=None):
+        """Result rows, in the order of ids when given
+
+        Args:
+            ids (list of str, optional): Building ids. Defaults to None, all rows.
+
+        Returns:
+            list of lists
+        """
+        columns = ', '.join(f'"{column}"' for column in self.columns)
+        rows = {row[0]: list(row) for row in self.connection.execute(f'SELECT {columns} FROM results')}
+        if ids is None:
+            return list(rows.values())
+        return [rows[id] for id in ids if id in rows]
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
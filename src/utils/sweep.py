@@ -0,0 +1,476 @@
+import copy
+import numpy as np
+
+from scipy.spatial import cKDTree
+
+from src.utils.bvh import TriangleBVH
+from src.utils.pointclouds import signed_distance_to_polygons
+
+
+SMOOTHING_KERNEL = np.array([0.1, 0.2, 0.4, 0.2, 0.1])
+
+
+class HeightSweep:
+    """Scores candidate intersection heights without rebuilding spatial structures.
+
+    The floorplan3d, building model and intersection samples each get one KD-tree. For a
+    candidate height the merged building consists of the floorplan3d samples below it, the
+    building model samples above it and the intersection samples lifted to it. Instead of
+    building a tree on that merged cloud, the k nearest floorplan3d and building model
+    samples of every point are looked up once and filtered on z per height. Whenever the
+    k neighbours cannot prove the nearest distance, k is doubled for those points and that
+    tree only, so the scores equal those of a KD-tree built on the merged samples. The
+    larger neighbourhoods are kept for later calls.
+    """
+
+    def __init__(self, samples_building_model, samples_floorplan3d, samples_intersection, samples_pointcloud, k=16):
+        """
+        Args:
+            samples_building_model (np.array(N,3)): Samples of the building model
+            samples_floorplan3d (np.array(N,3)): Samples of the 3D floorplan
+            samples_intersection (np.array(N,3)): Samples of the intersection at height 0, or None
+            samples_pointcloud (np.array(N,3)): Point cloud samples
+            k (int, optional): Initial number of neighbours per point. Defaults to 16.
+        """
+        self.floorplan = np.asarray(samples_floorplan3d, dtype=float).reshape(-1, 3)
+        self.building_model = np.asarray(samples_building_model, dtype=float).reshape(-1, 3)
+        self.k = k
+        self.evaluations = 0
+
+        self.floorplan_tree = cKDTree(self.floorplan, compact_nodes=False, balanced_tree=False)
+        self.building_model_tree = cKDTree(self.building_model, compact_nodes=False, balanced_tree=False)
+
+        self.intersection = None
+        if samples_intersection is not None and len(samples_intersection) > 0:
+            self.intersection = np.asarray(samples_intersection, dtype=float).reshape(-1, 3)
+
+            # A flat intersection only needs a 2D nearest neighbour per point
+            self.planar = np.ptp(self.intersection[:,2]) == 0
+            if self.planar:
+                self.intersection_tree = cKDTree(self.intersection[:,:2], compact_nodes=False, balanced_tree=False)
+            else:
+                self.intersection_tree = cKDTree(self.intersection, compact_nodes=False, balanced_tree=False)
+
+        self.set_queries(samples_pointcloud)
+
+    def set_queries(self, samples_pointcloud):
+        """Looks up the neighbours of new point cloud samples in the existing trees"""
+        self.queries = np.asarray(samples_pointcloud, dtype=float).reshape(-1, 3)
+        self.expanded = {}
+        self.floorplan_neighbours = self.neighbours(self.floorplan_tree, self.floorplan, self.queries, self.k)
+        self.building_model_neighbours = self.neighbours(self.building_model_tree, self.building_model, self.queries, self.k)
+
+        if self.intersection is not None and self.planar:
+            _, nearest = self.intersection_tree.query(self.queries[:,:2], workers=-1)
+            self.intersection_dxy = self.queries[:,:2] - self.intersection[nearest,:2]
+            self.intersection_z = self.intersection[nearest,2]
+
+    def for_queries(self, samples_pointcloud):
+        """Sweep of other point cloud samples that shares the trees of this one, e.g. for extra samples
+
+        Args:
+            samples_pointcloud (np.array(N,3)): Point cloud samples
+
+        Returns:
+            HeightSweep
+        """
+        sweep = copy.copy(self)
+        sweep.evaluations = 0
+        sweep.set_queries(samples_pointcloud)
+        return sweep
+
+    @staticmethod
+    def neighbours(tree, points, queries, k):
+        """k nearest neighbours of the queries
+
+        Returns:
+            distances (np.array(N,k)): Sorted neighbour distances
+            z (np.array(N,k)): Neighbour heights
+            complete (bool): True when the neighbours contain every point of the tree
+        """
+        k = min(k, points.shape[0])
+        if k == 0:
+            return np.zeros((queries.shape[0], 0)), np.zeros((queries.shape[0], 0)), True
+
+        distances, idx = tree.query(queries, k=k, workers=-1)
+        distances, idx = distances.reshape(queries.shape[0], k), idx.reshape(queries.shape[0], k)
+        return distances, points[idx,2], k == points.shape[0]
+
+    def intersection_distances(self, heights, rows=slice(None)):
+        queries = self.queries[rows]
+        if self.intersection is None:
+            return np.full((queries.shape[0], heights.shape[0]), np.inf)
+
+        if self.planar:
+            dx, dy = self.intersection_dxy[rows,0,None], self.intersection_dxy[rows,1,None]
+            dz = queries[:,2,None] - (self.intersection_z[rows,None] + heights[None,:])
+            return np.sqrt(dx * dx + dy * dy + dz * dz)
+
+        distances = np.empty((queries.shape[0], heights.shape[0]))
+        for i, height in enumerate(heights):
+            distances[:,i], _ = self.intersection_tree.query(queries - np.array([0.0, 0.0, height]), workers=-1)
+        return distances
+
+    @staticmethod
+    def filtered_distances(distances, z, heights, below):
+        """Nearest neighbour distance per height, using only neighbours below (or at and above) it
+
+        Args:
+            distances (np.array(N,k)): Neighbour distances
+            z (np.array(N,k)): Neighbour heights
+            heights (np.array(M,)): Sorted heights
+            below (bool): Keep neighbours with z < height, otherwise z >= height
+
+        Returns:
+            np.array(N,M)
+        """
+        num_queries, num_heights = distances.shape[0], heights.shape[0]
+        layers = np.searchsorted(heights, z, side='right')
+        rows = np.broadcast_to(np.arange(num_queries)[:,None], layers.shape)
+
+        # A neighbour in layer l lies below heights l.. and at or above heights ..l-1
+        filtered = np.full((num_queries, num_heights + 1), np.inf)
+        np.minimum.at(filtered, (rows, layers), distances)
+
+        if below:
+            return np.minimum.accumulate(filtered[:,:-1], axis=1)
+        return np.minimum.accumulate(filtered[:,:0:-1], axis=1)[:,::-1]
+
+    def distances(self, heights):
+        """Nearest neighbour distances of the point cloud samples to the buildings merged at `heights`
+
+        Args:
+            heights (np.array(M,)): Sorted intersection heights
+
+        Returns:
+            np.array(N,M)
+        """
+        heights = np.asarray(heights, dtype=float)
+        gap = self.queries[:,2,None] - heights[None,:]
+
+        floorplan_distances, floorplan_z, floorplan_complete = self.floorplan_neighbours
+        building_model_distances, building_model_z, building_model_complete = self.building_model_neighbours
+        floorplan = self.filtered_distances(floorplan_distances, floorplan_z, heights, below=True)
+        building_model = self.filtered_distances(building_model_distances, building_model_z, heights, below=False)
+        distances = np.minimum(np.minimum(floorplan, building_model), self.intersection_distances(heights))
+        floorplan_kth = floorplan_distances[:,-1].copy() if floorplan_distances.shape[1] > 0 else np.zeros(self.queries.shape[0])
+        building_model_kth = building_model_distances[:,-1].copy() if building_model_distances.shape[1] > 0 else np.zeros(self.queries.shape[0])
+
+        # Every tree only looks further for the points it cannot resolve yet
+        floorplan_rows = building_model_rows = np.arange(self.queries.shape[0])
+        floorplan_k = building_model_k = self.k
+        while True:
+            # Samples that were not among the k neighbours are at least the k-th distance away,
+            # and samples below (above) a height at least the height difference
+            if floorplan_complete:
+                floorplan_rows = floorplan_rows[:0]
+            resolved = np.isfinite(floorplan[floorplan_rows]) | (distances[floorplan_rows] <= np.maximum(floorplan_kth[floorplan_rows,None], gap[floorplan_rows]))
+            floorplan_rows = floorplan_rows[np.logical_not(resolved.all(axis=1))]
+
+            if building_model_complete:
+                building_model_rows = building_model_rows[:0]
+            resolved = np.isfinite(building_model[building_model_rows]) | (distances[building_model_rows] <= np.maximum(building_model_kth[building_model_rows,None], -gap[building_model_rows]))
+            building_model_rows = building_model_rows[np.logical_not(resolved.all(axis=1))]
+
+            if floorplan_rows.shape[0] == 0 and building_model_rows.shape[0] == 0:
+                break
+
+            if floorplan_rows.shape[0] > 0:
+                floorplan_k *= 2
+                neighbour_distances, neighbour_z, floorplan_complete = self.expanded_neighbours('floorplan', floorplan_rows, floorplan_k)
+                floorplan[floorplan_rows] = self.filtered_distances(neighbour_distances, neighbour_z, heights, below=True)
+                floorplan_kth[floorplan_rows] = neighbour_distances[:,-1]
+                distances[floorplan_rows] = np.minimum(distances[floorplan_rows], floorplan[floorplan_rows])
+
+            if building_model_rows.shape[0] > 0:
+                building_model_k *= 2
+                neighbour_distances, neighbour_z, building_model_complete = self.expanded_neighbours('building_model', building_model_rows, building_model_k)
+                building_model[building_model_rows] = self.filtered_distances(neighbour_distances, neighbour_z, heights, below=False)
+                building_model_kth[building_model_rows] = neighbour_distances[:,-1]
+                distances[building_model_rows] = np.minimum(distances[building_model_rows], building_model[building_model_rows])
+
+        return distances
+
+    def expanded_neighbours(self, name, rows, k):
+        """k nearest neighbours of some queries in the floorplan or building model tree, kept for later calls
+
+        Args:
+            name (str): 'floorplan' or 'building_model'
+            rows (np.array(R,)): Sorted query indices
+            k (int): Number of neighbours
+
+        Returns:
+            see neighbours
+        """
+        tree, points = getattr(self, name + '_tree'), getattr(self, name)
+        cached_rows, cached_distances, cached_z = self.expanded.get((name, k), (np.zeros(0, dtype=int), None, None))
+
+        missing = rows
+        if cached_rows.shape[0] > 0:
+            missing = rows[cached_rows[np.minimum(np.searchsorted(cached_rows, rows), cached_rows.shape[0] - 1)] != rows]
+
+        if missing.shape[0] > 0:
+            distances, z, _ = self.neighbours(tree, points, self.queries[missing], k)
+            if cached_rows.shape[0] > 0:
+                order = np.argsort(np.concatenate([cached_rows, missing]), kind='stable')
+                cached_rows = np.concatenate([cached_rows, missing])[order]
+                cached_distances, cached_z = np.vstack([cached_distances, distances])[order], np.vstack([cached_z, z])[order]
+            else:
+                cached_rows, cached_distances, cached_z = missing, distances, z
+            self.expanded[(name, k)] = (cached_rows, cached_distances, cached_z)
+
+        index = np.searchsorted(cached_rows, rows)
+        return cached_distances[index], cached_z[index], min(k, points.shape[0]) == points.shape[0]
+
+    def score(self, height):
+        """Average nearest neighbour score for a single intersection height
+
+        Args:
+            height (float): Intersection height
+
+        Returns:
+            float
+        """
+        self.evaluations += 1
+        return self.distances(np.array([height]))[:,0].mean()
+
+    def sweep(self, steps, return_distances=False):
+        """Average nearest neighbour score for every step
+
+        Args:
+            steps (np.array(M,)): Sorted intersection heights
+            return_distances (bool, optional): Also return the distance of every sample at every step. Defaults to False.
+
+        Returns:
+            np.array(M,): scores
+            np.array(N,M): distances, only with return_distances
+        """
+        self.evaluations += len(steps)
+        distances = self.distances(steps)
+        scores = np.ascontiguousarray(distances.T).mean(axis=1)
+        return (scores, distances) if return_distances else scores
+
+
+class ExactHeightSweep(HeightSweep):
+    """Scores candidate intersection heights with exact point-to-mesh distances.
+
+    Instead of surface samples the merged building is the building model clipped to the part
+    at or above the height, the floorplan walls from the bottom up to the height and the
+    intersection at the height. The floorplan walls and the intersection are vertical and
+    horizontal, so their distances follow from one 2D distance per point. The building model
+    triangles get one TriangleBVH that clips its boxes per height instead of being rebuilt.
+    """
+
+    def __init__(self, building_model, floorplan, bottom, intersection_geometry, samples_pointcloud):
+        """
+        Args:
+            building_model (trimesh.Trimesh): Wall and roof of the building model
+            floorplan (list[list[list]]]): Building floorplan
+            bottom (float): Bottom height of the floorplan walls
+            intersection_geometry (IntersectionGeometry): Intersection between the floorplan and outline, or None
+            samples_pointcloud (np.array(N,3)): Point cloud samples
+        """
+        self.floorplan = floorplan
+        self.intersection_geometry = intersection_geometry
+        self.bottom = bottom
+        self.evaluations = 0
+        self.bvh = TriangleBVH(building_model.vertices, building_model.faces)
+        self.set_queries(samples_pointcloud)
+
+    def set_queries(self, samples_pointcloud):
+        """2D distances of new point cloud samples to the floorplan and intersection"""
+        self.queries = np.asarray(samples_pointcloud, dtype=float).reshape(-1, 3)
+        self.floorplan_dxy = np.abs(signed_distance_to_polygons(self.queries[:,:2], self.floorplan))
+        self.intersection_dxy = None
+        if self.intersection_geometry:
+            self.intersection_dxy = np.maximum(signed_distance_to_polygons(self.queries[:,:2], self.intersection_geometry.polygons), 0.0)
+
+    def distances(self, heights):
+        """Distances of the point cloud samples to the buildings merged at `heights`
+
+        Args:
+            heights (np.array(M,)): Intersection heights
+
+        Returns:
+            np.array(N,M)
+        """
+        heights = np.asarray(heights, dtype=float)
+        z = self.queries[:,2,None]
+
+        dz = np.maximum(np.maximum(z - heights[None,:], self.bottom - z), 0.0)
+        distances = np.sqrt(self.floorplan_dxy[:,None] ** 2 + dz ** 2)
+        if self.intersection_dxy is not None:
+            distances = np.minimum(distances, np.sqrt(self.intersection_dxy[:,None] ** 2 + (z - heights[None,:]) ** 2))
+
+        return self.bvh.distances(self.queries, heights, upper_bounds=distances)
+
+
+def bootstrap_spread(distances, steps, smooth=False, bootstraps=32, confidence=0.9, seed=None):
+    """Uncertainty of the best height, from bootstrap resamples of the point cloud samples
+
+    Every resample weighs the samples by how often they are drawn, so its score curve is one
+    matrix product with the distances instead of a new sweep.
+
+    Args:
+        distances (np.array(N,M)): Distance of every sample at every step, from HeightSweep.sweep
+        steps (np.array(M,)): Sorted intersection heights
+        smooth (bool, optional): Apply the gaussian filter to the score curves. Defaults to False.
+        bootstraps (int, optional): Number of resamples. Defaults to 32.
+        confidence (float, optional): Share of the resamples within the spread. Defaults to 0.9.
+        seed (int or np.random.Generator, optional): Seed of the resampling. Defaults to None.
+
+    Returns:
+        float: width of the central `confidence` interval of the best heights of the resamples
+    """
+    rng = np.random.default_rng(seed)
+    num_samples = distances.shape[0]
+    weights = rng.multinomial(num_samples, np.full(num_samples, 1 / num_samples), size=bootstraps)
+    scores = weights @ distances / num_samples
+
+    if smooth:
+        width = scores.shape[1] - SMOOTHING_KERNEL.shape[0] + 1
+        if width <= 0:
+            return 0.0
+        scores = sum(weight * scores[:,i:i + width] for i, weight in enumerate(SMOOTHING_KERNEL))
+        steps = steps[2:-2]
+
+    # Quantiles on the steps themselves, an interpolated width would never equal whole steps
+    heights = steps[scores.argmin(axis=1)]
+    low, high = np.quantile(heights, [(1 - confidence) / 2, (1 + confidence) / 2], method='nearest')
+    return high - low
+
+
+def adaptive_sweep(sweep, samples_pointcloud, steps, sample_counts, smooth=False, height_tolerance=0.1, bootstraps=32, confidence=0.9, seed=None):
+    """Sweeps a growing number of point cloud samples until the best height is stable
+
+    Every round adds the next point cloud samples, looks them up in the trees of the sweep and
+    only computes their distances, so the samples of earlier rounds are never scored twice. A
+    building that needs all samples costs one full sweep plus the bootstraps. The height is
+    stable when the bootstrap spread is within height_tolerance and the best height moved at
+    most height_tolerance since the previous round.
+
+    Args:
+        sweep (HeightSweep): Scoring engine of the first sample_counts[0] point cloud samples
+        samples_pointcloud (np.array(N,3)): Point cloud samples in random order, N >= sample_counts[-1]
+        steps (np.array(M,)): Sorted intersection heights
+        sample_counts (list of int): Increasing numbers of samples per round
+        smooth (bool, optional): Apply the gaussian filter in the bootstrap. Defaults to False.
+        height_tolerance (float, optional): Spread of the best height at which to stop. Defaults to 0.1.
+        bootstraps (int, optional): Number of bootstrap resamples per round. Defaults to 32.
+        confidence (float, optional): Share of the resamples within the spread. Defaults to 0.9.
+        seed (int or np.random.Generator, optional): Seed of the bootstrap. Defaults to None.
+
+    Returns:
+        scores: (np.array(M,)),
+        count: (int) number of samples used,
+        spread: (float) see bootstrap_spread
+    """
+    rng = np.random.default_rng(seed)
+    sample_counts = sorted({min(count, samples_pointcloud.shape[0]) for count in sample_counts})
+    distances = np.empty((sample_counts[-1], steps.shape[0]))
+
+    start, previous = 0, None
+    for count in sample_counts:
+        part = sweep if start == 0 else sweep.for_queries(samples_pointcloud[start:count])
+        distances[start:count] = part.distances(steps)
+        sweep.evaluations += steps.shape[0]
+
+        scores = np.ascontiguousarray(distances[:count].T).mean(axis=1)
+        curve = np.convolve(scores, SMOOTHING_KERNEL, mode='valid') if smooth else scores
+        heights = steps[2:-2] if smooth else steps
+        height = heights[curve.argmin()] if heights.shape[0] else None
+
+        # Stable means a narrow bootstrap spread and the same best height as the last round,
+        # the spread is a whole number of steps up to rounding
+        spread = bootstrap_spread(distances[:count], steps, smooth=smooth, bootstraps=bootstraps, confidence=confidence, seed=rng)
+        if previous is not None and height is not None and spread <= height_tolerance + 1e-9 and abs(height - previous) <= height_tolerance + 1e-9:
+            break
+        start, previous = count, height
+
+    return scores, count, spread
+
+
+def histogram_seeds(z, steps, num_seeds=3):
+    """Indices of the steps at the densest z-levels of the point cloud
+
+    Args:
+        z (np.array(N,)): Point cloud heights
+        steps (np.array(M,)): Sorted, evenly spaced intersection heights
+        num_seeds (int, optional): Maximum number of seeds. Defaults to 3.
+
+    Returns:
+        np.array(K,)
+    """
+    stepsize = steps[1] - steps[0] if steps.shape[0] > 1 else 1.0
+    counts, _ = np.histogram(z, bins=np.append(steps, steps[-1] + stepsize))
+    seeds = np.argsort(counts, kind='stable')[::-1][:num_seeds]
+    return np.sort(seeds[counts[seeds] > 0])
+
+
+def coarse_to_fine_search(sweep, steps, coarse_stepsize=1.0, tolerance=None, candidates=2, smooth=False, seeds=None):
+    """Finds the best step with a coarse scan followed by a refinement around the best candidates
+
+    The coarse scan scores every `coarse_stepsize` and the seeds. The best `candidates` are
+    refined within one coarse step on either side, every `tolerance`. Both the scan and the
+    refinement windows of all candidates are scored in one sweep call each, a call has a
+    fixed cost for the neighbour lookups that a call per height would pay over and over.
+    With `smooth` the refinement uses the same gaussian filter as the full sweep, so a
+    refined score equals the full sweep score at that step.
+
+    Args:
+        sweep (HeightSweep): Scoring engine
+        steps (np.array(M,)): Sorted, evenly spaced intersection heights
+        coarse_stepsize (float, optional): Interval of the coarse scan. Defaults to 1.0.
+        tolerance (float, optional): Height tolerance of the refinement. Defaults to the stepsize.
+        candidates (int, optional): Number of coarse minima to refine. Defaults to 2.
+        smooth (bool, optional): Apply the gaussian filter. Defaults to False.
+        seeds (np.array(K,), optional): Extra step indices for the coarse scan. Defaults to None.
+
+    Returns:
+        index: (int) or None when there are too few steps,
+        score: (float),
+        raw_scores: (dict) unfiltered score per evaluated step index
+    """
+    stepsize = steps[1] - steps[0] if steps.shape[0] > 1 else 1.0
+    tolerance = stepsize if tolerance is None else tolerance
+    raw_scores = {}
+
+    def evaluate(indices):
+        missing = np.array(sorted(set(indices) - raw_scores.keys()), dtype=int)
+        if missing.shape[0] > 0:
+            raw_scores.update(zip(missing.tolist(), sweep.sweep(steps[missing])))
+
+    def objective(i):
+        if not smooth:
+            return raw_scores[i]
+        return np.dot(SMOOTHING_KERNEL, [raw_scores[j] for j in range(i - 2, i + 3)])
+
+    def window(indices):
+        return [j for i in indices for j in range(i - 2, i + 3)] if smooth else list(indices)
+
+    lo, hi = (2, steps.shape[0] - 3) if smooth else (0, steps.shape[0] - 1)
+    if hi < lo:
+        return None, np.inf, raw_scores
+
+    ratio = max(1, int(round(coarse_stepsize / stepsize)))
+    coarse = np.append(np.arange(lo, hi + 1, ratio), hi)
+    if seeds is not None:
+        coarse = np.append(coarse, np.clip(seeds, lo, hi))
+    coarse = np.unique(coarse)
+
+    evaluate(coarse)
+    coarse_scores = np.array([raw_scores[i] for i in coarse])
+
+    # Every refinement window in one call
+    stride = max(1, int(round(tolerance / stepsize)))
+    refined = set()
+    for candidate in coarse[np.argsort(coarse_scores, kind='stable')[:candidates]]:
+        start, end = max(lo, candidate - ratio), min(hi, candidate + ratio)
+        refined.update(range(start, end + 1, stride))
+        refined.update([candidate, end])
+    refined = sorted(refined)
+    evaluate(window(refined))
+
+    scores = [objective(i) for i in refined]
+    best = int(np.argmin(scores))
+    return refined[best], scores[best], raw_scores
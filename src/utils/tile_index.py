@@ -0,0 +1,138 @@
+import os
+import json
+import trimesh
+import threading
+import numpy as np
+
+from collections import OrderedDict
+
+from src.utils.cityjson import cityjson_to_meshes
+
+
+class TileIndex:
+    """Lazy access to the buildings of downloaded 3DBAG tiles.
+
+    Maps every Building and BuildingPart id to the tile file that holds it, so only the
+    tiles of the requested buildings are parsed. At most `max_tiles` parsed tiles are kept,
+    the least recently used one is dropped first, so memory does not grow with the number
+    of tiles. Can be passed as `city_model` to the dataloader instead of a merged CityJSON.
+    """
+
+    def __init__(self, tile_files, index_file=None, max_tiles=4, lod=2.2):
+        """
+        Args:
+            tile_files (list of str): 3DBAG CityJSON tiles, e.g. from get_bag3d_tile_files
+            index_file (str, optional): JSON file that keeps the index between runs, only new or changed tiles are scanned. Defaults to None.
+            max_tiles (int, optional): Maximum number of parsed tiles in memory. Defaults to 4.
+            lod (float, optional): Level of detail. Defaults to 2.2.
+        """
+        self.tile_files = list(tile_files)
+        self.index_file = index_file
+        self.max_tiles = max_tiles
+        self.lod = lod
+        self.tiles = OrderedDict()
+        self.lock = threading.Lock()
+        self.loading = {}
+
+        scanned = {}
+        if index_file is not None and os.path.isfile(index_file):
+            with open(index_file) as f:
+                scanned = json.load(f)
+
+        changed = False
+        for tile_file in self.tile_files:
+            stat = os.stat(tile_file)
+            if tile_file in scanned and scanned[tile_file]['stat'] == [stat.st_size, stat.st_mtime]:
+                continue
+
+            with open(tile_file) as f:
+                j = json.load(f)
+            ids = [id for id, city_object in j['CityObjects'].items() if city_object['type'] in ('Building', 'BuildingPart')]
+            scanned[tile_file] = {'stat': [stat.st_size, stat.st_mtime], 'ids': ids}
+            changed = True
+
+        if index_file is not None and changed:
+            with open(index_file, 'w') as f:
+                json.dump(scanned, f)
+
+        # A building on a tile border is in several tiles, the first one is used
+        self.index = {}
+        for tile_file in self.tile_files:
+            for id in scanned[tile_file]['ids']:
+                self.index.setdefault(id, tile_file)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['tiles'] = OrderedDict()
+        state['loading'] = {}
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, id):
+        return id in self.index
+
+    def tile_file(self, id):
+        """Tile file that holds a city object, None when it is in no tile"""
+        return self.index.get(id)
+
+    def read_tile(self, tile_file):
+        with open(tile_file) as f:
+            j = json.load(f)
+
+        # Convert the vertices once per tile instead of once per building
+        vertices = np.asarray(j['vertices'], dtype=np.float64)
+        transform = j.pop('transform', None)
+        if transform:
+            vertices = vertices * np.array(transform['scale']) + np.array(transform['translate'])
+        j['vertices'] = vertices
+        return j
+
+    def get_cached(self, tile_file):
+        # Call with self.lock held
+        if tile_file in self.tiles:
+            self.tiles.move_to_end(tile_file)
+            return self.tiles[tile_file]
+        return None
+
+    def load_tile(self, tile_file):
+        # Prefetch threads share the loaded tiles. A tile is parsed outside of the shared lock,
+        # threads that need the same tile wait for its own lock instead of parsing it again.
+        with self.lock:
+            j = self.get_cached(tile_file)
+            if j is not None:
+                return j
+            tile_lock = self.loading.setdefault(tile_file, threading.Lock())
+
+        with tile_lock:
+            with self.lock:
+                j = self.get_cached(tile_file)
+            if j is not None:
+                return j
+
+            j = self.read_tile(tile_file)
+            with self.lock:
+                self.tiles[tile_file] = j
+                if len(self.tiles) > self.max_tiles:
+                    self.tiles.popitem(last=False)
+                self.loading.pop(tile_file, None)
+            return j
+
+    def get(self, id):
+        """Meshes of a city object
+
+        Args:
+            id (str): City object id, e.g. 'NL.IMBAG.Pand.0363100012165490-0'
+
+        Returns:
+            (trimesh.Trimesh, trimesh.Trimesh, trimesh.Trimesh): ground, wall, roof
+        """
+        j = self.load_tile(self.index[id])
+        meshes = cityjson_to_meshes(j, ids=[id], lod=self.lod)[id]
+        return tuple(trimesh.Trimesh(vertices, faces) for vertices, faces in meshes)